@@ -0,0 +1,349 @@
+# analyze_warp.py
+"""
+Extract Photoshop's smart object warp from a calibration render.
+
+Photoshop's custom warps (mug curvature, cap bulge) are reproduced by rendering
+a known grid through the template once, e.g. with main.py:
+
+    images/calibration_grid.png  ->  output/result_calibration_grid.png
+
+This script finds the grid intersections in both images, fits a smooth dense
+displacement field between them (thin-plate spline) and saves it as a float32
+remap LUT that psd_renderer.load_warp_lut() plays back with a single gather:
+
+    python analyze_warp.py --psd psdFiles/mug.psd
+
+An error report comparing the LUT render with the real Photoshop output is
+printed and written next to the LUT.
+"""
+import argparse
+import json
+import os
+import sys
+from pathlib import Path
+
+import numpy as np
+from PIL import Image
+
+BASE_DIR = Path(__file__).resolve().parent
+sys.path.insert(0, str(BASE_DIR / "server"))
+
+import psd_renderer  # noqa: E402
+
+LUT_DIR = BASE_DIR / "server" / "warp_luts"
+
+
+def vertical_runs(mask, min_length):
+    """
+    Vertical runs of at least ``min_length`` True pixels as (x, top, bottom) arrays, bottom
+    exclusive: what a morphological opening with a 1 x ``min_length`` line keeps.
+    """
+    padded = np.zeros((mask.shape[0] + 2, mask.shape[1]), dtype=np.int8)
+    padded[1:-1] = mask
+    edges = np.diff(padded, axis=0)
+    # Transposed so each column's starts and ends come out top to bottom, column by column
+    start_x, tops = np.nonzero(edges.T == 1)
+    _, bottoms = np.nonzero(edges.T == -1)
+    long = bottoms - tops >= min_length
+    return start_x[long], tops[long], bottoms[long]
+
+
+def connected_runs(xs, tops, bottoms):
+    """Group runs (sorted by x, then top) into 8-connected components; returns a label per run."""
+    parent = np.arange(len(xs))
+
+    def root(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    column_starts = np.searchsorted(xs, np.arange(xs.max() + 2)) if len(xs) else []
+    for x in range(len(column_starts) - 2):
+        left = range(column_starts[x], column_starts[x + 1])
+        right = range(column_starts[x + 1], column_starts[x + 2])
+        j = right.start
+        for i in left:
+            # Diagonal neighbours touch too: runs overlap once widened by a row
+            while j < right.stop and bottoms[j] < tops[i]:
+                j += 1
+            k = j
+            while k < right.stop and tops[k] <= bottoms[i]:
+                parent[root(k)] = root(i)
+                k += 1
+    return np.array([root(i) for i in range(len(xs))], dtype=int)
+
+
+def find_grid_columns(dark, min_length=25):
+    """Vertical grid lines as (mean x, ys, xs) pixel sets, left to right."""
+    xs, tops, bottoms = vertical_runs(dark, min_length)
+    labels = connected_runs(xs, tops, bottoms)
+    columns = []
+    for label in np.unique(labels):
+        runs = np.nonzero(labels == label)[0]
+        ys = np.concatenate([np.arange(tops[i], bottoms[i]) for i in runs])
+        if np.ptp(ys) >= 3 * min_length:
+            run_xs = np.concatenate([np.full(bottoms[i] - tops[i], xs[i]) for i in runs])
+            columns.append((run_xs.mean(), ys, run_xs))
+    columns.sort(key=lambda column: column[0])
+    return columns
+
+
+def find_crossings(gray, valid, column, reach=(3, 7), threshold=200):
+    """Points where horizontal lines leave ``column`` on either side, top to bottom."""
+    _, ys, xs = column
+    height, width = gray.shape
+    rows = np.unique(ys)
+    centre = np.array([xs[ys == y].mean() for y in rows])
+
+    hit = np.zeros(len(rows), dtype=bool)
+    for sign in (-1, 1):
+        side = np.full(len(rows), 255.0)
+        for distance in range(*reach):
+            xi = np.clip(np.round(centre + sign * distance).astype(int), 0, width - 1)
+            side = np.minimum(side, np.where(valid[rows, xi], gray[rows, xi], 255.0))
+        hit |= side < threshold
+
+    groups = []
+    for y in rows[hit]:
+        if groups and y - groups[-1][-1] <= 3:
+            groups[-1].append(y)
+        else:
+            groups.append([y])
+    return [(float(np.interp(np.mean(g), rows, centre)), float(np.mean(g))) for g in groups]
+
+
+def label_rows(columns):
+    """
+    Give every crossing a row index that is consistent across columns.
+
+    The column with the most crossings is numbered top to bottom; labels then
+    spread to neighbouring columns by nearest y after removing the median drift,
+    so a crossing hidden by the rim in one column doesn't shift the others.
+    """
+    labelled = [None] * len(columns)
+    reference = max(range(len(columns)), key=lambda i: len(columns[i]))
+    labelled[reference] = [(x, y, row) for row, (x, y) in enumerate(columns[reference])]
+    ref_ys = np.array([y for _, y in columns[reference]])
+    spacing = float(np.median(np.diff(ref_ys))) if len(ref_ys) > 1 else 1.0
+
+    for order in (range(reference + 1, len(columns)), range(reference - 1, -1, -1)):
+        previous = labelled[reference]
+        for index in order:
+            prev_ys = np.array([y for _, y, _ in previous])
+            prev_rows = np.array([row for _, _, row in previous])
+            ys = np.array([y for _, y in columns[index]])
+            if not len(ys) or not len(prev_ys):
+                labelled[index] = []
+                continue
+            nearest = np.abs(ys[:, None] - prev_ys[None, :]).argmin(axis=1)
+            drift = float(np.median(ys - prev_ys[nearest]))
+            nearest = np.abs((ys - drift)[:, None] - prev_ys[None, :]).argmin(axis=1)
+            rows = prev_rows[nearest] + np.round((ys - drift - prev_ys[nearest]) / spacing).astype(int)
+            labelled[index] = [(x, y, int(row)) for (x, y), row in zip(columns[index], rows)]
+            previous = labelled[index]
+    return labelled
+
+
+def detect_grid(rgb, valid):
+    """Grid intersections as {(column, row): (x, y)} with zero-based indices."""
+    gray = rgb.max(axis=2).astype(np.float64)  # red labels stay bright, black lines don't
+    columns = find_grid_columns((gray < 128) & valid)
+    crossings = label_rows([find_crossings(gray, valid, column) for column in columns])
+
+    points = {}
+    lowest = min((row for column in crossings for _, _, row in column), default=0)
+    for col, column in enumerate(crossings):
+        for x, y, row in column:
+            points[(col, row - lowest)] = (x + 0.5, y + 0.5)  # pixel index -> centre
+    return points
+
+
+def fit_tps(points, values, smoothing=1.0):
+    """Fit a thin-plate spline from 2D ``points`` to 2D ``values``."""
+    scale = 1000.0
+    p = points / scale
+    count = len(p)
+    r2 = ((p[:, None, :] - p[None, :, :]) ** 2).sum(-1)
+    kernel = np.where(r2 > 0, r2 * np.log(np.maximum(r2, 1e-20)), 0.0)
+    poly = np.hstack([np.ones((count, 1)), p])
+    system = np.zeros((count + 3, count + 3))
+    system[:count, :count] = kernel + np.eye(count) * smoothing * 1e-4
+    system[:count, count:] = poly
+    system[count:, :count] = poly.T
+    rhs = np.zeros((count + 3, 2))
+    rhs[:count] = values
+    return p, np.linalg.solve(system, rhs), scale
+
+
+def eval_tps(model, x, y, chunk=64):
+    """Evaluate a fitted thin-plate spline on coordinate arrays ``x``/``y``."""
+    centres, coeffs, scale = model
+    weights, affine = coeffs[:-3], coeffs[-3:]
+    out = np.empty(x.shape + (2,), dtype=np.float64)
+    for start in range(0, x.shape[0], chunk):
+        px = x[start:start + chunk, ..., None] / scale
+        py = y[start:start + chunk, ..., None] / scale
+        r2 = (px - centres[:, 0]) ** 2 + (py - centres[:, 1]) ** 2
+        basis = np.where(r2 > 0, r2 * np.log(np.maximum(r2, 1e-20)), 0.0)
+        out[start:start + chunk] = (
+            basis @ weights
+            + affine[0]
+            + px * affine[1]
+            + py * affine[2]
+        )
+    return out
+
+
+def match_points(out_points, src_points, col_offset, row_offset):
+    """Pairs of (render xy, grid xy) for one alignment of the two grids."""
+    return [
+        (xy, src_points[(col + col_offset, row + row_offset)])
+        for (col, row), xy in out_points.items()
+        if (col + col_offset, row + row_offset) in src_points
+    ]
+
+
+def build_lut(pairs, box, source_size, smoothing):
+    """Fit the field through matched points and return (WarpGrid, residuals)."""
+    dst = np.array([p[0] for p in pairs])
+    src = np.array([p[1] for p in pairs])
+    model = fit_tps(dst, src, smoothing)
+    residuals = np.linalg.norm(eval_tps(model, dst[None, :, 0], dst[None, :, 1])[0] - src, axis=1)
+
+    # Drop stray detections (rim edges, text) that the smooth field can't follow.
+    keep = residuals <= 3 * np.median(residuals) + 2.0
+    if not keep.all() and keep.sum() >= 6:
+        dst, src = dst[keep], src[keep]
+        model = fit_tps(dst, src, smoothing)
+        residuals = np.linalg.norm(eval_tps(model, dst[None, :, 0], dst[None, :, 1])[0] - src, axis=1)
+
+    left, top, right, bottom = box
+    x, y = np.meshgrid(np.arange(left, right) + 0.5, np.arange(top, bottom) + 0.5)
+    field = eval_tps(model, x, y).astype(np.float32)
+    warp = psd_renderer.WarpGrid(box, field[..., 0], field[..., 1], source_size)
+    return warp, residuals
+
+
+def compare(rendered, reference, valid):
+    """Per-pixel error statistics between two RGB uint8 images."""
+    error = np.abs(rendered.astype(np.float64) - reference.astype(np.float64)).mean(axis=2)
+    mse = float((error[valid] ** 2).mean()) if valid.any() else 0.0
+    return {
+        "mean_abs_error": float(error[valid].mean()) if valid.any() else 0.0,
+        "p95_abs_error": float(np.percentile(error[valid], 95)) if valid.any() else 0.0,
+        "psnr_db": float(10 * np.log10(255.0 ** 2 / mse)) if mse > 0 else float("inf"),
+    }, error
+
+
+def render_rgb(template, image, warp):
+    """Render ``image`` through ``template`` as an RGB uint8 array."""
+    return np.asarray(psd_renderer.render_image(template, image, warp).convert("RGB"))
+
+
+def analyze_distortion(psd_path, grid_path, render_path, layer_name=psd_renderer.LAYER_NAME, smoothing=1.0):
+    """
+    Compare the original grid with Photoshop's render of it and return
+    (WarpGrid, report) for the best fitting grid alignment.
+    """
+    template = psd_renderer.load_template(psd_path, layer_name)
+    grid_image = Image.open(grid_path).convert("RGB")
+    reference = np.asarray(Image.open(render_path).convert("RGB"))
+    if reference.shape[1::-1] != tuple(template.canvas_size):
+        raise ValueError(f"Render is {reference.shape[1::-1]}, template canvas is {template.canvas_size}")
+
+    # Only trust pixels where the smart object shows through the overlay.
+    valid = (template.mask > 0.5) & (template.above_coverage() < 0.5)
+    src_points = detect_grid(np.asarray(grid_image), np.ones(grid_image.size[::-1], dtype=bool))
+    out_points = detect_grid(reference, valid)
+    if not out_points:
+        raise ValueError("No grid intersections found in the Photoshop render")
+
+    src_cols = max(col for col, _ in src_points) + 1
+    src_rows = max(row for _, row in src_points) + 1
+
+    # Which source column/row the first visible one is can't be read off the
+    # render (the mug hides part of the grid), so try every alignment that
+    # explains most detected points and keep the one whose playback matches
+    # Photoshop best.
+    min_pairs = max(6, int(0.8 * len(out_points)))
+    best = None
+    candidates = 0
+    for col_offset in range(-src_cols + 1, src_cols):
+        for row_offset in range(-src_rows + 1, src_rows):
+            pairs = match_points(out_points, src_points, col_offset, row_offset)
+            if len(pairs) < min_pairs:
+                continue
+            candidates += 1
+            warp, residuals = build_lut(pairs, template.region, grid_image.size, smoothing)
+            stats, _ = compare(render_rgb(template, grid_image, warp), reference, valid)
+            if best is None or stats["mean_abs_error"] < best[0]["mean_abs_error"]:
+                best = (stats, warp, residuals, col_offset, row_offset)
+
+    if best is None:
+        raise ValueError("Could not match the rendered grid to the calibration grid")
+    stats, warp, residuals, col_offset, row_offset = best
+
+    # What the template renders without a LUT (its warp mesh or transform box).
+    baseline, _ = compare(render_rgb(template, grid_image, None), reference, valid)
+    report = {
+        "psd": os.path.basename(psd_path),
+        "layer_name": layer_name,
+        "source_size": list(grid_image.size),
+        "box": list(warp.box),
+        "grid_points_matched": int(len(residuals)),
+        "grid_alignment": {"first_column": col_offset, "first_row": row_offset, "candidates": candidates},
+        "point_residual_px": {
+            "mean": float(residuals.mean()),
+            "max": float(residuals.max()),
+        },
+        "lut_vs_photoshop": stats,
+        "psd_warp_vs_photoshop": baseline,
+    }
+    return warp, report
+
+
+def save_lut(warp, lut_path):
+    """Write a WarpGrid as the .npz LUT read by psd_renderer.load_warp_lut()."""
+    os.makedirs(os.path.dirname(os.path.abspath(lut_path)), exist_ok=True)
+    np.savez(
+        lut_path,
+        box=np.array(warp.box, dtype=np.int32),
+        map_x=warp.map_x.astype(np.float32),
+        map_y=warp.map_y.astype(np.float32),
+        source_size=np.array(warp.source_size, dtype=np.int32),
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Fit a remap LUT from a Photoshop calibration render.")
+    parser.add_argument("--psd", default=str(BASE_DIR / "psdFiles" / "mug.psd"))
+    parser.add_argument("--grid", default=str(BASE_DIR / "images" / "calibration_grid.png"))
+    parser.add_argument("--render", default=str(BASE_DIR / "output" / "result_calibration_grid.png"))
+    parser.add_argument("--layer", default=psd_renderer.LAYER_NAME)
+    parser.add_argument("--out", help="LUT path (default: server/warp_luts/<psd name>.npz)")
+    parser.add_argument("--smoothing", type=float, default=1.0, help="Thin-plate spline regularisation")
+    parser.add_argument("--diff", help="Optional path for an error heat-map PNG")
+    args = parser.parse_args()
+
+    lut_path = args.out or str(LUT_DIR / f"{Path(args.psd).stem}.npz")
+    warp, report = analyze_distortion(args.psd, args.grid, args.render, args.layer, args.smoothing)
+    save_lut(warp, lut_path)
+
+    report_path = os.path.splitext(lut_path)[0] + ".report.json"
+    with open(report_path, "w") as f:
+        json.dump(report, f, indent=2)
+
+    if args.diff:
+        template = psd_renderer.load_template(args.psd, args.layer)
+        reference = np.asarray(Image.open(args.render).convert("RGB"))
+        grid_image = Image.open(args.grid).convert("RGB")
+        _, error = compare(render_rgb(template, grid_image, warp), reference, np.ones(reference.shape[:2], dtype=bool))
+        Image.fromarray(np.clip(error * 4, 0, 255).astype(np.uint8)).save(args.diff)
+
+    print(json.dumps(report, indent=2))
+    print(f"LUT saved to {lut_path}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,284 @@
+# batch_render.py
+"""
+Render every image in a directory into every given template.
+
+    python batch_render.py --psd psdFiles/mug.psd psdFiles/cap.psd --images images --out output/batch
+
+Replaces the one-template, one-image-at-a-time loops of main.py and
+with_psd_tools.py. The images x templates cross product is split into chunks
+of one template and a few images, and the chunks run on a process pool, so
+each worker maps a template once (from its compiled bundle, see
+server/template_bundle.py) and renders several images into it.
+
+Progress is recorded in <out>/manifest.json after every chunk. Running the
+same command again skips items whose output exists and whose image, template
+and output options are unchanged, so an interrupted batch picks up where it
+stopped (--force renders everything again).
+
+Each item's render/encode time is printed as it finishes, followed by a
+throughput summary. --backend photoshop drives Photoshop instead, one item at
+a time (a single Photoshop instance can't render in parallel).
+
+--profile prof|collapsed profiles every item's decode, render and encode (see
+server/profiling.py) into <out>/profiles/.
+"""
+import argparse
+import glob
+import json
+import os
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pathlib import Path
+
+BASE_DIR = Path(__file__).resolve().parent
+sys.path.insert(0, str(BASE_DIR / "server"))
+
+import output_encoder  # noqa: E402
+import profiling  # noqa: E402
+from render_cache import file_digest  # noqa: E402
+from upload_normalizer import normalize_upload  # noqa: E402
+
+LAYER_NAME = "front_surface"
+BUNDLE_DIR = BASE_DIR / "server" / "template_bundles"
+LUT_DIR = BASE_DIR / "server" / "warp_luts"
+IMAGE_EXTENSIONS = ("*.png", "*.jpg", "*.jpeg", "*.webp")
+MANIFEST_VERSION = 1
+
+
+def find_images(images_dir):
+    image_files = []
+    for ext in IMAGE_EXTENSIONS:
+        image_files.extend(glob.glob(os.path.join(images_dir, ext)))
+    return sorted(image_files)
+
+
+def item_id(psd_path, image_path):
+    return f"{Path(psd_path).name}|{Path(image_path).name}"
+
+
+def output_path_for(out_dir, psd_path, image_path, encoding):
+    return os.path.join(out_dir, Path(psd_path).stem, f"{Path(image_path).stem}{encoding.extension}")
+
+
+def load_manifest(path):
+    try:
+        with open(path, "r") as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return {"version": MANIFEST_VERSION, "items": {}}
+    if manifest.get("version") != MANIFEST_VERSION:
+        return {"version": MANIFEST_VERSION, "items": {}}
+    return manifest
+
+
+def save_manifest(path, manifest):
+    """Write the manifest atomically so an interrupted run never leaves it half-written."""
+    staging = f"{path}.tmp"
+    with open(staging, "w") as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(staging, path)
+
+
+def is_done(entry, fingerprint, output_path):
+    return entry is not None and entry.get("fingerprint") == fingerprint and os.path.exists(output_path)
+
+
+def profile_path_for(out_dir, psd_path, image_path, profile):
+    if profile is None:
+        return None
+    return profiling.profile_path(os.path.join(out_dir, "profiles"), f"{Path(psd_path).stem}_{Path(image_path).stem}", profile)
+
+
+def render_chunk(psd_path, image_paths, out_dir, layer_name, encoding, lut_path, profile=None):
+    """
+    Worker body (psd-tools): load the template once, render and encode each image.
+
+    Returns one result dict per image; failures are reported, not raised.
+    ``profile`` ("prof" or "collapsed") profiles each image's render and encode.
+    """
+    import psd_renderer
+    import template_bundle
+
+    template = template_bundle.get_bundle(psd_path, str(BUNDLE_DIR), layer_name)
+    warp = psd_renderer.get_warp_lut(lut_path)
+    target_size = psd_renderer.artwork_size(template, warp)
+
+    results = []
+    for image_path in image_paths:
+        output_path = output_path_for(out_dir, psd_path, image_path, encoding)
+        profile_path = profile_path_for(out_dir, psd_path, image_path, profile)
+        try:
+            with profiling.profile(profile, profile_path):
+                started = time.perf_counter()
+                image = normalize_upload(image_path, [target_size])
+                rendered = psd_renderer.render_image(template, image, warp)
+                render_ms = round((time.perf_counter() - started) * 1000, 1)
+                stats = output_encoder.encode(rendered, output_path, encoding)
+            results.append({"psd": psd_path, "image": image_path, "output": output_path, "render_ms": render_ms,
+                            "profile": profile_path, **stats})
+        except Exception as e:
+            results.append({"psd": psd_path, "image": image_path, "error": str(e)})
+    return results
+
+
+def render_with_photoshop(psd_path, image_paths, out_dir, layer_name, encoding, session, profile=None):
+    """Photoshop counterpart of render_chunk, run in this process."""
+    import psd_renderer
+
+    target_size = psd_renderer.smart_object_size(psd_path, layer_name)
+    results = []
+    for image_path in image_paths:
+        output_path = output_path_for(out_dir, psd_path, image_path, encoding)
+        profile_path = profile_path_for(out_dir, psd_path, image_path, profile)
+        try:
+            with profiling.profile(profile, profile_path):
+                started = time.perf_counter()
+                normalized = os.path.join(tempfile.gettempdir(), f"batch_{os.getpid()}_{Path(image_path).stem}.png")
+                normalize_upload(image_path, [target_size]).save(normalized, compress_level=1)
+                rendered = os.path.join(tempfile.gettempdir(), f"batch_{os.getpid()}_render.png")
+                try:
+                    session.render(psd_path, normalized, rendered, layer_name)
+                finally:
+                    os.unlink(normalized)
+                render_ms = round((time.perf_counter() - started) * 1000, 1)
+                stats = output_encoder.encode(rendered, output_path, encoding)
+            results.append({"psd": psd_path, "image": image_path, "output": output_path, "render_ms": render_ms,
+                            "profile": profile_path, **stats})
+        except Exception as e:
+            results.append({"psd": psd_path, "image": image_path, "error": str(e)})
+    return results
+
+
+def plan(psd_paths, image_paths, out_dir, encoding, layer_name, manifest, force):
+    """Work still to do as {psd_path: [image_path, ...]}, plus fingerprints and the skip count."""
+    options = {"layer": layer_name, "encoding": encoding.to_dict()}
+    image_hashes = {image_path: file_digest(image_path) for image_path in image_paths}
+    todo, fingerprints, skipped = {}, {}, 0
+    for psd_path in psd_paths:
+        psd_hash = file_digest(psd_path)
+        lut_path = LUT_DIR / f"{Path(psd_path).stem}.npz"
+        lut_hash = file_digest(str(lut_path)) if lut_path.exists() else None
+        for image_path in image_paths:
+            key = item_id(psd_path, image_path)
+            fingerprint = {"image_sha256": image_hashes[image_path], "psd_sha256": psd_hash, "warp_lut": lut_hash, **options}
+            fingerprints[key] = fingerprint
+            output_path = output_path_for(out_dir, psd_path, image_path, encoding)
+            if not force and is_done(manifest["items"].get(key), fingerprint, output_path):
+                skipped += 1
+                continue
+            todo.setdefault(psd_path, []).append(image_path)
+    return todo, fingerprints, skipped
+
+
+def chunks(todo, size):
+    for psd_path, image_paths in todo.items():
+        for start in range(0, len(image_paths), size):
+            yield psd_path, image_paths[start:start + size]
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(int(round(fraction * (len(ordered) - 1))), len(ordered) - 1)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Render every image into every template, in parallel and resumably.")
+    parser.add_argument("--psd", nargs="+", required=True, help="Template PSDs")
+    parser.add_argument("--images", default=str(BASE_DIR / "images"), help="Directory of images")
+    parser.add_argument("--out", default=str(BASE_DIR / "output" / "batch"))
+    parser.add_argument("--layer", default=LAYER_NAME)
+    parser.add_argument("--backend", choices=["psd-tools", "photoshop"], default="psd-tools")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 2)
+    parser.add_argument("--chunk", type=int, default=4, help="Images per task (one template each)")
+    parser.add_argument("--format", default="png", help="png, jpeg or webp")
+    parser.add_argument("--quality", type=int)
+    parser.add_argument("--compression", type=int)
+    parser.add_argument("--colors", type=int)
+    parser.add_argument("--force", action="store_true", help="Ignore the manifest and render everything")
+    parser.add_argument("--profile", choices=list(profiling.PROFILE_FORMATS),
+                        help="Profile each item into <out>/profiles (cProfile .prof or collapsed stacks)")
+    args = parser.parse_args()
+
+    try:
+        encoding = output_encoder.EncodeOptions(args.format, args.quality, args.compression, args.colors)
+    except ValueError as e:
+        parser.error(str(e))
+    image_paths = find_images(args.images)
+    if not image_paths:
+        print(f"No images found in {args.images}")
+        return
+    psd_paths = [os.path.abspath(psd) for psd in args.psd]
+    for psd_path in psd_paths:
+        os.makedirs(os.path.join(args.out, Path(psd_path).stem), exist_ok=True)
+
+    manifest_path = os.path.join(args.out, "manifest.json")
+    manifest = load_manifest(manifest_path)
+    todo, fingerprints, skipped = plan(psd_paths, image_paths, args.out, encoding, args.layer, manifest, args.force)
+    total = sum(len(images) for images in todo.values())
+    print(f"{len(image_paths)} images x {len(psd_paths)} templates: {total} to render, {skipped} already done")
+    if not total:
+        return
+
+    started = time.perf_counter()
+    done, failed, item_ms = 0, 0, []
+
+    def record(results):
+        nonlocal done, failed
+        for result in results:
+            key = item_id(result["psd"], result["image"])
+            label = f"{Path(result['psd']).stem} x {Path(result['image']).name}"
+            if "error" in result:
+                failed += 1
+                print(f"[{done + failed}/{total}] {label}: FAILED {result['error']}")
+                continue
+            done += 1
+            item_ms.append(result["render_ms"] + result["encode_ms"])
+            manifest["items"][key] = {
+                "fingerprint": fingerprints[key],
+                "output": os.path.relpath(result["output"], args.out),
+                "render_ms": result["render_ms"],
+                "encode_ms": result["encode_ms"],
+                "bytes": result["bytes"],
+            }
+            print(f"[{done + failed}/{total}] {label}: render {result['render_ms']:.0f} ms, "
+                  f"encode {result['encode_ms']:.0f} ms, {result['bytes'] / 1024:.0f} KB"
+                  + (f", profile {result['profile']}" if result["profile"] else ""))
+        save_manifest(manifest_path, manifest)
+
+    if args.backend == "photoshop":
+        from photoshop_session import ComPhotoshop, SessionManager
+
+        session = SessionManager(ComPhotoshop)
+        try:
+            for psd_path, chunk in chunks(todo, args.chunk):
+                record(render_with_photoshop(psd_path, chunk, args.out, args.layer, encoding, session, args.profile))
+        finally:
+            session.close()
+    else:
+        import template_bundle
+
+        # Compile bundles up front so workers only ever map them
+        for psd_path in todo:
+            template_bundle.compile_template(psd_path, str(BUNDLE_DIR), args.layer)
+        with ProcessPoolExecutor(max_workers=args.workers) as pool:
+            pending = [
+                pool.submit(render_chunk, psd_path, chunk, args.out, args.layer, encoding,
+                            str(LUT_DIR / f"{Path(psd_path).stem}.npz"), args.profile)
+                for psd_path, chunk in chunks(todo, args.chunk)
+            ]
+            for future in as_completed(pending):
+                record(future.result())
+
+    elapsed = time.perf_counter() - started
+    print(f"\nRendered {done} items ({failed} failed, {skipped} skipped) in {elapsed:.1f} s: "
+          f"{done / elapsed:.2f} items/s")
+    if item_ms:
+        print(f"Per item: mean {sum(item_ms) / len(item_ms):.0f} ms, p50 {percentile(item_ms, 0.5):.0f} ms, "
+              f"p95 {percentile(item_ms, 0.95):.0f} ms (render + encode, per worker)")
+    print(f"Manifest: {manifest_path}")
+
+
+if __name__ == "__main__":
+    main()
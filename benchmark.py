@@ -0,0 +1,481 @@
+# benchmark.py
+"""
+Time every render backend on the same templates and images.
+
+    python benchmark.py
+    python benchmark.py --backend psd-tools psd-tools-bundle --repeat 5
+    python benchmark.py --baseline output/benchmarks/<earlier run>.json
+
+Each template in psdFiles/ is rendered with each image in images/ by every
+backend, and each stage is timed on its own:
+
+    parse    open the PSD
+    locate   find the smart object layer
+    decode   decode the upload and fit it to the smart object
+    replace  put the image into the smart object (and warp it)
+    flatten  composite the layers into the final image
+    encode   write the output file
+
+Backends do some stages as one call (Photoshop and Aspose flatten while
+saving, photoshopapi decodes the image inside replace and can't flatten at
+all); those stages are null in the results and the backend's note says where
+the time went. The backends are:
+
+    photoshop         Photoshop over COM, like main.py (Windows, Photoshop running)
+    photoshopapi      PhotoshopAPI, like with_psd_tools.py
+    aspose            Aspose.PSD, like aspose.psd/main.py
+    psd-tools         psd-tools from the PSD, cold (what psd_renderer.load_template does)
+    psd-tools-bundle  psd-tools from a compiled bundle, warm (the server's path)
+
+Backends whose packages aren't installed are skipped. Every backend runs in a
+fresh process, so its peak RSS is its own. The results are written as JSON
+(per item, plus per backend medians) together with the git commit, so runs can
+be compared: --baseline prints each stage's change against an earlier run and
+exits with status 1 if a stage got slower than --threshold.
+"""
+import argparse
+import importlib.util
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+from pathlib import Path
+
+BASE_DIR = Path(__file__).resolve().parent
+sys.path.insert(0, str(BASE_DIR / "server"))
+
+import output_encoder  # noqa: E402
+from metrics import StageTimer  # noqa: E402  the server's own, so stages are timed and named alike
+from batch_render import find_images, percentile  # noqa: E402
+
+LAYER_NAME = "front_surface"
+STAGES = ("parse", "locate", "decode", "replace", "flatten", "encode")
+RESULTS_VERSION = 1
+
+
+class BackendUnavailable(Exception):
+    """The backend can't run here (package not installed, wrong platform, no Photoshop)."""
+
+
+def has_module(name):
+    try:
+        return importlib.util.find_spec(name) is not None
+    except ImportError:  # a missing parent package, e.g. "aspose" for "aspose.psd"
+        return False
+
+
+class Backend:
+    """One way of rendering a mockup, split into the timed stages."""
+
+    name = None
+    note = ""
+
+    def __init__(self, layer_name, encoding, work_dir):
+        self.layer_name = layer_name
+        self.encoding = encoding
+        self.work_dir = work_dir
+
+    def check(self):
+        """Raise BackendUnavailable if the backend can't run here."""
+
+    def render(self, psd_path, image_path, output_path, timer):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class PsdToolsBackend(Backend):
+    name = "psd-tools"
+    note = "flatten includes splitting the PSD around the smart object"
+
+    def check(self):
+        if not has_module("psd_tools"):
+            raise BackendUnavailable("psd-tools is not installed")
+
+    def render(self, psd_path, image_path, output_path, timer):
+        from psd_tools import PSDImage
+
+        import psd_renderer
+        from upload_normalizer import normalize_upload
+
+        with timer.stage("parse"):
+            psd = PSDImage.open(psd_path)
+        with timer.stage("locate"):
+            target = psd_renderer.find_smart_object(psd, self.layer_name)
+            if target is None:
+                raise ValueError(f"Smart object layer '{self.layer_name}' not found")
+        with timer.stage("flatten"):
+            template = psd_renderer.split_template(psd, target)
+        with timer.stage("decode"):
+            image = normalize_upload(image_path, [psd_renderer.artwork_size(template)])
+        with timer.stage("replace"):
+            warp = template.warp or psd_renderer.perspective_grid(template)
+            placed = psd_renderer.place_artwork(image, warp)
+        with timer.stage("flatten"):
+            rendered = psd_renderer.from_premultiplied(psd_renderer.composite(template, placed, warp.box))
+        with timer.stage("encode"):
+            output_encoder.encode(rendered, output_path, self.encoding)
+
+
+class BundleBackend(Backend):
+    name = "psd-tools-bundle"
+    note = "parse maps the compiled bundle (compiled before timing); locate is done at compile time"
+
+    def check(self):
+        if not has_module("psd_tools"):
+            raise BackendUnavailable("psd-tools is not installed")
+        self.bundle_root = os.path.join(self.work_dir, "template_bundles")
+
+    def render(self, psd_path, image_path, output_path, timer):
+        import psd_renderer
+        import template_bundle
+        from upload_normalizer import normalize_upload
+
+        template_bundle.compile_template(psd_path, self.bundle_root, self.layer_name)
+        with timer.stage("parse"):
+            template = template_bundle.get_bundle(psd_path, self.bundle_root, self.layer_name)
+        with timer.stage("decode"):
+            image = normalize_upload(image_path, [psd_renderer.artwork_size(template)])
+        with timer.stage("replace"):
+            warp = template.warp or psd_renderer.perspective_grid(template)
+            placed = psd_renderer.place_artwork(image, warp)
+        with timer.stage("flatten"):
+            rendered = psd_renderer.get_compositor(template, warp.box).render(placed)
+        with timer.stage("encode"):
+            output_encoder.encode(rendered, output_path, self.encoding)
+
+
+class PhotoshopApiBackend(Backend):
+    name = "photoshopapi"
+    note = "decode happens inside replace; no flatten, encode writes a layered PSD"
+
+    def check(self):
+        if not has_module("photoshopapi"):
+            raise BackendUnavailable("photoshopapi is not installed")
+
+    def render(self, psd_path, image_path, output_path, timer):
+        import photoshopapi as psapi
+
+        from with_psd_tools import find_layer_recursive
+
+        with timer.stage("parse"):
+            layered_file = psapi.LayeredFile.read(psd_path)
+        with timer.stage("locate"):
+            target = find_layer_recursive(layered_file.layers, self.layer_name)
+            if target is None or not hasattr(target, "replace"):
+                raise ValueError(f"Smart object layer '{self.layer_name}' not found")
+        with timer.stage("replace"):
+            orig_w, orig_h = target.width, target.height
+            target.replace(image_path)
+            if target.width > 0 and target.height > 0:
+                scale_x, scale_y = orig_w / target.width, orig_h / target.height
+                if abs(scale_x - 1.0) > 0.001 or abs(scale_y - 1.0) > 0.001:
+                    target.scale(scale_x, scale_y, target.center_x, target.center_y)
+        with timer.stage("encode"):
+            layered_file.write(str(Path(output_path).with_suffix(".psd")))
+
+
+class AsposeBackend(Backend):
+    name = "aspose"
+    note = "decode happens inside replace; encode includes flatten"
+
+    def check(self):
+        if not has_module("aspose.psd"):
+            raise BackendUnavailable("aspose-psd is not installed")
+        # aspose.psd/main.py can't be imported by name (its directory has a dot in it)
+        spec = importlib.util.spec_from_file_location("aspose_main", BASE_DIR / "aspose.psd" / "main.py")
+        self.module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(self.module)
+
+    def render(self, psd_path, image_path, output_path, timer):
+        from aspose.psd import Image
+        from aspose.psd.fileformats.psd import PsdImage
+        from aspose.psd.imageloadoptions import PsdLoadOptions
+        from aspose.psd.imageoptions import PngOptions
+        from aspose.pycore import cast
+
+        load_options = PsdLoadOptions()
+        load_options.allow_warp_repaint = True
+        load_options.load_effects_resource = True
+        with timer.stage("parse"):
+            image = Image.load(psd_path, load_options)
+        try:
+            psd_image = cast(PsdImage, image)
+            with timer.stage("locate"):
+                target = self.module.find_smart_object_layer(psd_image.layers, self.layer_name)
+                if not target:
+                    raise ValueError(f"Smart object layer '{self.layer_name}' not found")
+            with timer.stage("replace"):
+                target.replace_contents(image_path)
+            with timer.stage("encode"):
+                psd_image.save(str(Path(output_path).with_suffix(".png")), PngOptions())
+        finally:
+            image.dispose()
+
+
+class PhotoshopBackend(Backend):
+    name = "photoshop"
+    note = "replace includes its own layer lookup; encode includes flatten (Photoshop saves a PNG)"
+
+    def check(self):
+        if sys.platform != "win32" or not has_module("win32com"):
+            raise BackendUnavailable("needs Windows with pywin32")
+        from photoshop_session import ComPhotoshop, SessionLostError
+
+        self.driver = ComPhotoshop()
+        try:
+            self.driver.connect()
+        except SessionLostError as e:
+            raise BackendUnavailable(str(e))
+
+    def render(self, psd_path, image_path, output_path, timer):
+        import psd_renderer
+        from upload_normalizer import normalize_upload
+
+        with timer.stage("parse"):
+            doc = self.driver.open(psd_path)
+        try:
+            with timer.stage("locate"):
+                layer = self.driver.find_layer(doc, self.layer_name)
+            normalized = os.path.join(self.work_dir, f"upload_{Path(image_path).stem}.png")
+            with timer.stage("decode"):
+                target_size = psd_renderer.smart_object_size(psd_path, self.layer_name)
+                normalize_upload(image_path, [target_size]).save(normalized, compress_level=1)
+            with timer.stage("replace"):
+                self.driver.replace_contents(doc, layer, normalized)
+            with timer.stage("encode"):
+                self.driver.save_png(doc, str(Path(output_path).with_suffix(".png")))
+        finally:
+            self.driver.close(doc)
+
+
+BACKENDS = {
+    backend.name: backend
+    for backend in (PhotoshopBackend, PhotoshopApiBackend, AsposeBackend, PsdToolsBackend, BundleBackend)
+}
+
+
+def peak_rss_bytes():
+    """Peak resident set size of this process, or None where it can't be read."""
+    try:
+        import resource
+    except ImportError:  # Windows
+        if not has_module("psutil"):
+            return None
+        import psutil
+
+        return getattr(psutil.Process().memory_info(), "peak_wset", None)
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024  # bytes on macOS, KiB elsewhere
+
+
+def run_backend(name, psd_paths, image_paths, layer_name, encoding, repeat, warmup, work_dir):
+    """
+    Worker body: render every template x image ``repeat`` times with one backend.
+    ``warmup`` untimed renders of the first pair run first (imports, caches).
+    """
+    backend = BACKENDS[name](layer_name, encoding, work_dir)
+    try:
+        backend.check()
+    except BackendUnavailable as e:
+        return {"backend": name, "skipped": str(e)}
+
+    output_path = os.path.join(work_dir, f"out{encoding.extension}")
+    items, errors, rss_before = [], [], None
+    try:
+        for _ in range(warmup):
+            try:
+                backend.render(psd_paths[0], image_paths[0], output_path, StageTimer())
+            except Exception:
+                break  # the timed run reports the error
+        rss_before = peak_rss_bytes()
+        for psd_path in psd_paths:
+            for image_path in image_paths:
+                for run in range(repeat):
+                    timer = StageTimer()
+                    started = time.perf_counter()
+                    try:
+                        backend.render(psd_path, image_path, output_path, timer)
+                    except Exception as e:
+                        errors.append({"psd": Path(psd_path).name, "image": Path(image_path).name, "error": str(e)})
+                        break
+                    stages_ms = {stage: ms for stage, _, ms in timer.entries()}
+                    items.append({
+                        "psd": Path(psd_path).name,
+                        "image": Path(image_path).name,
+                        "run": run,
+                        "total_ms": round((time.perf_counter() - started) * 1000, 2),
+                        "stages_ms": {stage: round(stages_ms[stage], 2) if stage in stages_ms else None for stage in STAGES},
+                    })
+    finally:
+        backend.close()
+    return {
+        "backend": name,
+        "note": backend.note,
+        "peak_rss_bytes": peak_rss_bytes(),
+        "peak_rss_before_bytes": rss_before,
+        "items": items,
+        "errors": errors,
+    }
+
+
+def summarize(result):
+    """Median ms per stage and in total over a backend's items."""
+    items = result.get("items") or []
+    if not items:
+        return None
+    summary = {"items": len(items), "total_ms": round(percentile([item["total_ms"] for item in items], 0.5), 2)}
+    for stage in STAGES:
+        values = [item["stages_ms"][stage] for item in items if item["stages_ms"][stage] is not None]
+        summary[f"{stage}_ms"] = round(percentile(values, 0.5), 2) if values else None
+    return summary
+
+
+def git_commit():
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], cwd=BASE_DIR, capture_output=True, text=True, check=True)
+        dirty = subprocess.run(["git", "status", "--porcelain", "--untracked-files=no"], cwd=BASE_DIR,
+                               capture_output=True, text=True, check=True)
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return commit.stdout.strip() + ("-dirty" if dirty.stdout.strip() else "")
+
+
+def environment():
+    versions = {}
+    for package in ("numpy", "PIL", "psd_tools", "photoshopapi"):
+        if has_module(package):
+            try:
+                versions[package] = getattr(__import__(package), "__version__", None)
+            except Exception:
+                versions[package] = None
+    return {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "packages": versions,
+    }
+
+
+def print_summary(results):
+    header = f"{'backend':<18}{'items':>6}" + "".join(f"{stage:>9}" for stage in STAGES) + f"{'total':>9}{'peak RSS':>10}"
+    print(header)
+    for result in results:
+        if "skipped" in result:
+            print(f"{result['backend']:<18}skipped: {result['skipped']}")
+            continue
+        summary = result["summary"]
+        if summary is None:
+            print(f"{result['backend']:<18}no successful renders")
+        else:
+            cells = "".join(f"{'-' if summary[f'{stage}_ms'] is None else round(summary[f'{stage}_ms']):>9}"
+                            for stage in STAGES)
+            rss = result["peak_rss_bytes"]
+            rss = "-" if rss is None else f"{rss / 2 ** 20:.0f} MB"
+            print(f"{result['backend']:<18}{summary['items']:>6}{cells}{round(summary['total_ms']):>9}{rss:>10}")
+        for error in result["errors"]:
+            print(f"{'':<18}{error['psd']} x {error['image']}: {error['error']}")
+    print("(median ms per item)")
+
+
+def compare(results, baseline, threshold):
+    """Print each stage's change against ``baseline``; return the regressions beyond ``threshold``."""
+    previous = {result["backend"]: result.get("summary") for result in baseline.get("results", [])}
+    regressions = []
+    print(f"\nAgainst {baseline.get('commit') or 'baseline'}:")
+    for result in results:
+        before, after = previous.get(result["backend"]), result.get("summary")
+        if not before or not after:
+            continue
+        changes = []
+        for key in [f"{stage}_ms" for stage in STAGES] + ["total_ms"]:
+            if not before.get(key) or after.get(key) is None:
+                continue
+            change = after[key] / before[key] - 1.0
+            changes.append(f"{key[:-3]} {change:+.0%}")
+            if change > threshold:
+                regressions.append(f"{result['backend']} {key[:-3]}: {before[key]:.1f} -> {after[key]:.1f} ms")
+        print(f"  {result['backend']}: {', '.join(changes)}")
+    for regression in regressions:
+        print(f"  REGRESSION {regression}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Time every render backend, stage by stage.")
+    parser.add_argument("--psd", nargs="+", help="Template PSDs (default: every PSD in psdFiles/)")
+    parser.add_argument("--images", default=str(BASE_DIR / "images"), help="Directory of images")
+    parser.add_argument("--backend", nargs="+", choices=list(BACKENDS), default=list(BACKENDS))
+    parser.add_argument("--layer", default=LAYER_NAME)
+    parser.add_argument("--repeat", type=int, default=3, help="Timed renders per template x image")
+    parser.add_argument("--warmup", type=int, default=1, help="Untimed renders per backend before timing")
+    parser.add_argument("--format", default="png", help="Output format for the psd-tools backends")
+    parser.add_argument("--out", help="Results JSON (default: output/benchmarks/<time>_<commit>.json)")
+    parser.add_argument("--baseline", help="Earlier results JSON to compare against")
+    parser.add_argument("--threshold", type=float, default=0.2, help="Slowdown that counts as a regression")
+    args = parser.parse_args()
+
+    try:
+        encoding = output_encoder.EncodeOptions(args.format)
+    except ValueError as e:
+        parser.error(str(e))
+    psd_paths = [os.path.abspath(psd) for psd in args.psd] if args.psd else sorted(
+        str(path) for path in (BASE_DIR / "psdFiles").glob("*.psd"))
+    image_paths = find_images(args.images)
+    if not psd_paths or not image_paths:
+        print("No templates or no images to benchmark")
+        return
+    print(f"{len(psd_paths)} templates x {len(image_paths)} images x {args.repeat} runs, "
+          f"backends: {', '.join(args.backend)}")
+
+    commit = git_commit()
+    results = []
+    for name in args.backend:
+        work_dir = tempfile.mkdtemp(prefix=f"benchmark_{name}_")
+        try:
+            # A fresh process per backend: its own imports, caches and peak RSS
+            with ProcessPoolExecutor(max_workers=1, mp_context=get_context("spawn")) as pool:
+                result = pool.submit(run_backend, name, psd_paths, image_paths, args.layer, encoding,
+                                     args.repeat, args.warmup, work_dir).result()
+        finally:
+            shutil.rmtree(work_dir, ignore_errors=True)
+        if "skipped" not in result:
+            result["summary"] = summarize(result)
+        print(f"{name}: " + (f"skipped ({result['skipped']})" if "skipped" in result
+                             else f"{len(result['items'])} renders, {len(result['errors'])} errors"))
+        results.append(result)
+
+    print()
+    print_summary(results)
+    report = {
+        "version": RESULTS_VERSION,
+        "commit": commit,
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "environment": environment(),
+        "templates": [Path(psd_path).name for psd_path in psd_paths],
+        "images": [Path(image_path).name for image_path in image_paths],
+        "repeat": args.repeat,
+        "results": results,
+    }
+    out_path = args.out or str(BASE_DIR / "output" / "benchmarks" /
+                               f"{time.strftime('%Y%m%d-%H%M%S')}_{(commit or 'nogit')[:12]}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(out_path)), exist_ok=True)
+    with open(out_path, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"\nResults: {out_path}")
+
+    if args.baseline:
+        with open(args.baseline, "r") as f:
+            if compare(results, json.load(f), args.threshold):
+                sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
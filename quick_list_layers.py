@@ -1,8 +1,14 @@
-from psd_tools import PSDImage
+import sys
+from pathlib import Path
 
-PSD_PATH = r"C:\Users\ROY\Desktop\python-photoshop\psdFiles\mug.psd"
-psd = PSDImage.open(PSD_PATH)
+BASE_DIR = Path(__file__).resolve().parent
+sys.path.insert(0, str(BASE_DIR / "server"))
 
-print("Listing all layers using psd-tools:")
-for layer in psd.descendants():
-    print(f"Name: '{layer.name}' | Kind: {layer.kind}")
+import psd_index  # noqa: E402
+
+PSD_PATH = sys.argv[1] if len(sys.argv) > 1 else str(BASE_DIR / "psdFiles" / "mug.psd")
+index = psd_index.read_index(PSD_PATH)
+
+print("Listing all layers from the layer records:")
+for depth, layer in psd_index.walk(index["layers"]):
+    print(f"{'  ' * depth}Name: '{layer['name']}' | Kind: {layer['kind']}")
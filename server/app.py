@@ -1,13 +1,34 @@
-from fastapi import FastAPI, UploadFile, File, HTTPException, Form, Request
-from fastapi.responses import FileResponse, JSONResponse
+from fastapi import FastAPI, UploadFile, File, HTTPException, Form, Query, Request, WebSocket, WebSocketDisconnect
+from fastapi.responses import FileResponse, JSONResponse, PlainTextResponse, Response, StreamingResponse
 from fastapi.staticfiles import StaticFiles
 from fastapi.middleware.cors import CORSMiddleware
-import win32com.client
+from fastapi.concurrency import run_in_threadpool
+import asyncio
+import hmac
+import io
+import json
 import os
 import uuid
 import shutil
-import json
+import time
+from concurrent import futures
 from pathlib import Path
+from PIL import Image
+
+from catalog import ProductCatalog, CatalogError
+from janitor import InFlight, Janitor, TrackedStaticFiles, sharded_path
+from jobs import EventStream, JobQueue, QueueFullError
+from render_cache import RenderCache, HashingWriter, file_digest, render_key
+from upload_normalizer import normalize_upload
+import color_management
+import metrics
+import output_encoder
+import profiling
+
+try:
+    import win32com.client
+except ImportError:  # Not on Windows: only the psd-tools backend is available
+    win32com = None
 
 app = FastAPI()
 
@@ -24,6 +45,8 @@ CORS_ALLOW_HEADERS = [
     'x-requested-with',
     'x-client-type',
     'ngrok-skip-browser-warning',
+    'x-profile',
+    'x-admin-token',
 ]
 
 app.add_middleware(
@@ -32,153 +55,742 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],  # Allows all methods
     allow_headers=CORS_ALLOW_HEADERS,
+    expose_headers=["Server-Timing"],
 )
 
 # Configuration (Relative to workspace root or absolute)
 BASE_DIR = Path(__file__).resolve().parent.parent
 PSD_DIR = str(BASE_DIR / "psdFiles")
 OUTPUT_DIR = str(BASE_DIR / "server" / "temp_output")
+RENDER_TMP_DIR = os.path.join(OUTPUT_DIR, "tmp")  # renders in progress, moved into the cache when done
 UPLOAD_DIR = str(BASE_DIR / "server" / "uploads")
 PRODUCTS_FILE = str(BASE_DIR / "server" / "products.json")
+BUNDLE_DIR = str(BASE_DIR / "server" / "template_bundles")  # compiled templates (psd-tools backend)
+LUT_DIR = str(BASE_DIR / "server" / "warp_luts")  # calibrated warps from analyze_warp.py
+PSD_INDEX_DIR = str(BASE_DIR / "server" / "psd_index")  # cached layer indexes, see psd_index.py
 LAYER_NAME = "front_surface"
+PREVIEW_LEVELS = ("editor", "half", "quarter")  # mode=preview resolutions, see template_bundle.py
+STREAM_FORMATS = {"ndjson": "application/x-ndjson", "sse": "text/event-stream"}  # /process stream=
+# "photoshop" drives a running Photoshop over COM (Windows only),
+# "psd-tools" renders headlessly with psd-tools + NumPy (see psd_renderer.py)
+RENDER_BACKEND = os.environ.get("RENDER_BACKEND", "photoshop").lower()
+# Render job pool: one Photoshop instance can't render in parallel, the headless backend can
+RENDER_WORKERS = int(os.environ.get("RENDER_WORKERS", "1" if RENDER_BACKEND == "photoshop" else str(os.cpu_count() or 2)))
+JOB_QUEUE_DEPTH = int(os.environ.get("JOB_QUEUE_DEPTH", "100"))
+# Threads compressing finished renders (Pillow's encoders release the GIL)
+ENCODE_WORKERS = int(os.environ.get("ENCODE_WORKERS", "2"))
+# Disk budget for cached renders in temp_output, least recently used are deleted first
+RENDER_CACHE_BYTES = int(os.environ.get("RENDER_CACHE_BYTES", str(2 * 1024 ** 3)))
+# Background cleanup (seconds / bytes): uploads expire after UPLOAD_TTL or oldest-first over
+# UPLOAD_QUOTA_BYTES, cached renders after OUTPUT_TTL without use
+UPLOAD_TTL = int(os.environ.get("UPLOAD_TTL", "3600"))
+UPLOAD_QUOTA_BYTES = int(os.environ.get("UPLOAD_QUOTA_BYTES", str(1024 ** 3)))
+OUTPUT_TTL = int(os.environ.get("OUTPUT_TTL", str(24 * 3600)))
+JANITOR_INTERVAL = int(os.environ.get("JANITOR_INTERVAL", "60"))
+# Template documents the Photoshop session keeps open between jobs
+PHOTOSHOP_MAX_DOCUMENTS = int(os.environ.get("PHOTOSHOP_MAX_DOCUMENTS", "8"))
+# Processes the views of one multi-view product are spread over (psd-tools backend)
+RENDER_PROCESSES = int(os.environ.get("RENDER_PROCESSES", str(os.cpu_count() or 2)))
+# Requests carrying this token in X-Admin-Token may ask for a profile with X-Profile (unset: nobody can)
+ADMIN_TOKEN = os.environ.get("ADMIN_TOKEN")
+PROFILE_DIR = str(BASE_DIR / "server" / "profiles")
+PROFILE_KEEP = int(os.environ.get("PROFILE_KEEP", "50"))  # newest profiles kept in PROFILE_DIR
+# Live preview WebSocket sessions (see preview_session.py) and the largest image one may upload
+PREVIEW_SESSIONS = int(os.environ.get("PREVIEW_SESSIONS", "32"))
+PREVIEW_MAX_UPLOAD_BYTES = int(os.environ.get("PREVIEW_MAX_UPLOAD_BYTES", str(25 * 1024 ** 2)))
+# Seconds a mapped template may go unused before a process unloads it (see template_bundle.TemplateStore)
+TEMPLATE_IDLE_SECONDS = float(os.environ.get("TEMPLATE_IDLE_SECONDS", "600"))
 
 # Ensure directories exist
 THUMBNAILS_DIR = str(BASE_DIR / "server" / "thumbnails")
 os.makedirs(OUTPUT_DIR, exist_ok=True)
+os.makedirs(RENDER_TMP_DIR, exist_ok=True)
 os.makedirs(UPLOAD_DIR, exist_ok=True)
 os.makedirs(THUMBNAILS_DIR, exist_ok=True)
 
+# Files in use (job inputs, renders in progress, outputs being downloaded); the janitor skips them
+in_flight = InFlight()
+
 # Mount static files
-app.mount("/outputs", StaticFiles(directory=OUTPUT_DIR), name="outputs")
+app.mount("/outputs", TrackedStaticFiles(directory=OUTPUT_DIR, in_flight=in_flight), name="outputs")
 app.mount("/thumbnails", StaticFiles(directory=THUMBNAILS_DIR), name="thumbnails")
 
-def find_layer_recursive(layers, layer_name):
-    """Recursively search for a layer by name in groups and sets."""
-    for layer in layers:
-        if layer.Name == layer_name:
-            return layer
-        if layer.Typename == "LayerSet":
-            found = find_layer_recursive(layer.Layers, layer_name)
-            if found:
-                return found
-    return None
-
-def process_photoshop_image(image_path, output_path, psd_filename):
+ps_session = None  # created on the render thread, COM objects are bound to it
+
+def process_photoshop_image(image_path, psd_filename, timer=None, layers=None):
     """
-    Opens a PSD, finds a smart object, replaces content, and scales to original bounds.
+    Replaces the smart object's content in a PSD through Photoshop, scaled to its original bounds.
+    ``image_path`` may be a dict of smart object name -> image path to fill several before the save
+    (``layers`` is unused: the session looks each one up in the open document).
+    Templates stay open between jobs (see photoshop_session.py). Returns the path of the PNG
+    Photoshop saved, for the encoder to convert or keep. ``timer`` gets the session's stages.
     """
+    global ps_session
+    if win32com is None:
+        raise HTTPException(status_code=500, detail="Photoshop backend requires pywin32 on Windows")
+    import photoshop_session as ps
+
+    if ps_session is None:
+        ps_session = ps.SessionManager(ps.ComPhotoshop, max_documents=PHOTOSHOP_MAX_DOCUMENTS)
+
+    psd_path = os.path.join(PSD_DIR, psd_filename)
+    output_path = os.path.join(RENDER_TMP_DIR, f"{uuid.uuid4()}.png")
     try:
-        # We need to dispatch Photoshop inside the request or use a global instance
-        # For simplicity and reliability in a local dev server, we'll dispatch here.
-        ps_app = win32com.client.Dispatch("Photoshop.Application")
-    except Exception as e:
+        ps_session.render(psd_path, image_path, output_path, None if isinstance(image_path, dict) else LAYER_NAME, timer)
+    except ps.LayerNotFoundError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    except ps.SessionLostError as e:
         raise HTTPException(status_code=500, detail=f"Could not connect to Photoshop: {e}")
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Photoshop processing error: {e}")
+    return output_path
 
-    abs_psd_path = os.path.abspath(os.path.join(PSD_DIR, psd_filename))
-    abs_image_path = os.path.abspath(image_path)
-    abs_output_path = os.path.abspath(output_path)
-    
-    js_image_path = abs_image_path.replace('\\', '/')
+def warp_lut_path(psd_filename):
+    """Where analyze_warp.py stores the calibrated LUT for a template."""
+    return os.path.join(LUT_DIR, f"{Path(psd_filename).stem}.npz")
+
+def process_psd_tools_image(image, psd_filename, timer=None, layers=None):
+    """
+    Headless counterpart of process_photoshop_image: composites the image into the
+    PSD's smart object with psd-tools and NumPy, no Photoshop required.
+    Takes the decoded upload (a PIL image, or a dict of them by smart object name,
+    all placed in one pass) and returns the rendered PIL image. ``layers`` are all of
+    the template's smart objects (catalog.layers()), the bundle compiled at startup;
+    those without an upload keep their own content.
+    """
+    import psd_renderer
+    import template_bundle
+
+    psd_path = os.path.join(PSD_DIR, psd_filename)
+    layers = layers or [LAYER_NAME]
+    with metrics.maybe_stage(timer, "template"):
+        # A calibrated LUT overrides the warp mesh read from the PSD (or its plain transform box).
+        warp = psd_renderer.get_warp_lut(warp_lut_path(psd_filename))
+
+        try:
+            template = template_bundle.get_bundle(psd_path, BUNDLE_DIR, layers, hold=True)
+        except ValueError as e:
+            raise HTTPException(status_code=404, detail=str(e))
+        except Exception as e:
+            raise HTTPException(status_code=500, detail=f"Error opening PSD: {e}")
 
     try:
-        doc = ps_app.Open(abs_psd_path)
+        with template_bundle.held(template):
+            return psd_renderer.render_image(template, image, warp, timer=timer)
     except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Error opening PSD: {e}")
+        raise HTTPException(status_code=500, detail=f"Render error: {e}")
 
-    try:
-        target_layer = find_layer_recursive(doc.Layers, LAYER_NAME)
-        
-        if not target_layer:
-            doc.Close(2) # psDoNotSaveChanges
-            raise HTTPException(status_code=404, detail=f"Layer '{LAYER_NAME}' not found in PSD.")
+RENDER_BACKENDS = {
+    "photoshop": process_photoshop_image,
+    "psd-tools": process_psd_tools_image,
+}
 
-        orig_bounds = target_layer.Bounds
-        orig_width = orig_bounds[2] - orig_bounds[0]
-        orig_height = orig_bounds[3] - orig_bounds[1]
-        
-        doc.ActiveLayer = target_layer
-
-        js_code = f"""
-        var idplacedLayerReplaceContents = stringIDToTypeID("placedLayerReplaceContents");
-        var desc = new ActionDescriptor();
-        var idnull = charIDToTypeID("null");
-        desc.putPath(idnull, new File("{js_image_path}"));
-        var idPgNm = charIDToTypeID("PgNm");
-        desc.putInteger(idPgNm, 1);
-        executeAction(idplacedLayerReplaceContents, desc, DialogModes.NO);
-
-        var layer = app.activeDocument.activeLayer;
-        var currentBounds = layer.bounds;
-        var currentWidth = currentBounds[2] - currentBounds[0];
-        var currentHeight = currentBounds[3] - currentBounds[1];
-        
-        var widthPercent = ({orig_width} / currentWidth) * 100;
-        var heightPercent = ({orig_height} / currentHeight) * 100;
-        
-        layer.resize(widthPercent, heightPercent, AnchorPosition.MIDDLECENTER);
-        """
-        
-        ps_app.DoJavaScript(js_code)
+if RENDER_BACKEND not in RENDER_BACKENDS:
+    raise RuntimeError(f"Unknown RENDER_BACKEND '{RENDER_BACKEND}'. Choose one of: {list(RENDER_BACKENDS)}")
 
-        # Save as PNG
-        save_options = win32com.client.Dispatch("Photoshop.PNGSaveOptions")
-        doc.SaveAs(abs_output_path, save_options, True) 
+render_template = RENDER_BACKENDS[RENDER_BACKEND]
 
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Photoshop processing error: {e}")
-    finally:
-        doc.Close(2) # Always close without saving template changes
+def init_render_thread():
+    """COM must be initialised on every thread that talks to Photoshop."""
+    if RENDER_BACKEND == "photoshop" and win32com is not None:
+        import pythoncom
+        pythoncom.CoInitialize()
+
+job_queue = JobQueue(workers=RENDER_WORKERS, max_depth=JOB_QUEUE_DEPTH, thread_initializer=init_render_thread)
+
+@app.on_event("startup")
+async def start_job_queue():
+    await job_queue.start()
+
+@app.on_event("shutdown")
+async def stop_job_queue():
+    await job_queue.stop()
+    if RENDER_BACKEND == "psd-tools":
+        import render_pool
+        render_pool.shutdown_pool()
+
+catalog = ProductCatalog(PRODUCTS_FILE, PSD_DIR, layer_name=LAYER_NAME, index_dir=PSD_INDEX_DIR)
+result_cache = RenderCache(OUTPUT_DIR, RENDER_CACHE_BYTES, is_busy=in_flight.__contains__)
+janitor = Janitor(
+    UPLOAD_DIR, OUTPUT_DIR, result_cache, in_flight,
+    upload_ttl=UPLOAD_TTL, upload_quota=UPLOAD_QUOTA_BYTES, output_ttl=OUTPUT_TTL, interval=JANITOR_INTERVAL,
+)
+
+@app.on_event("startup")
+async def start_janitor():
+    janitor.start()
+
+@app.on_event("shutdown")
+async def stop_janitor():
+    await janitor.stop()
+
+@app.on_event("startup")
+def load_render_cache():
+    """Indexes renders left in temp_output and hashes the templates before the first request."""
+    print(f"Render cache: {result_cache.load()} cached renders")
+    for psd_name in catalog.psd_files():
+        if os.path.exists(os.path.join(PSD_DIR, psd_name)):
+            file_digest(os.path.join(PSD_DIR, psd_name))
+
+@app.on_event("startup")
+def compile_template_bundles():
+    """Pre-compiles every product template so the first render doesn't parse a PSD."""
+    import template_bundle
+
+    template_bundle.store.idle_seconds = TEMPLATE_IDLE_SECONDS  # render_pool's workers take it over
+    template_bundle.store.start_sweeping()  # previews map bundles whatever the backend
+    if RENDER_BACKEND != "psd-tools":
+        return
+
+    for psd_name, status in template_bundle.compile_products(PRODUCTS_FILE, PSD_DIR, BUNDLE_DIR, LAYER_NAME).items():
+        print(f"Template bundle {psd_name}: {status}")
+
+    # The 1/2 and 1/4 preview levels come with the bundles; build the editor-sized ones too
+    for product in catalog.snapshot().products:
+        editor_size = (product.get("editorWidth"), product.get("editorHeight"))
+        if not all(editor_size):
+            continue
+        for psd_name in product.get("psdFiles", []):
+            if psd_name not in catalog.missing_psds(product.get("id")):
+                preview_level_for(psd_name, "editor", editor_size, catalog.layers(product, psd_name)[0])
+
+    if RENDER_PROCESSES > 1:
+        import render_pool
+        render_pool.start_pool(RENDER_PROCESSES)
 
 @app.get("/products")
 async def get_products(request: Request):
     """Returns a list of products from the JSON file with absolute URLs."""
     base_url = str(request.base_url).rstrip("/")
     try:
-        with open(PRODUCTS_FILE, "r") as f:
-            products = json.load(f)
-            # Make thumbnail URLs absolute
-            for product in products:
-                if "thumbnail" in product and product["thumbnail"].startswith("/"):
-                    product["thumbnail"] = f"{base_url}{product['thumbnail']}"
-            return products
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Error loading products: {e}")
+        return Response(content=catalog.products_json(base_url), media_type="application/json")
+    except CatalogError as e:
+        raise HTTPException(status_code=500, detail=str(e))
 
 @app.get("/products/{product_id}")
 async def get_product(product_id: str, request: Request):
     """Returns a single product by ID with absolute URLs."""
     base_url = str(request.base_url).rstrip("/")
     try:
-        if not os.path.exists(PRODUCTS_FILE):
-             raise HTTPException(status_code=500, detail="Products database not found")
-             
-        with open(PRODUCTS_FILE, "r") as f:
-            products = json.load(f)
-        
-        product = next((p for p in products if p["id"] == product_id), None)
-        
-        if not product:
-            raise HTTPException(status_code=404, detail=f"Product with ID '{product_id}' not found")
+        body = catalog.product_json(base_url, product_id)
+    except CatalogError as e:
+        raise HTTPException(status_code=500, detail=str(e))
+    if body is None:
+        raise HTTPException(status_code=404, detail=f"Product with ID '{product_id}' not found")
+    return Response(content=body, media_type="application/json")
+
+def render_options(psd_name, encoding, preview_size=None):
+    """Everything other than the upload, the PSD and the layer that changes a render's output."""
+    backend = "psd-tools" if preview_size else RENDER_BACKEND
+    lut_path = warp_lut_path(psd_name)
+    use_lut = backend == "psd-tools" and os.path.exists(lut_path)
+    options = {
+        "backend": backend,
+        "encoding": encoding.to_dict(),
+        "warp_lut": file_digest(lut_path) if use_lut else None,
+        "color": ["srgb", int(color_management.INTENT)],  # uploads and outputs converted, see color_management.py
+    }
+    if preview_size:
+        options["preview_size"] = list(preview_size)
+    return options
+
+def view_inputs(layers, extra_inputs):
+    """
+    Which upload fills each of a template's smart objects ``layers``: its own file[<layer>]
+    (a key of ``extra_inputs``), else None for the main upload in the first one. Smart
+    objects without an input keep the template's content.
+    """
+    filled = {layer: layer for layer in layers if layer in extra_inputs}
+    filled.setdefault(layers[0], None)
+    return {layer: filled[layer] for layer in layers if layer in filled}
+
+def cache_key_for(upload_sha256, psd_name, encoding, preview_size=None, layers=None, extra_inputs=None):
+    """
+    The render cache key of ``psd_name``: its smart objects ``layers`` (default LAYER_NAME) filled
+    from the upload and ``extra_inputs`` ({layer: (path, SHA-256)}, see view_inputs()).
+    """
+    psd_sha256 = file_digest(os.path.join(PSD_DIR, psd_name))
+    options = render_options(psd_name, encoding, preview_size)
+    extra_inputs = extra_inputs or {}
+    digests = {
+        layer: upload_sha256 if key is None else extra_inputs[key][1]
+        for layer, key in view_inputs(layers or [LAYER_NAME], extra_inputs).items()
+    }
+    if len(digests) == 1:
+        (layer, digest), = digests.items()
+        return render_key(digest, psd_sha256, layer, options)
+    return render_key(digests, psd_sha256, list(digests), options)
+
+def input_size_for(psd_name, layers=None, layer_name=None):
+    """The largest artwork size a template's render can make use of, in ``layer_name`` (default its first)."""
+    import psd_renderer
+
+    layers = layers or [LAYER_NAME]
+    layer_name = layer_name or layers[0]
+    psd_path = os.path.join(PSD_DIR, psd_name)
+    if RENDER_BACKEND == "psd-tools":
+        import template_bundle
+
+        template = template_bundle.get_bundle(psd_path, BUNDLE_DIR, layers)
+        return psd_renderer.artwork_size(template, psd_renderer.get_warp_lut(warp_lut_path(psd_name)), layer_name)
+    return psd_renderer.smart_object_size(psd_path, layer_name, PSD_INDEX_DIR)
+
+def prepare_upload(input_path, psd_files, layers=None, extra_inputs=None):
+    """
+    Decodes, orients and downscales each upload once for all of a job's templates. Returns what
+    render_template takes, by view_inputs() key (None for the main upload): the image itself for
+    psd-tools, a normalised file for Photoshop to place.
+    """
+    layers = layers or {}
+    extra_inputs = extra_inputs or {}
+    paths = {None: input_path, **{key: path for key, (path, _) in extra_inputs.items()}}
+    try:
+        target_sizes = {}
+        for psd_name in psd_files:
+            psd_layers = layers.get(psd_name) or [LAYER_NAME]
+            for layer, key in view_inputs(psd_layers, extra_inputs).items():
+                target_sizes.setdefault(key, []).append(input_size_for(psd_name, psd_layers, layer))
+    except ValueError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error opening PSD: {e}")
+
+    uploads = {}
+    try:
+        for key, sizes in target_sizes.items():
+            try:
+                image = normalize_upload(paths[key], sizes)
+            except (OSError, Image.DecompressionBombError) as e:
+                raise HTTPException(status_code=400, detail=f"Could not decode image{f' for {key}' if key else ''}: {e}")
+            if RENDER_BACKEND == "psd-tools":
+                uploads[key] = image
+                continue
+            normalized_path = os.path.join(os.path.dirname(paths[key]), f"{Path(paths[key]).stem}_normalized.png")
+            image.save(normalized_path, compress_level=1)
+            uploads[key] = normalized_path
+    except Exception:
+        release_uploads(uploads)
+        raise
+    return uploads
+
+def release_uploads(uploads):
+    """Deletes the Photoshop backend's normalised copies made by prepare_upload()."""
+    for upload in (uploads or {}).values():
+        if isinstance(upload, str) and os.path.exists(upload):
+            os.unlink(upload)
+
+def view_upload(uploads, filled):
+    """What render_template takes for a view filled as ``filled`` (see view_inputs()): an upload, or a dict of them."""
+    if list(filled) == [LAYER_NAME]:
+        return uploads[filled[LAYER_NAME]]
+    return {layer: uploads[key] for layer, key in filled.items()}
+
+def render_views_in_parallel(job, uploads, views, inputs, layers, encoding, on_view=None):
+    """
+    Renders and encodes a multi-view product's templates concurrently on the process pool, from
+    prepare_upload()'s ``uploads`` filled as ``inputs`` per PSD (see view_inputs()) into the
+    bundle of each PSD's smart objects ``layers``.
+    Returns the encode stats per PSD; ``on_view(psd_name, output_path, stats)`` is called
+    as each view finishes.
+    """
+    import render_pool
+
+    pool_views = [
+        (os.path.join(PSD_DIR, psd_name), warp_lut_path(psd_name), output_path, inputs[psd_name],
+         layers.get(psd_name) or [LAYER_NAME])
+        for psd_name, output_path in views
+    ]
+
+    def finished(index, stats, error):
+        if error is None:
+            psd_name, output_path = views[index]
+            job.timings[psd_name] = stats.pop("render_ms")
+            job.stages.merge(stats.pop("stages"))
+            if on_view is not None:
+                on_view(psd_name, output_path, stats)
+
+    try:
+        outcomes = render_pool.render_views(
+            uploads, pool_views, encoding, RENDER_PROCESSES, BUNDLE_DIR, LAYER_NAME, on_view=finished
+        )
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Render error: {e}")
+
+    encoded = {}
+    for (psd_name, _), (stats, error) in zip(views, outcomes):
+        if isinstance(error, ValueError):
+            raise HTTPException(status_code=404, detail=str(error))
+        if error is not None:
+            raise HTTPException(status_code=500, detail=f"Render error ({psd_name}): {error}")
+        encoded[psd_name] = stats
+    return encoded
+
+def render_views_in_turn(job, uploads, views, inputs, layers, encoding, encode_inline=False, on_view=None):
+    """
+    Renders one template after another, handing each result to the encoder threads so the
+    next render overlaps the previous encode. ``uploads``, ``inputs`` and ``layers`` are as for
+    render_views_in_parallel(). Returns the encode stats per PSD.
+    ``encode_inline`` encodes on this thread instead, for a profiler to see.
+    ``on_view(psd_name, output_path, stats)`` is called as each view's encode finishes.
+    """
+    encodes = []
+    try:
+        for psd_name, output_path in views:
+            started = time.perf_counter()
+            upload = view_upload(uploads, inputs[psd_name])
+            rendered = render_template(
+                upload, psd_name, job.stages.for_template(psd_name), layers.get(psd_name) or [LAYER_NAME]
+            )
+            render_ms = (time.perf_counter() - started) * 1000
+            job.timings[psd_name] = round(render_ms, 1)
+            job.stages.add("render", render_ms, psd_name)
+            then = None
+            if on_view is not None:
+                then = lambda stats, psd_name=psd_name, output_path=output_path: on_view(psd_name, output_path, stats)
+            if encode_inline:
+                future = futures.Future()
+                try:
+                    future.set_result(output_encoder._encode_then(rendered, output_path, encoding, then))
+                except Exception as e:
+                    future.set_exception(e)
+            else:
+                future = output_encoder.submit(rendered, output_path, encoding, ENCODE_WORKERS, then)
+            encodes.append((psd_name, future))
+    finally:
+        futures.wait([future for _, future in encodes])
 
-        # Make thumbnail URL absolute
-        if "thumbnail" in product and product["thumbnail"].startswith("/"):
-            product["thumbnail"] = f"{base_url}{product['thumbnail']}"
-            
-        return product
+    encoded = {}
+    for psd_name, future in encodes:
+        try:
+            encoded[psd_name] = future.result()
+        except Exception as e:
+            raise HTTPException(status_code=500, detail=f"Encode error ({psd_name}): {e}")
+        job.stages.add("encode", encoded[psd_name]["encode_ms"], psd_name)
+    return encoded
+
+def run_process_job(job, input_path, upload_sha256, psd_files, encoding, base_url, profile=None, layers=None,
+                    extra_inputs=None):
+    """
+    Job body for /process: renders every requested template that isn't cached yet, on a worker thread.
+    ``profile`` ("prof" or "collapsed") renders every view, on this thread, under the profiler.
+    ``layers`` lists each PSD's smart objects and ``extra_inputs`` ({layer: (path, SHA-256)})
+    has the uploads for all but the first one (see view_inputs()).
+    """
+    layers = layers or {}
+    extra_inputs = extra_inputs or {}
+    views = []
+    uploads = None
+    metrics.queue_wait_seconds.observe(job.started_at - job.created_at, backend=RENDER_BACKEND)
+    try:
+        keys = {
+            psd_name: cache_key_for(upload_sha256, psd_name, encoding, None, layers.get(psd_name), extra_inputs)
+            for psd_name in psd_files
+        }
+        inputs = {
+            psd_name: view_inputs(layers.get(psd_name) or [LAYER_NAME], extra_inputs) for psd_name in psd_files
+        }
+        # An identical request may have rendered some of them meanwhile
+        filenames = {psd_name: None if profile else result_cache.peek(keys[psd_name]) for psd_name in psd_files}
+        # Renders land under a temporary name and are moved into the cache once complete
+        views = [
+            (psd_name, os.path.join(RENDER_TMP_DIR, f"{job.id}_{Path(psd_name).stem}{encoding.extension}"))
+            for psd_name in psd_files
+            if filenames[psd_name] is None
+        ]
+        in_flight.hold(*[output_path for _, output_path in views])
+
+        for psd_name in psd_files:
+            if filenames[psd_name] is not None:
+                job.events.publish({"event": "view", **describe_output(psd_name, filenames[psd_name], encoding, base_url)})
+
+        def finish_view(psd_name, output_path, stats):
+            """Moves a finished view into the cache straight away and tells streaming clients about it."""
+            filenames[psd_name] = result_cache.put(keys[psd_name], output_path)
+            output = describe_output(psd_name, filenames[psd_name], encoding, base_url, stats)
+            job.events.publish({"event": "view", **output, "render_ms": job.timings.get(psd_name)})
+
+        encoded = {}
+        profile_path = profiling.profile_path(PROFILE_DIR, profiling.profile_name(job.id), profile) if profile else None
+        with profiling.profile(profile, profile_path):
+            if views:
+                started = time.perf_counter()
+                with job.stages.stage("decode"):
+                    uploads = prepare_upload(input_path, [psd_name for psd_name, _ in views], layers, extra_inputs)
+                job.timings["normalize_ms"] = round((time.perf_counter() - started) * 1000, 1)
+
+                if RENDER_BACKEND == "psd-tools" and len(views) > 1 and RENDER_PROCESSES > 1 and not profile:
+                    encoded = render_views_in_parallel(job, uploads, views, inputs, layers, encoding, on_view=finish_view)
+                else:
+                    # One Photoshop instance renders one document at a time
+                    encoded = render_views_in_turn(
+                        job, uploads, views, inputs, layers, encoding, encode_inline=bool(profile), on_view=finish_view
+                    )
+        if profile:
+            job.details["profile"] = describe_profile(profile_path, profile, base_url)
+
+        unfinished = [psd_name for psd_name, _ in views if filenames[psd_name] is None]
+        if unfinished:
+            raise HTTPException(status_code=500, detail=f"Render did not complete: {unfinished}")
+    finally:
+        for _, output_path in views:
+            if os.path.exists(output_path):
+                os.unlink(output_path)
+        release_uploads(uploads)
+        upload_paths = [input_path, *[path for path, _ in extra_inputs.values()]]
+        in_flight.release(*upload_paths, *[output_path for _, output_path in views])
+        # The uploads are the job's own; the janitor's UPLOAD_TTL is only for ones left behind
+        for path in upload_paths:
+            if path not in in_flight and os.path.exists(path):
+                os.unlink(path)
+        job.stages.observe(RENDER_BACKEND)
+
+    outputs = describe_outputs(psd_files, filenames, encoding, base_url, encoded)
+    job.details["outputs"] = outputs
+    return [output["url"] for output in outputs]
+
+def describe_profile(path, kind, base_url):
+    """Download link of a profile written by profiling.profile(); prunes old profiles."""
+    profiling.prune(PROFILE_DIR, PROFILE_KEEP)
+    return {"format": kind, "url": f"{base_url}/profiles/{os.path.basename(path)}"}
+
+def preview_level_for(psd_name, level, editor_size, layer_name=LAYER_NAME, hold=False):
+    """
+    The mapped preview level of a template and the warp to render it with: 1/2 or 1/4 of
+    the canvas, or the canvas fitted into the product's editor area. Previews fill the
+    smart object ``layer_name`` only. ``hold`` keeps the level loaded until released.
+    """
+    import psd_renderer
+    import template_bundle
+
+    psd_path = os.path.join(PSD_DIR, psd_name)
+    template = template_bundle.get_bundle(psd_path, BUNDLE_DIR, layer_name)
+    if level == "editor":
+        scale = template_bundle.editor_scale(template.canvas_size, editor_size)
+    else:
+        scale = template_bundle.PREVIEW_SCALES[level]
+    size = template_bundle.preview_size(template.canvas_size, scale)
+    width, height = template.canvas_size
+    warp = psd_renderer.get_warp_lut(warp_lut_path(psd_name), (size[0] / width, size[1] / height))
+
+    level_template = template_bundle.get_level(psd_path, BUNDLE_DIR, layer_name, size, hold)
+    return size, level_template, warp
+
+def run_preview(input_path, upload_sha256, psd_files, encoding, level, editor_size, base_url, stages, profile=None,
+                on_output=None, layers=None):
+    """
+    /process with mode=preview: renders against pre-built low-resolution levels of the
+    templates, on the calling thread instead of the job queue. Always the psd-tools renderer.
+    Returns the outputs, timings and profile link; ``stages`` (a metrics.StageTimer) gets the stages,
+    ``on_output`` each view's output as soon as it is ready. The upload fills the first of
+    each template's smart objects ``layers``.
+    """
+    profile_path = None
+    if profile:
+        profile_path = profiling.profile_path(PROFILE_DIR, profiling.profile_name(f"preview_{uuid.uuid4()}"), profile)
+    with profiling.profile(profile, profile_path):
+        outputs, timings = _run_preview(
+            input_path, upload_sha256, psd_files, encoding, level, editor_size, base_url, stages, bool(profile),
+            on_output, layers or {}
+        )
+    return outputs, timings, describe_profile(profile_path, profile, base_url) if profile else None
+
+def _run_preview(input_path, upload_sha256, psd_files, encoding, level, editor_size, base_url, stages, uncached,
+                 on_output, layers):
+    import psd_renderer
+
+    first_layers = {psd_name: (layers.get(psd_name) or [LAYER_NAME])[0] for psd_name in psd_files}
+    timings = {}
+    views = []
+    try:
+        try:
+            levels = {}
+            for psd_name in psd_files:
+                with stages.for_template(psd_name).stage("template"):
+                    levels[psd_name] = preview_level_for(psd_name, level, editor_size, first_layers[psd_name])
+        except ValueError as e:
+            raise HTTPException(status_code=404, detail=str(e))
+        except Exception as e:
+            raise HTTPException(status_code=500, detail=f"Error opening PSD: {e}")
+
+        keys = {
+            psd_name: cache_key_for(upload_sha256, psd_name, encoding, levels[psd_name][0], [first_layers[psd_name]])
+            for psd_name in psd_files
+        }
+        filenames = {psd_name: None if uncached else result_cache.get(keys[psd_name]) for psd_name in psd_files}
+        views = [
+            (psd_name, os.path.join(RENDER_TMP_DIR, f"preview_{uuid.uuid4()}{encoding.extension}"))
+            for psd_name in psd_files
+            if filenames[psd_name] is None
+        ]
+        in_flight.hold(*[output_path for _, output_path in views])
+        if on_output is not None:
+            for psd_name in psd_files:
+                if filenames[psd_name] is not None:
+                    on_output(describe_output(psd_name, filenames[psd_name], encoding, base_url))
+
+        encoded = {}
+        if views:
+            started = time.perf_counter()
+            target_sizes = [
+                psd_renderer.artwork_size(levels[psd_name][1], levels[psd_name][2]) for psd_name, _ in views
+            ]
+            try:
+                with stages.stage("decode"):
+                    image = normalize_upload(input_path, target_sizes)
+            except (OSError, Image.DecompressionBombError) as e:
+                raise HTTPException(status_code=400, detail=f"Could not decode image: {e}")
+            timings["normalize_ms"] = round((time.perf_counter() - started) * 1000, 1)
+
+            for psd_name, output_path in views:
+                _, template, warp = levels[psd_name]
+                started = time.perf_counter()
+                try:
+                    rendered = psd_renderer.render_image(template, image, warp, timer=stages.for_template(psd_name))
+                except Exception as e:
+                    raise HTTPException(status_code=500, detail=f"Render error: {e}")
+                render_ms = (time.perf_counter() - started) * 1000
+                timings[psd_name] = round(render_ms, 1)
+                stages.add("render", render_ms, psd_name)
+                encoded[psd_name] = output_encoder.encode(rendered, output_path, encoding)
+                stages.add("encode", encoded[psd_name]["encode_ms"], psd_name)
+                filenames[psd_name] = result_cache.put(keys[psd_name], output_path)
+                if on_output is not None:
+                    output = describe_output(psd_name, filenames[psd_name], encoding, base_url, encoded[psd_name])
+                    on_output({**output, "render_ms": timings[psd_name]})
+    finally:
+        for _, output_path in views:
+            if os.path.exists(output_path):
+                os.unlink(output_path)
+        in_flight.release(input_path, *[output_path for _, output_path in views])
+        stages.observe("psd-tools", mode="preview")
+
+    return describe_outputs(psd_files, filenames, encoding, base_url, encoded), timings
+
+def describe_output(psd_name, filename, encoding, base_url, stats=None):
+    """A view's result URL, format, pixel size, encoded size and encode time (None when served from the cache)."""
+    path = result_cache.path(filename)
+    size = stats.get("size") if stats else None
+    if size is None:
+        try:
+            with Image.open(path) as image:  # reads the header only
+                size = list(image.size)
+        except OSError:
+            size = None
+    return {
+        "psd": psd_name,
+        "url": f"{base_url}/outputs/{filename}",
+        "format": encoding.format,
+        "size": size,
+        "bytes": stats["bytes"] if stats else os.path.getsize(path),
+        "encode_ms": stats["encode_ms"] if stats else None,
+        "cached": stats is None,
+    }
+
+def describe_outputs(psd_files, filenames, encoding, base_url, encoded=None):
+    """describe_output() of every view."""
+    return [
+        describe_output(psd_name, filenames[psd_name], encoding, base_url, (encoded or {}).get(psd_name))
+        for psd_name in psd_files
+    ]
+
+def format_event(event, stream):
+    """One /process stream event as an NDJSON line or a Server-Sent Event."""
+    data = json.dumps(event)
+    if stream == "sse":
+        return f"event: {event['event']}\ndata: {data}\n\n"
+    return data + "\n"
+
+def streaming_response(events, stream):
+    headers = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}  # don't let proxies hold events back
+    return StreamingResponse(
+        (format_event(event, stream) async for event in events), media_type=STREAM_FORMATS[stream], headers=headers
+    )
+
+async def job_events(job, base_url):
+    """/process stream of a queued job: queued, a view event per finished view, then done or error."""
+    yield {"event": "queued", "job_id": job.id, "status_url": f"{base_url}/jobs/{job.id}"}
+    async for event in job.events.follow():
+        yield event
+    details = job.to_dict()
+    if job.status == "failed":
+        yield {"event": "error", "job_id": job.id, "status": 500, "detail": job.error}
+        return
+    yield {
+        "event": "done",
+        "job_id": job.id,
+        "results": job.result,
+        "outputs": details["outputs"],
+        "timings": details["timings"],
+        **({"profile": details["profile"]} if "profile" in details else {}),
+    }
+
+async def async_iter(items):
+    for item in items:
+        yield item
+
+async def preview_events(task, views, level):
+    """/process stream of a preview: a view event per rendered view, then done (or error)."""
+    async for event in views.follow():
+        yield {"event": "view", **event}
+    try:
+        outputs, timings, profile_link = await task
     except HTTPException as e:
-        raise e
+        yield {"event": "error", "status": e.status_code, "detail": e.detail}
+        return
     except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
+        yield {"event": "error", "status": 500, "detail": str(e)}
+        return
+    yield {
+        "event": "done",
+        "job_id": None,
+        "mode": "preview",
+        "level": level,
+        "results": [output["url"] for output in outputs],
+        "timings": timings,
+        **({"profile": profile_link} if profile_link else {}),
+    }
 
 @app.post("/process")
 async def process_image(
     request: Request, 
     product_id: str = Form(None), 
     file: UploadFile = File(None),
-    singleView: bool = Form(False)
+    singleView: bool = Form(False),
+    wait: bool = Form(False),
+    output_format: str = Form("png", alias="format"),
+    quality: int = Form(None),
+    compression: int = Form(None),
+    colors: int = Form(None),
+    mode: str = Form("final"),
+    previewLevel: str = Form("editor"),
+    stream: str = Form(None)
 ):
-    """Upload an image, process it for PSDs, and return result URLs. If singleView is true, only processes the first PSD."""
+    """
+    Upload an image and queue it for rendering into the product's PSDs. Returns a job id
+    to poll at /jobs/{job_id}; with wait=true, responds with the result URLs once done.
+    If singleView is true, only processes the first PSD.
+    format is png (compression 0-9, colors to quantize), jpeg or webp (quality).
+    mode=preview renders right away at low resolution (previewLevel editor, half or quarter)
+    while the artwork is being positioned; mode=final is the full-resolution render for the order.
+    Admins can send X-Profile: prof or collapsed (with X-Admin-Token) to profile the render.
+    stream=ndjson or sse streams an event per view as soon as it is rendered, then a done event.
+    Templates with several smart objects (smartObjects in products.json) take the image for
+    each one after the first as a file[<layer name>] field, rendered together in one pass.
+    """
     base_url = str(request.base_url).rstrip("/")
+    stages = request.state.stages = metrics.StageTimer()  # reported in the Server-Timing header
+    profile = requested_profile(request)
+
+    try:
+        encoding = output_encoder.EncodeOptions(output_format, quality, compression, colors)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    if mode not in ("final", "preview"):
+        raise HTTPException(status_code=400, detail="mode must be 'final' or 'preview'")
+    if previewLevel not in PREVIEW_LEVELS:
+        raise HTTPException(status_code=400, detail=f"previewLevel must be one of: {list(PREVIEW_LEVELS)}")
+    if stream is not None and stream not in STREAM_FORMATS:
+        raise HTTPException(status_code=400, detail=f"stream must be one of: {list(STREAM_FORMATS)}")
     
     # 1. Basic presence validation
     if not product_id:
@@ -193,19 +805,27 @@ async def process_image(
     if file_ext not in allowed_extensions:
         raise HTTPException(status_code=400, detail=f"File type not supported. Allowed: {list(allowed_extensions)}")
 
+    # More smart objects of the templates, as file[<layer name>]
+    extra_files = {
+        name[len("file["):-1]: value
+        for name, value in (await request.form()).multi_items()
+        if name.startswith("file[") and name.endswith("]") and getattr(value, "filename", None)
+    }
+    for layer, extra_file in extra_files.items():
+        if os.path.splitext(extra_file.filename)[1].lower() not in allowed_extensions:
+            raise HTTPException(status_code=400, detail=f"File type of file[{layer}] not supported. Allowed: {list(allowed_extensions)}")
+
     # Generate unique base ID for this request
     file_id = str(uuid.uuid4())
-    input_path = os.path.join(UPLOAD_DIR, f"{file_id}{file_ext}")
+    input_path = sharded_path(UPLOAD_DIR, f"{file_id}{file_ext}")
+    extra_inputs = {}  # layer -> (path, SHA-256)
 
     try:
         # 3. Product existence validation
-        if not os.path.exists(PRODUCTS_FILE):
-             raise HTTPException(status_code=500, detail="Products database not found")
-
-        with open(PRODUCTS_FILE, "r") as f:
-            products = json.load(f)
-        
-        product = next((p for p in products if p["id"] == product_id), None)
+        try:
+            product = catalog.get(product_id)
+        except CatalogError as e:
+            raise HTTPException(status_code=500, detail=str(e))
         if not product:
             raise HTTPException(status_code=404, detail=f"Product with ID '{product_id}' not found")
 
@@ -217,36 +837,332 @@ async def process_image(
         # If singleView is true, only deal with the first PSD
         files_to_process = [psd_files[0]] if singleView else psd_files
 
+        # Checked when the catalog was loaded, not on every request
+        missing_psds = catalog.missing_psds(product_id)
+        layers = {psd_name: catalog.layers(product, psd_name) for psd_name in files_to_process}
         for psd_name in files_to_process:
-            if not os.path.exists(os.path.join(PSD_DIR, psd_name)):
-                raise HTTPException(status_code=500, detail=f"PSD template '{psd_name}' missing on server")
+            if psd_name in missing_psds:
+                raise HTTPException(status_code=500, detail=f"PSD template '{psd_name}' missing on server or lacks one of its smart objects {layers[psd_name]}")
+        unknown = set(extra_files) - {layer for psd_layers in layers.values() for layer in psd_layers}
+        if unknown:
+            raise HTTPException(status_code=400, detail=f"No smart object {sorted(unknown)} in this product's templates")
 
-        # Save the uploaded file
-        with open(input_path, "wb") as buffer:
-            shutil.copyfileobj(file.file, buffer)
+        # Save the uploaded files, hashing them on the way to disk
+        with stages.stage("upload"):
+            with open(input_path, "wb") as buffer:
+                upload = HashingWriter(buffer)
+                shutil.copyfileobj(file.file, upload)
+            upload_sha256 = upload.hexdigest()
+            for number, (layer, extra_file) in enumerate(extra_files.items(), 1):
+                extra_path = sharded_path(UPLOAD_DIR, f"{file_id}_{number}{os.path.splitext(extra_file.filename)[1].lower()}")
+                with open(extra_path, "wb") as buffer:
+                    upload = HashingWriter(buffer)
+                    shutil.copyfileobj(extra_file.file, upload)
+                extra_inputs[layer] = (extra_path, upload.hexdigest())
+        upload_paths = [input_path, *[path for path, _ in extra_inputs.values()]]
 
-        result_urls = []
-        # Process each PSD file associated with the product (or just one if singleView is true)
-        for psd_name in files_to_process:
-            output_filename = f"result_{file_id}_{psd_name.replace('.psd', '')}.png"
-            output_path = os.path.join(OUTPUT_DIR, output_filename)
-            
-            process_photoshop_image(input_path, output_path, psd_name)
-            result_urls.append(f"{base_url}/outputs/{output_filename}")
+        if mode == "preview":
+            editor_size = (product.get("editorWidth"), product.get("editorHeight"))
+            level = previewLevel if all(editor_size) or previewLevel != "editor" else "half"
+            views = EventStream() if stream else None
+            in_flight.hold(input_path)
+
+            async def render_preview():
+                try:
+                    return await run_in_threadpool(
+                        run_preview, input_path, upload_sha256, files_to_process, encoding, level, editor_size,
+                        base_url, stages, profile, views.publish if views else None, layers
+                    )
+                finally:
+                    for path in upload_paths:  # previews only fill the first smart object
+                        os.unlink(path)
+                    if views:
+                        views.close()
+
+            if stream:
+                return streaming_response(preview_events(asyncio.ensure_future(render_preview()), views, level), stream)
+            outputs, timings, profile_link = await render_preview()
+            return JSONResponse(content={
+                "job_id": None,
+                "status": "done",
+                "mode": "preview",
+                "level": level,
+                "results": [output["url"] for output in outputs],
+                "outputs": outputs,
+                "timings": timings,
+                **({"profile": profile_link} if profile_link else {}),
+            })
+
+        # The same artwork on the same templates was rendered before: hand back those files
+        with stages.stage("cache"):
+            cached = {
+                psd_name: result_cache.get(
+                    cache_key_for(upload_sha256, psd_name, encoding, None, layers[psd_name], extra_inputs)
+                )
+                for psd_name in files_to_process
+            }
+        stages.observe(RENDER_BACKEND)  # the job records its own stages
+        if all(cached.values()) and not profile:
+            for path in upload_paths:
+                os.unlink(path)
+            outputs = describe_outputs(files_to_process, cached, encoding, base_url)
+            if stream:
+                done = {"event": "done", "job_id": None, "cached": True, "results": [output["url"] for output in outputs]}
+                return streaming_response(
+                    async_iter([{"event": "view", **output} for output in outputs] + [done]), stream
+                )
+            return JSONResponse(content={
+                "job_id": None,
+                "status": "done",
+                "cached": True,
+                "results": [output["url"] for output in outputs],
+                "outputs": outputs,
+            })
+
+        # Rendering happens on the job queue's workers, never on the event loop.
+        # The job deletes the uploads when it finishes; until then the janitor leaves them alone.
+        in_flight.hold(*upload_paths)
+        try:
+            job = job_queue.submit(
+                run_process_job, input_path, upload_sha256, files_to_process, encoding, base_url, profile, layers,
+                extra_inputs
+            )
+        except QueueFullError as e:
+            in_flight.release(*upload_paths)
+            for path in upload_paths:
+                os.unlink(path)
+            raise HTTPException(status_code=503, detail=str(e), headers={"Retry-After": "5"})
+
+        if stream:
+            return streaming_response(job_events(job, base_url), stream)
 
-        # Return the list of result images for this specific request
-        return JSONResponse(content={"results": result_urls})
+        if wait:
+            await job_queue.wait(job)
+            stages.merge(job.stages)
+            if job.status == "failed":
+                raise HTTPException(status_code=500, detail=job.error)
+            details = job.to_dict()
+            return JSONResponse(content={
+                "job_id": job.id,
+                "results": job.result,
+                "outputs": details["outputs"],
+                "timings": details["timings"],
+                **({"profile": details["profile"]} if "profile" in details else {}),
+            })
+
+        return JSONResponse(
+            status_code=202,
+            content={"job_id": job.id, "status": job.status, "status_url": f"{base_url}/jobs/{job.id}"},
+        )
 
     except Exception as e:
         if isinstance(e, HTTPException):
             raise e
         raise HTTPException(status_code=500, detail=str(e))
-    # Note: In a production environment, you should clean up temp files later.
+
+preview_sessions = set()
+
+def render_preview_frame(view, artwork, placement, encoding):
+    """One live preview frame of a view: render at its preview level and encode in memory."""
+    import psd_renderer
+
+    psd_name, _, template, warp = view
+    stages = metrics.StageTimer(psd_name)
+    started = time.perf_counter()
+    rendered = psd_renderer.render_image(template, artwork, warp, timer=stages, placement=placement)
+    render_ms = (time.perf_counter() - started) * 1000
+    stages.add("render", render_ms)
+    data, stats = output_encoder.encode_bytes(rendered, encoding)
+    stages.add("encode", stats["encode_ms"])
+    stages.observe("psd-tools", mode="live")
+    return data, {"psd": psd_name, "format": encoding.format, "render_ms": round(render_ms, 1), **stats}
+
+def prepare_artwork(data, views):
+    """Decodes an uploaded image once and resizes it to each view's artwork size."""
+    import psd_renderer
+
+    sizes = {view: psd_renderer.artwork_size(view[2], view[3]) for view in views}
+    image = normalize_upload(io.BytesIO(data), list(sizes.values()))
+    return {view: image.resize(size, Image.LANCZOS) for view, size in sizes.items()}
+
+@app.websocket("/preview")
+async def live_preview(websocket: WebSocket, product_id: str = None, singleView: bool = False,
+                       level: str = "editor", output_format: str = Query("webp", alias="format"), quality: int = None):
+    """
+    Live preview session: send the image as a binary message, then placement updates as
+    JSON text ({"offset": [x, y], "scale": s, "rotation": degrees, "seq": n}). Each frame
+    comes back as a "frame" JSON message followed by the encoded image as a binary message.
+    """
+    import preview_session
+    import template_bundle
+
+    await websocket.accept()
+    send_lock = asyncio.Lock()
+
+    async def send_event(event, data=None):
+        async with send_lock:
+            await websocket.send_json(event)
+            if data is not None:
+                await websocket.send_bytes(data)
+
+    async def refuse(detail, code=1008):
+        await send_event({"event": "error", "detail": detail})
+        await websocket.close(code=code)
+
+    if len(preview_sessions) >= PREVIEW_SESSIONS:
+        return await refuse("Too many live preview sessions, try again later", code=1013)
+    try:
+        encoding = output_encoder.EncodeOptions(output_format, quality)
+        product = catalog.get(product_id) if product_id else None
+    except (ValueError, CatalogError) as e:
+        return await refuse(str(e))
+    if level not in PREVIEW_LEVELS:
+        return await refuse(f"level must be one of: {list(PREVIEW_LEVELS)}")
+    if not product or not product.get("psdFiles"):
+        return await refuse(f"Product with ID '{product_id}' not found or has no PSD templates")
+    psd_files = product["psdFiles"][:1] if singleView else product["psdFiles"]
+    missing_psds = catalog.missing_psds(product_id)
+    if any(psd_name in missing_psds for psd_name in psd_files):
+        return await refuse(f"A PSD template of '{product_id}' is missing on server or lacks one of its smart objects")
+
+    editor_size = (product.get("editorWidth"), product.get("editorHeight"))
+    level = level if all(editor_size) or level != "editor" else "half"
+    views = []  # their templates are kept loaded for the whole session, however idle
+    try:
+        for psd_name in psd_files:
+            size, template, warp = await run_in_threadpool(
+                preview_level_for, psd_name, level, editor_size, catalog.layers(product, psd_name)[0], True
+            )
+            views.append((psd_name, tuple(size), template, warp))
+    except Exception as e:
+        for _, _, template, _ in views:
+            template_bundle.store.release(template)
+        return await refuse(f"Error opening PSD: {e}", code=1011)
+
+    session = preview_session.PreviewSession(
+        views, lambda view, artwork, placement: render_preview_frame(view, artwork, placement, encoding), send_event
+    )
+    preview_sessions.add(session)
+    renderer = asyncio.ensure_future(session.run())
+    try:
+        await send_event({
+            "event": "ready",
+            "level": level,
+            "format": encoding.format,
+            "views": [{"psd": psd_name, "size": list(size)} for psd_name, size, _, _ in views],
+        })
+        while True:
+            message = await websocket.receive()
+            if message["type"] == "websocket.disconnect":
+                break
+            if message.get("bytes") is not None:
+                if len(message["bytes"]) > PREVIEW_MAX_UPLOAD_BYTES:
+                    await send_event({"event": "error", "detail": "Image too large"})
+                    continue
+                try:
+                    session.set_artwork(await run_in_threadpool(prepare_artwork, message["bytes"], views))
+                except (OSError, Image.DecompressionBombError) as e:
+                    await send_event({"event": "error", "detail": f"Could not decode image: {e}"})
+                continue
+            try:
+                update = json.loads(message.get("text") or "")
+                session.move(preview_session.placement_from(update), update.get("seq"))
+            except ValueError as e:
+                await send_event({"event": "error", "detail": f"Invalid placement: {e}"})
+    except WebSocketDisconnect:
+        pass
+    finally:
+        renderer.cancel()
+        preview_sessions.discard(session)
+        for _, _, template, _ in views:
+            template_bundle.store.release(template)
+
+def is_admin(request):
+    """True if the request carries the configured ADMIN_TOKEN."""
+    token = request.headers.get("x-admin-token", "")
+    return bool(ADMIN_TOKEN) and hmac.compare_digest(token.encode(), ADMIN_TOKEN.encode())
+
+def requested_profile(request):
+    """The profile format asked for with X-Profile, None if none. Only admins may ask."""
+    kind = request.headers.get("x-profile")
+    if not kind:
+        return None
+    if not is_admin(request):
+        raise HTTPException(status_code=403, detail="Profiling requires a valid X-Admin-Token")
+    if kind not in profiling.PROFILE_FORMATS:
+        raise HTTPException(status_code=400, detail=f"X-Profile must be one of: {list(profiling.PROFILE_FORMATS)}")
+    return kind
+
+@app.get("/profiles/{filename}")
+async def get_profile(filename: str, request: Request):
+    """Downloads a profile captured with X-Profile (admins only)."""
+    if not is_admin(request):
+        raise HTTPException(status_code=403, detail="Profiles require a valid X-Admin-Token")
+    path = os.path.join(PROFILE_DIR, os.path.basename(filename))
+    if not os.path.isfile(path):
+        raise HTTPException(status_code=404, detail=f"Profile '{filename}' not found")
+    return FileResponse(path, filename=os.path.basename(path))
+
+@app.get("/jobs/{job_id}")
+async def get_job(job_id: str, request: Request):
+    """Reports a render job's status (queued, running, done or failed), result URLs and timings."""
+    job = job_queue.get(job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail=f"Job '{job_id}' not found")
+    request.state.stages = job.stages
+    return {**job.to_dict(), "queue": job_queue.stats()}
+
+@app.middleware("http")
+async def server_timing(request: Request, call_next):
+    """Times every request; adds the stages a handler recorded in request.state.stages as Server-Timing."""
+    started = time.perf_counter()
+    response = await call_next(request)
+    elapsed = time.perf_counter() - started
+    route = request.scope.get("route")
+    metrics.request_seconds.observe(
+        elapsed, method=request.method, route=getattr(route, "path", "unmatched"), status=response.status_code
+    )
+    stages = getattr(request.state, "stages", None)
+    timing = f"total;dur={elapsed * 1000:.1f}"
+    if stages is not None and stages.entries():
+        timing = f"{stages.server_timing()}, {timing}"
+    response.headers["Server-Timing"] = timing
+    return response
+
+def loaded_templates():
+    import template_bundle
+    return template_bundle.store.stats()["loaded"]
+
+metrics.register(metrics.Gauge("mockup_jobs_queued", "Render jobs waiting for a worker.",
+                               lambda: job_queue.stats()["queued"]))
+metrics.register(metrics.Gauge("mockup_jobs_running", "Render jobs being rendered.",
+                               lambda: job_queue.stats()["running"]))
+metrics.register(metrics.Gauge("mockup_preview_sessions", "Open live preview sessions.",
+                               lambda: len(preview_sessions)))
+metrics.register(metrics.Gauge("mockup_templates_loaded", "Templates mapped by the server process (workers keep their own).",
+                               loaded_templates))
+metrics.register(metrics.Gauge("mockup_render_cache_bytes", "Size of the cached renders.",
+                               lambda: result_cache.stats()["bytes"]))
+metrics.register(metrics.Gauge("mockup_render_cache_hits_total", "Render cache hits.",
+                               lambda: result_cache.stats()["hits"], kind="counter"))
+metrics.register(metrics.Gauge("mockup_render_cache_misses_total", "Render cache misses.",
+                               lambda: result_cache.stats()["misses"], kind="counter"))
+
+@app.get("/metrics")
+async def get_metrics():
+    """Stage, render, queue-wait and request latency histograms in the Prometheus text format."""
+    return PlainTextResponse(metrics.render_text(), media_type="text/plain; version=0.0.4")
+
+@app.get("/cache")
+async def get_cache_stats():
+    """Render cache size and hit/miss counters, and what the janitor has cleaned up."""
+    return {**result_cache.stats(), "janitor": janitor.stats()}
 
 if __name__ == "__main__":
     import uvicorn
-    # Optional: Clear temp folders on startup to keep things clean
-    for folder in [OUTPUT_DIR, UPLOAD_DIR]:
+    # Optional: Clear temp folders on startup to keep things clean.
+    # temp_output is left alone: it holds the render cache, bounded by RENDER_CACHE_BYTES.
+    for folder in [UPLOAD_DIR]:
         for filename in os.listdir(folder):
             file_path = os.path.join(folder, filename)
             try:
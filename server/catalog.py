@@ -0,0 +1,187 @@
+"""
+In-memory product catalog.
+
+products.json is loaded once into an immutable snapshot: the product list, a
+dict index by id, and the set of each product's psdFiles that can't be
+rendered, because they are missing from the PSD directory or have no smart
+object called ``layer_name`` (checked at load, not per request, from the
+PSDs' layer records only, see psd_index.py). A product can fill several smart
+objects of a template in one render by listing them per PSD:
+
+    "smartObjects": {"shirt.psd": ["front_surface", "back_surface"]}
+
+The first one of a template gets the upload; the others their own inputs. Responses are pre-serialised per
+base URL with thumbnail URLs already made absolute, so GET /products is a dict
+lookup plus sending bytes.
+
+The file (and the PSD directory) are stat()ed at most every
+``check_interval`` seconds; when either changed, a new snapshot is built and
+swapped in with a single assignment. A file that fails to load keeps the
+previous snapshot serving.
+"""
+import json
+import os
+import threading
+import time
+
+import psd_index
+
+
+def _dump(value):
+    # Same encoding FastAPI's JSONResponse uses
+    return json.dumps(value, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+def template_layers(product, psd_name, layer_name):
+    """The smart objects ``product`` fills in ``psd_name``, in input order: its own list or [``layer_name``]."""
+    return list((product.get("smartObjects") or {}).get(psd_name) or [layer_name])
+
+
+class CatalogError(Exception):
+    """products.json could not be loaded and there is no earlier version to serve."""
+
+
+class CatalogSnapshot:
+    """One parsed version of products.json. Never mutated after construction."""
+
+    MAX_BASE_URLS = 16
+
+    def __init__(self, products, psd_dir, signature, layer_name=None, index_dir=None):
+        self.signature = signature
+        self.products = products
+        self.by_id = {}
+        self.missing_psds = {}
+        unusable = {}  # (psd name, smart object names) -> reason, checked once per snapshot
+        for product in products:
+            product_id = product.get("id")
+            if product_id is None:
+                print(f"Catalog: skipping product without an id: {product.get('name')!r}")
+                continue
+            if product_id in self.by_id:
+                print(f"Catalog: duplicate product id '{product_id}', keeping the first")
+                continue
+            self.by_id[product_id] = product
+            checks = {}
+            for name in product.get("psdFiles", []):
+                layers = tuple(template_layers(product, name, layer_name))
+                if (name, layers) not in unusable:
+                    unusable[name, layers] = self._check_psd(os.path.join(psd_dir, name), layers, index_dir)
+                checks[name] = unusable[name, layers]
+            missing = {name: reason for name, reason in checks.items() if reason}
+            if missing:
+                print(f"Catalog: product '{product_id}' has unusable PSDs: {missing}")
+            self.missing_psds[product_id] = frozenset(missing)
+        self._rendered = {}  # base_url -> (list JSON bytes, {id: product JSON bytes})
+
+    def rendered(self, base_url):
+        """Pre-serialised responses with absolute thumbnail URLs for ``base_url``."""
+        rendered = self._rendered.get(base_url)
+        if rendered is None:
+            resolved = [self._resolve(product, base_url) for product in self.products]
+            rendered = (
+                _dump(resolved),
+                {
+                    product["id"]: _dump(product)
+                    for original, product in zip(self.products, resolved)
+                    if self.by_id.get(original.get("id")) is original
+                },
+            )
+            if len(self._rendered) >= self.MAX_BASE_URLS:
+                self._rendered = {}
+            self._rendered = {**self._rendered, base_url: rendered}
+        return rendered
+
+    @staticmethod
+    def _check_psd(psd_path, layers, index_dir):
+        """Why a template can't be rendered, or None if it can."""
+        if not os.path.exists(psd_path):
+            return "missing"
+        layers = [name for name in layers if name is not None]
+        if not layers:
+            return None
+        try:
+            index = psd_index.get_index(psd_path, index_dir)
+        except (OSError, psd_index.PSDFormatError) as e:
+            return str(e)
+        for layer_name in layers:
+            if psd_index.find_layer(index, layer_name, "smartobject") is None:
+                return f"no smart object layer '{layer_name}'"
+        return None
+
+    @staticmethod
+    def _resolve(product, base_url):
+        thumbnail = product.get("thumbnail")
+        if thumbnail and thumbnail.startswith("/"):
+            return {**product, "thumbnail": f"{base_url}{thumbnail}"}
+        return product
+
+
+class ProductCatalog:
+    """Serves products.json from memory, reloading it when it changes on disk."""
+
+    def __init__(self, products_file, psd_dir, check_interval=1.0, layer_name=None, index_dir=None):
+        self.products_file = products_file
+        self.psd_dir = psd_dir
+        self.layer_name = layer_name
+        self.index_dir = index_dir
+        self.check_interval = check_interval
+        self._snapshot = None
+        self._checked_at = 0.0
+        self._reload_lock = threading.Lock()
+        self._failed_signature = None  # don't retry (and log) a broken file until it changes again
+        self.reloads = 0
+
+    def snapshot(self):
+        """The current catalog, reloading first if the file changed."""
+        now = time.monotonic()
+        if self._snapshot is None or now - self._checked_at >= self.check_interval:
+            self._checked_at = now
+            self._maybe_reload()
+        return self._snapshot
+
+    def get(self, product_id):
+        """The product dict for ``product_id`` (thumbnail as stored), or None."""
+        return self.snapshot().by_id.get(product_id)
+
+    def layers(self, product, psd_name):
+        """The smart objects ``product`` fills in ``psd_name``, see template_layers()."""
+        return template_layers(product, psd_name, self.layer_name)
+
+    def missing_psds(self, product_id):
+        return self.snapshot().missing_psds.get(product_id, frozenset())
+
+    def psd_files(self):
+        """Every PSD referenced by some product, each once."""
+        return list(dict.fromkeys(name for product in self.snapshot().products for name in product.get("psdFiles", [])))
+
+    def products_json(self, base_url):
+        return self.snapshot().rendered(base_url)[0]
+
+    def product_json(self, base_url, product_id):
+        """Serialised product, or None if there is no such product."""
+        return self.snapshot().rendered(base_url)[1].get(product_id)
+
+    def _signature(self):
+        stat = os.stat(self.products_file)
+        psd_dir_mtime = os.stat(self.psd_dir).st_mtime_ns if os.path.isdir(self.psd_dir) else None
+        return (stat.st_size, stat.st_mtime_ns, psd_dir_mtime)
+
+    def _maybe_reload(self):
+        with self._reload_lock:
+            signature = None
+            try:
+                signature = self._signature()
+                if self._snapshot is not None and signature in (self._snapshot.signature, self._failed_signature):
+                    return
+                with open(self.products_file, "r") as f:
+                    products = json.load(f)
+                if not isinstance(products, list):
+                    raise ValueError("products.json must contain a list of products")
+                self._snapshot = CatalogSnapshot(products, self.psd_dir, signature, self.layer_name, self.index_dir)
+                self.reloads += 1
+                print(f"Catalog: loaded {len(self._snapshot.by_id)} products")
+            except (OSError, ValueError) as e:
+                if self._snapshot is None:
+                    raise CatalogError(f"Error loading products: {e}")
+                self._failed_signature = signature
+                print(f"Catalog: keeping previous products, reload failed: {e}")
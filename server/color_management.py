@@ -0,0 +1,140 @@
+"""
+Colour management with LittleCMS (PIL.ImageCms).
+
+Uploads come in whatever profile the camera or editor embedded (Display P3
+phone photos, Adobe RGB, CMYK JPEGs) and Photoshop saves renders in the
+template's own profile, while a mockup is viewed in a browser as sRGB. Both
+are converted to sRGB here: uploads by upload_normalizer.py before any
+template sees them, Photoshop's renders by output_encoder.py before encoding.
+psd-tools already converts a template from its embedded profile when a bundle
+is compiled, so templates need no transform per render.
+
+Building a transform parses both profiles and precomputes LittleCMS's tables,
+which costs more than applying it to a mockup-sized image. get_transform()
+builds each (source profile, destination profile, intent, modes) once and
+keeps the most recently used ones; a transform is applied in place to an
+RGB(A) image's own pixel buffer. Images without a profile, or tagged sRGB,
+are taken as sRGB and left alone.
+"""
+import hashlib
+import io
+import threading
+from collections import OrderedDict
+
+from PIL import ImageCms
+
+import metrics
+
+# Photoshop's default conversion: relative colorimetric with black point compensation
+INTENT = ImageCms.Intent.RELATIVE_COLORIMETRIC
+TRANSFORM_CACHE_SIZE = 32  # transforms kept per process, least recently used dropped first
+
+transforms_total = metrics.register(metrics.Counter(
+    "mockup_color_transforms_total", "ICC transform lookups: found in the cache or built.", ("outcome",)))
+
+
+def profile_key(icc_profile):
+    """A short key for an ICC profile's bytes; None stands for sRGB."""
+    return None if icc_profile is None else hashlib.sha256(icc_profile).hexdigest()[:16]
+
+
+def profile_description(icc_profile):
+    with io.BytesIO(icc_profile) as f:
+        return ImageCms.getProfileDescription(ImageCms.ImageCmsProfile(f)).strip()
+
+
+_srgb_keys = {}  # profile_key -> whether the profile is sRGB
+
+
+def is_srgb(icc_profile):
+    """True for no profile or an sRGB one (by its description: the IEC 61966-2.1 profile is shipped under several)."""
+    if not icc_profile:
+        return True
+    key = profile_key(icc_profile)
+    if key not in _srgb_keys:
+        try:
+            _srgb_keys[key] = profile_description(icc_profile).startswith("sRGB")
+        except (ImageCms.PyCMSError, OSError):
+            _srgb_keys[key] = False
+    return _srgb_keys[key]
+
+
+class TransformCache:
+    """Built ImageCms transforms by (source, destination, intent, input mode, output mode), LRU-evicted."""
+
+    def __init__(self, max_entries=TRANSFORM_CACHE_SIZE):
+        self.max_entries = max_entries
+        self._transforms = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, source_icc, destination_icc, intent, in_mode, out_mode):
+        key = (profile_key(source_icc), profile_key(destination_icc), int(intent), in_mode, out_mode)
+        with self._lock:
+            transform = self._transforms.get(key)
+            if transform is not None:
+                self._transforms.move_to_end(key)
+                self.hits += 1
+                transforms_total.inc(outcome="hit")
+                return transform
+
+        # Built outside the lock; two threads racing on a new pair both build it once
+        transform = ImageCms.buildTransform(
+            _profile(source_icc), _profile(destination_icc), in_mode, out_mode, intent,
+            ImageCms.Flags.BLACKPOINTCOMPENSATION,
+        )
+        with self._lock:
+            self._transforms[key] = transform
+            self._transforms.move_to_end(key)
+            while len(self._transforms) > self.max_entries:
+                self._transforms.popitem(last=False)
+            self.misses += 1
+        transforms_total.inc(outcome="built")
+        return transform
+
+    def stats(self):
+        with self._lock:
+            return {"transforms": len(self._transforms), "hits": self.hits, "misses": self.misses}
+
+
+def _profile(icc_profile):
+    if icc_profile is None:
+        return ImageCms.createProfile("sRGB")
+    with io.BytesIO(icc_profile) as f:
+        return ImageCms.ImageCmsProfile(f)
+
+
+transforms = TransformCache()
+
+
+def get_transform(source_icc, destination_icc=None, intent=INTENT, in_mode="RGBA", out_mode="RGBA"):
+    """The cached transform from ``source_icc`` to ``destination_icc`` (ICC bytes, None for sRGB)."""
+    return transforms.get(source_icc, destination_icc, intent, in_mode, out_mode)
+
+
+def to_srgb(image, icc_profile=None, intent=INTENT):
+    """
+    Convert ``image`` from ``icc_profile`` (default: the profile it embeds) to sRGB.
+
+    RGB and RGBA images are converted in place and returned; other modes (CMYK,
+    greyscale) come back as a new RGB or RGBA image. An image without a
+    profile, already in sRGB, or whose profile can't be used is returned as is.
+    """
+    icc_profile = icc_profile or image.info.get("icc_profile")
+    if is_srgb(icc_profile):
+        return image
+    in_place = image.mode in ("RGB", "RGBA")
+    out_mode = image.mode if in_place else ("RGBA" if "A" in image.mode else "RGB")
+    try:
+        transform = get_transform(icc_profile, None, intent, image.mode, out_mode)
+        if in_place:
+            ImageCms.applyTransform(image, transform, inPlace=True)
+            converted = image
+        else:
+            converted = ImageCms.applyTransform(image, transform)
+    except (ImageCms.PyCMSError, OSError, ValueError) as e:
+        print(f"Colour management: could not convert a {image.mode} image to sRGB, leaving it as is: {e}")
+        return image
+    converted.info.pop("icc_profile", None)
+    return converted
@@ -0,0 +1,173 @@
+"""
+Housekeeping for the server's temporary files.
+
+Uploads and renders are spread over two-character shard directories
+(``uploads/3f/3f2a....png``, ``temp_output/9c/result_9c41....webp``) so no
+single directory grows to hundreds of thousands of entries.
+
+A Janitor runs in the background and, every ``interval`` seconds:
+
+- expires cached renders not used for ``output_ttl`` seconds, through the
+  RenderCache so its index and byte count stay right (the cache enforces its
+  own byte quota whenever a render is added);
+- deletes stray files in temp_output the cache doesn't know about (leftovers
+  of crashed jobs, older outputs) once they are ``output_ttl`` old;
+- deletes uploads older than ``upload_ttl``, then the oldest ones while the
+  upload directory is over ``upload_quota`` bytes.
+
+Files registered in the InFlight set are never touched: the upload and
+temporary outputs of queued and running jobs, and files being streamed to a
+client from /outputs.
+"""
+import asyncio
+import os
+import threading
+import time
+from collections import Counter
+
+from fastapi.staticfiles import StaticFiles
+
+
+def sharded_path(root, filename):
+    """``root/<first two characters>/filename``, creating the shard directory."""
+    shard = os.path.join(root, filename[:2])
+    os.makedirs(shard, exist_ok=True)
+    return os.path.join(shard, filename)
+
+
+class InFlight:
+    """Reference-counted set of paths that are in use and must not be deleted."""
+
+    def __init__(self):
+        self._paths = Counter()
+        self._lock = threading.Lock()
+
+    def hold(self, *paths):
+        with self._lock:
+            self._paths.update(os.path.abspath(path) for path in paths)
+
+    def release(self, *paths):
+        with self._lock:
+            for path in paths:
+                path = os.path.abspath(path)
+                self._paths[path] -= 1
+                if self._paths[path] <= 0:
+                    del self._paths[path]
+
+    def __contains__(self, path):
+        with self._lock:
+            return os.path.abspath(path) in self._paths
+
+
+class TrackedStaticFiles(StaticFiles):
+    """StaticFiles that marks each file as in flight while it is being sent."""
+
+    def __init__(self, *args, in_flight, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.in_flight = in_flight
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await super().__call__(scope, receive, send)
+        path = os.path.join(self.directory, self.get_path(scope))
+        self.in_flight.hold(path)
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            self.in_flight.release(path)
+
+
+def _files(root):
+    """(path, size, mtime) of every file under ``root``."""
+    for directory, _, filenames in os.walk(root):
+        for name in filenames:
+            path = os.path.join(directory, name)
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            yield path, stat.st_size, stat.st_mtime
+
+
+class Janitor:
+    """Periodic TTL and quota cleanup of the upload and output directories."""
+
+    def __init__(self, upload_dir, output_dir, cache, in_flight,
+                 upload_ttl=3600, upload_quota=1024 ** 3, output_ttl=24 * 3600, interval=60):
+        self.upload_dir = upload_dir
+        self.output_dir = output_dir
+        self.cache = cache
+        self.in_flight = in_flight
+        self.upload_ttl = upload_ttl
+        self.upload_quota = upload_quota
+        self.output_ttl = output_ttl
+        self.interval = interval
+        self.removed = Counter()
+        self._task = None
+
+    def sweep(self, now=None):
+        """One cleanup pass. Returns what was removed, e.g. {"uploads": 3, "renders": 1}."""
+        now = time.time() if now is None else now
+        removed = Counter()
+        removed["renders"] = self.cache.expire(self.output_ttl, now)
+
+        known = {os.path.abspath(path) for path in self.cache.paths()}
+        for path, _, mtime in _files(self.output_dir):
+            if now - mtime > self.output_ttl and os.path.abspath(path) not in known and self._delete(path):
+                removed["strays"] += 1
+
+        uploads = []
+        for path, size, mtime in _files(self.upload_dir):
+            if now - mtime > self.upload_ttl:
+                if self._delete(path):
+                    removed["uploads"] += 1
+            else:
+                uploads.append((mtime, path, size))
+        total = sum(size for _, _, size in uploads)
+        for _, path, size in sorted(uploads):
+            if total <= self.upload_quota:
+                break
+            if self._delete(path):
+                removed["uploads"] += 1
+                total -= size
+
+        removed = +removed  # drop zero counts
+        self.removed.update(removed)
+        return dict(removed)
+
+    def _delete(self, path):
+        if path in self.in_flight:
+            return False
+        try:
+            os.unlink(path)
+            return True
+        except OSError:  # gone already, or still open on Windows
+            return False
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                removed = await loop.run_in_executor(None, self.sweep)
+                if removed:
+                    print(f"Janitor removed {removed}")
+            except Exception as e:
+                print(f"Janitor sweep failed: {e}")
+
+    def start(self):
+        self._task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    def stats(self):
+        return {
+            "removed": dict(self.removed),
+            "upload_ttl": self.upload_ttl,
+            "upload_quota": self.upload_quota,
+            "output_ttl": self.output_ttl,
+        }
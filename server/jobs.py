@@ -0,0 +1,190 @@
+"""
+Background render jobs.
+
+Renders are blocking (COM calls into Photoshop, or NumPy compositing), so
+/process no longer runs them on the event loop. It enqueues a job instead; a
+fixed number of workers drain the queue and run each job on a thread pool,
+while GET /jobs/{id} reports progress.
+"""
+import asyncio
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from metrics import StageTimer
+
+
+class QueueFullError(Exception):
+    """Raised by JobQueue.submit when the queue is at its configured depth."""
+
+
+class EventStream:
+    """
+    Events published from any thread, read in order by coroutines until closed.
+
+    A reader that starts late still gets every event from the first one.
+    """
+
+    def __init__(self):
+        try:
+            self._loop = asyncio.get_running_loop()
+        except RuntimeError:  # created outside the event loop: nobody can follow it
+            self._loop = None
+        self._events = []
+        self._closed = False
+        self._changed = asyncio.Event()
+
+    def _notify(self):
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(self._changed.set)
+
+    def publish(self, event):
+        self._events.append(event)
+        self._notify()
+
+    def close(self):
+        self._closed = True
+        self._notify()
+
+    async def follow(self):
+        """Yield every event, waiting for new ones, until the stream is closed."""
+        position = 0
+        while True:
+            while position < len(self._events):
+                yield self._events[position]
+                position += 1
+            if self._closed:
+                if position >= len(self._events):
+                    return
+                continue
+            self._changed.clear()
+            if position < len(self._events) or self._closed:
+                continue
+            await self._changed.wait()
+
+
+class Job:
+    """One queued unit of work and its outcome."""
+
+    def __init__(self):
+        self.id = str(uuid.uuid4())
+        self.status = "queued"  # queued -> running -> done | failed
+        self.result = None
+        self.error = None
+        self.timings = {}       # filled in by the job function, in milliseconds
+        self.details = {}       # extra job-specific fields reported by to_dict()
+        self.stages = StageTimer()  # per-stage timings, from the queue wait on
+        self.events = EventStream()  # progress the job function publishes, e.g. each finished view
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self._done = asyncio.Event()
+
+    def to_dict(self):
+        timings = dict(self.timings)
+        if self.started_at is not None:
+            timings["queue_wait_ms"] = round((self.started_at - self.created_at) * 1000, 1)
+        if self.finished_at is not None:
+            timings["run_ms"] = round((self.finished_at - self.started_at) * 1000, 1)
+            timings["total_ms"] = round((self.finished_at - self.created_at) * 1000, 1)
+        return {
+            "job_id": self.id,
+            "status": self.status,
+            "result": self.result,
+            "error": self.error,
+            "timings": timings,
+            "stages": self.stages.as_dict(),
+            **self.details,
+        }
+
+
+class JobQueue:
+    """
+    A bounded queue of jobs drained by ``workers`` concurrent workers.
+
+    Job functions are called as ``func(job, *args)`` on a worker thread and
+    their return value becomes ``job.result``. Finished jobs are kept for
+    polling until ``keep_finished`` newer ones have completed.
+    """
+
+    def __init__(self, workers=2, max_depth=100, keep_finished=1000, thread_initializer=None):
+        self.workers = workers
+        self.max_depth = max_depth
+        self.keep_finished = keep_finished
+        self.thread_initializer = thread_initializer
+        self._jobs = OrderedDict()
+        self._queue = None
+        self._executor = None
+        self._tasks = []
+        self._running = 0
+
+    async def start(self):
+        self._queue = asyncio.Queue(maxsize=self.max_depth)
+        self._executor = ThreadPoolExecutor(
+            max_workers=self.workers,
+            thread_name_prefix="render",
+            initializer=self.thread_initializer,
+        )
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+
+    def submit(self, func, *args):
+        """Enqueue ``func(job, *args)`` and return its Job without waiting."""
+        job = Job()
+        try:
+            self._queue.put_nowait((job, func, args))
+        except asyncio.QueueFull:
+            raise QueueFullError(f"Render queue is full ({self.max_depth} jobs waiting)")
+        self._jobs[job.id] = job
+        return job
+
+    async def wait(self, job):
+        """Wait until ``job`` has finished (successfully or not)."""
+        await job._done.wait()
+        return job
+
+    def get(self, job_id):
+        return self._jobs.get(job_id)
+
+    def stats(self):
+        return {
+            "workers": self.workers,
+            "running": self._running,
+            "queued": self._queue.qsize() if self._queue is not None else 0,
+            "max_depth": self.max_depth,
+        }
+
+    async def _worker(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            job, func, args = await self._queue.get()
+            job.status = "running"
+            job.started_at = time.time()
+            job.stages.add("queue", (job.started_at - job.created_at) * 1000)
+            self._running += 1
+            try:
+                job.result = await loop.run_in_executor(self._executor, func, job, *args)
+                job.status = "done"
+            except Exception as e:
+                job.status = "failed"
+                job.error = getattr(e, "detail", None) or str(e)
+            finally:
+                self._running -= 1
+                job.finished_at = time.time()
+                job._done.set()
+                job.events.close()
+                self._queue.task_done()
+                self._forget_old_jobs()
+
+    def _forget_old_jobs(self):
+        finished = [job_id for job_id, job in self._jobs.items() if job.finished_at is not None]
+        for job_id in finished[:max(len(finished) - self.keep_finished, 0)]:
+            del self._jobs[job_id]
@@ -0,0 +1,218 @@
+"""
+Render timings: per-stage timers, latency histograms and a Prometheus /metrics page.
+
+A StageTimer follows one request or job through its stages (upload copy,
+queue wait, decode, PSD open, smart object replace, save, encode...), per
+template where a stage belongs to one. Its entries become the request's
+Server-Timing header and, once the work is done, observe() feeds them into the
+histograms below, labelled by backend (and template for whole renders).
+
+Histograms and counters live in this process; render_text() writes them in
+the Prometheus text exposition format. A render pool worker keeps its own
+StageTimer and hands its entries back to the job (see render_pool.py), so
+its stages are counted by the server process like any other.
+"""
+import threading
+import time
+from contextlib import contextmanager
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+_registry = []
+_registry_lock = threading.Lock()
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(names, values, extra=()):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in list(zip(names, values)) + list(extra)]
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _number(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    """A monotonically increasing count per label combination."""
+
+    kind = "counter"
+
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(str(labels[name]) for name in self.labelnames)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            return [(self.name, _labels(self.labelnames, key), value) for key, value in self._values.items()]
+
+
+class Histogram:
+    """Observations (in seconds) counted into cumulative buckets per label combination."""
+
+    kind = "histogram"
+
+    def __init__(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self._values = {}  # label values -> [bucket counts..., sum, count]
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(str(labels[name]) for name in self.labelnames)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = [0] * len(self.buckets) + [0.0, 0]
+            for position, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state[position] += 1
+            state[-2] += value
+            state[-1] += 1
+
+    def samples(self):
+        samples = []
+        with self._lock:
+            for key, state in self._values.items():
+                for bound, count in zip(self.buckets, state):
+                    samples.append((f"{self.name}_bucket", _labels(self.labelnames, key, [("le", _number(bound))]), count))
+                samples.append((f"{self.name}_bucket", _labels(self.labelnames, key, [("le", "+Inf")]), state[-1]))
+                samples.append((f"{self.name}_sum", _labels(self.labelnames, key), state[-2]))
+                samples.append((f"{self.name}_count", _labels(self.labelnames, key), state[-1]))
+        return samples
+
+
+class Gauge:
+    """A value read from ``func`` whenever the metrics are scraped (queue depth, cache size)."""
+
+    kind = "gauge"
+
+    def __init__(self, name, help, func, kind="gauge"):
+        self.name = name
+        self.help = help
+        self.func = func
+        self.kind = kind
+
+    def samples(self):
+        try:
+            value = self.func()
+        except Exception:
+            return []
+        return [] if value is None else [(self.name, "", value)]
+
+
+def register(metric):
+    """Add ``metric`` to what render_text() reports, replacing one of the same name."""
+    with _registry_lock:
+        _registry[:] = [existing for existing in _registry if existing.name != metric.name]
+        _registry.append(metric)
+    return metric
+
+
+def render_text():
+    """Every registered metric in the Prometheus text format (version 0.0.4)."""
+    lines = []
+    with _registry_lock:
+        metrics = list(_registry)
+    for metric in metrics:
+        lines.append(f"# HELP {metric.name} {metric.help}")
+        lines.append(f"# TYPE {metric.name} {metric.kind}")
+        for name, labels, value in metric.samples():
+            lines.append(f"{name}{labels} {_number(value)}")
+    return "\n".join(lines) + "\n"
+
+
+stage_seconds = register(Histogram(
+    "mockup_stage_seconds", "Time spent in each stage of a render request.", ("backend", "mode", "stage")))
+render_seconds = register(Histogram(
+    "mockup_render_seconds", "Time to render one view, per template.", ("backend", "mode", "template")))
+queue_wait_seconds = register(Histogram(
+    "mockup_queue_wait_seconds", "Time a render job waited for a worker.", ("backend",)))
+request_seconds = register(Histogram(
+    "mockup_http_request_seconds", "HTTP request latency.", ("method", "route", "status")))
+
+
+class StageTimer:
+    """
+    Milliseconds per (stage, template) for one request or job, in the order first seen.
+
+    A stage timed twice adds up. ``for_template()`` returns a view that files
+    its stages under one template, for code that doesn't know which it is
+    rendering (psd_renderer, the Photoshop session).
+    """
+
+    def __init__(self, template=None, _entries=None, _lock=None):
+        self.template = template
+        self._entries = {} if _entries is None else _entries
+        self._lock = _lock or threading.Lock()
+
+    def for_template(self, template):
+        return StageTimer(template, self._entries, self._lock)
+
+    @contextmanager
+    def stage(self, name):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, (time.perf_counter() - started) * 1000)
+
+    def add(self, name, ms, template=None):
+        key = (name, template or self.template)
+        with self._lock:
+            self._entries[key] = self._entries.get(key, 0.0) + ms
+
+    def entries(self):
+        """[(stage, template or None, ms), ...]; picklable, for merge() in another process."""
+        with self._lock:
+            return [(name, template, ms) for (name, template), ms in self._entries.items()]
+
+    def merge(self, entries):
+        """Add the entries of another StageTimer (or its entries())."""
+        if isinstance(entries, StageTimer):
+            entries = entries.entries()
+        for name, template, ms in entries:
+            self.add(name, ms, template)
+
+    def as_dict(self):
+        """{"stage": ms} and {"stage template": ms}, rounded, for JSON responses."""
+        return {f"{name} {template}" if template else name: round(ms, 1) for name, template, ms in self.entries()}
+
+    def server_timing(self):
+        """The entries as a Server-Timing header value."""
+        metrics = []
+        for name, template, ms in self.entries():
+            desc = f';desc="{_escape(template)}"' if template else ""
+            metrics.append(f"{name}{desc};dur={ms:.1f}")
+        return ", ".join(metrics)
+
+    def observe(self, backend, mode="final"):
+        """Record every entry in the stage histograms; whole renders ("render") per template too."""
+        for name, template, ms in self.entries():
+            stage_seconds.observe(ms / 1000, backend=backend, mode=mode, stage=name)
+            if name == "render" and template:
+                render_seconds.observe(ms / 1000, backend=backend, mode=mode, template=template)
+
+
+@contextmanager
+def maybe_stage(timer, name):
+    """``timer.stage(name)``, or nothing when there is no timer."""
+    if timer is None:
+        yield
+    else:
+        with timer.stage(name):
+            yield
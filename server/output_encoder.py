@@ -0,0 +1,157 @@
+"""
+Output encoding for rendered mockups.
+
+Results used to be written as full-size lossless PNGs at zlib level 6, which
+is slow to encode and heavy to download through a tunnel. A request can now
+ask for:
+
+    png   compression 0-9 (default 6), optionally quantised to ``colors`` (2-256)
+    jpeg  progressive, quality 1-95 (default 85)
+    webp  quality 1-100 (default 80)
+
+Pillow releases the GIL while its encoders run, so encoding is done on a
+small thread pool of its own: a job can render its next view while the
+previous one is being compressed. Each encode reports the bytes written and
+the time it took.
+
+A renderer's PNG in another profile than sRGB (Photoshop saves in the
+template's) is converted to sRGB first, see color_management.py.
+"""
+import io
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from PIL import Image
+
+import color_management
+
+EXTENSIONS = {"png": ".png", "jpeg": ".jpg", "webp": ".webp"}
+FORMAT_ALIASES = {"jpg": "jpeg"}
+DEFAULT_QUALITY = {"jpeg": 85, "webp": 80}
+QUALITY_RANGE = {"jpeg": (1, 95), "webp": (1, 100)}
+DEFAULT_PNG_LEVEL = 6
+
+
+class EncodeOptions:
+    """A validated output format and its settings. Raises ValueError for bad values."""
+
+    def __init__(self, format="png", quality=None, compression=None, colors=None):
+        format = FORMAT_ALIASES.get((format or "png").lower(), (format or "png").lower())
+        if format not in EXTENSIONS:
+            raise ValueError(f"Unsupported output format '{format}'. Choose one of: {list(EXTENSIONS)}")
+
+        if format == "png":
+            if quality is not None:
+                raise ValueError("quality applies to jpeg and webp; use compression for png")
+            compression = DEFAULT_PNG_LEVEL if compression is None else compression
+            if not 0 <= compression <= 9:
+                raise ValueError("compression must be between 0 and 9")
+            if colors is not None and not 2 <= colors <= 256:
+                raise ValueError("colors must be between 2 and 256")
+        else:
+            if compression is not None or colors is not None:
+                raise ValueError("compression and colors apply to png only")
+            low, high = QUALITY_RANGE[format]
+            quality = DEFAULT_QUALITY[format] if quality is None else quality
+            if not low <= quality <= high:
+                raise ValueError(f"quality must be between {low} and {high} for {format}")
+
+        self.format = format
+        self.quality = quality
+        self.compression = compression
+        self.colors = colors
+
+    @property
+    def extension(self):
+        return EXTENSIONS[self.format]
+
+    @property
+    def is_default_png(self):
+        """Settings a renderer's own PNG already satisfies, so it can be kept as is."""
+        return self.format == "png" and self.compression == DEFAULT_PNG_LEVEL and self.colors is None
+
+    def to_dict(self):
+        return {
+            "format": self.format,
+            "quality": self.quality,
+            "compression": self.compression,
+            "colors": self.colors,
+        }
+
+
+def _save_arguments(image, options):
+    if options.format == "jpeg":
+        return image.convert("RGB"), {"format": "JPEG", "quality": options.quality, "progressive": True, "optimize": True}
+    if options.format == "webp":
+        return image, {"format": "WEBP", "quality": options.quality, "method": 4}
+    if options.colors is not None:
+        image = image.quantize(options.colors, method=Image.Quantize.FASTOCTREE)
+    return image, {"format": "PNG", "compress_level": options.compression}
+
+
+def encode(rendered, output_path, options):
+    """
+    Write ``rendered`` (a PIL image, or the path of a PNG a renderer saved) to
+    ``output_path`` in the requested format. Returns {"bytes", "encode_ms", "size"}.
+    """
+    started = time.perf_counter()
+    if isinstance(rendered, str):
+        with Image.open(rendered) as image:
+            size = image.size
+            keep = options.is_default_png and color_management.is_srgb(image.info.get("icc_profile"))
+            if not keep:
+                image, arguments = _save_arguments(color_management.to_srgb(image), options)
+                image.save(output_path, **arguments)
+        if keep:
+            os.replace(rendered, output_path)
+        else:
+            os.unlink(rendered)
+    else:
+        size = rendered.size
+        image, arguments = _save_arguments(rendered, options)
+        image.save(output_path, **arguments)
+    return {
+        "bytes": os.path.getsize(output_path),
+        "encode_ms": round((time.perf_counter() - started) * 1000, 1),
+        "size": list(size),
+    }
+
+
+def encode_bytes(image, options):
+    """
+    encode() a PIL ``image`` into memory, for frames sent straight to a client.
+    Returns (data, {"bytes", "encode_ms", "size"}).
+    """
+    started = time.perf_counter()
+    buffer = io.BytesIO()
+    encoded, arguments = _save_arguments(image, options)
+    encoded.save(buffer, **arguments)
+    data = buffer.getvalue()
+    return data, {
+        "bytes": len(data),
+        "encode_ms": round((time.perf_counter() - started) * 1000, 1),
+        "size": list(image.size),
+    }
+
+
+_executor = None
+
+
+def _encode_then(rendered, output_path, options, then):
+    stats = encode(rendered, output_path, options)
+    if then is not None:
+        then(stats)
+    return stats
+
+
+def submit(rendered, output_path, options, workers=2, then=None):
+    """
+    Encode on the shared encoder threads; returns a Future of encode()'s result.
+    ``then(stats)`` runs on the encoder thread right after the file is written,
+    before the Future completes.
+    """
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="encode")
+    return _executor.submit(_encode_then, rendered, output_path, options, then)
@@ -0,0 +1,390 @@
+"""
+Long-lived Photoshop session for the COM backend.
+
+Opening a template PSD in Photoshop costs more than replacing its smart object,
+so instead of Dispatch/Open/Close per image, a SessionManager keeps one
+connection and every template it has used open. After opening a document it
+remembers the document's history state; each render replaces the contents,
+saves a copy, and rolls the document back to that state for the next job.
+A document that was closed behind our back is reopened, and if Photoshop itself
+stops answering the session reconnects and retries the render once. Smart object
+layers are looked up once per open document, and a render can replace several
+of them before the one save.
+
+The manager only talks to a PhotoshopDriver. ComPhotoshop drives the real
+application over win32com; FakePhotoshop is an in-memory, scriptable stand-in
+so the pooling, rollback and recovery logic can be exercised on any platform:
+
+    fake = FakePhotoshop(script=[("save_png", "crash")])
+    session = SessionManager(lambda: fake)
+    session.render("mug.psd", "art.png", "out.png", "front_surface")
+    fake.calls  # -> [("connect",), ("open", "mug.psd"), ..., ("connect",), ...]
+"""
+import os
+import threading
+from collections import OrderedDict
+
+from metrics import maybe_stage
+
+
+class LayerNotFoundError(LookupError):
+    """The template has no layer with the requested name."""
+
+
+class SessionLostError(RuntimeError):
+    """Photoshop stopped responding (crashed, was closed, or the COM link broke)."""
+
+
+def find_layer_recursive(layers, layer_name):
+    """Recursively search for a layer by name in groups and sets."""
+    for layer in layers:
+        if layer.Name == layer_name:
+            return layer
+        if layer.Typename == "LayerSet":
+            found = find_layer_recursive(layer.Layers, layer_name)
+            if found:
+                return found
+    return None
+
+
+class PhotoshopDriver:
+    """The Photoshop operations SessionManager relies on."""
+
+    def connect(self):
+        raise NotImplementedError
+
+    def is_alive(self):
+        raise NotImplementedError
+
+    def open(self, psd_path):
+        """Open a document and return a handle to it."""
+        raise NotImplementedError
+
+    def is_open(self, doc):
+        raise NotImplementedError
+
+    def snapshot(self, doc):
+        """Return a token for the document's current history state."""
+        raise NotImplementedError
+
+    def rollback(self, doc, state):
+        raise NotImplementedError
+
+    def find_layer(self, doc, layer_name):
+        """Return a handle to the document's layer called ``layer_name``. Raises LayerNotFoundError."""
+        raise NotImplementedError
+
+    def replace_contents(self, doc, layer, image_path):
+        """Replace the contents of the smart object ``layer`` (from find_layer), keeping its original bounds."""
+        raise NotImplementedError
+
+    def save_png(self, doc, output_path):
+        """Save a PNG copy, leaving the open document as it is."""
+        raise NotImplementedError
+
+    def close(self, doc):
+        raise NotImplementedError
+
+
+class ComPhotoshop(PhotoshopDriver):
+    """Drives a running Photoshop through win32com (Windows only)."""
+
+    def __init__(self):
+        self.app = None
+
+    def connect(self):
+        import win32com.client
+
+        self._client = win32com.client
+        try:
+            self.app = win32com.client.Dispatch("Photoshop.Application")
+        except Exception as e:
+            raise SessionLostError(f"Could not connect to Photoshop: {e}")
+        self.app.DisplayDialogs = 3  # psDisplayNoDialogs: never block on a modal dialog
+
+    def is_alive(self):
+        try:
+            self.app.Version
+            return True
+        except Exception:
+            return False
+
+    def open(self, psd_path):
+        return self.app.Open(os.path.abspath(psd_path))
+
+    def is_open(self, doc):
+        try:
+            doc.Name
+            return True
+        except Exception:
+            return False
+
+    def snapshot(self, doc):
+        self.app.ActiveDocument = doc
+        return doc.ActiveHistoryState
+
+    def rollback(self, doc, state):
+        self.app.ActiveDocument = doc
+        doc.ActiveHistoryState = state
+
+    def find_layer(self, doc, layer_name):
+        target_layer = find_layer_recursive(doc.Layers, layer_name)
+        if not target_layer:
+            raise LayerNotFoundError(f"Layer '{layer_name}' not found in PSD.")
+        return target_layer
+
+    def replace_contents(self, doc, target_layer, image_path):
+        self.app.ActiveDocument = doc
+        orig_bounds = target_layer.Bounds
+        orig_width = orig_bounds[2] - orig_bounds[0]
+        orig_height = orig_bounds[3] - orig_bounds[1]
+        doc.ActiveLayer = target_layer
+
+        js_image_path = os.path.abspath(image_path).replace('\\', '/')
+        js_code = f"""
+        var idplacedLayerReplaceContents = stringIDToTypeID("placedLayerReplaceContents");
+        var desc = new ActionDescriptor();
+        var idnull = charIDToTypeID("null");
+        desc.putPath(idnull, new File("{js_image_path}"));
+        var idPgNm = charIDToTypeID("PgNm");
+        desc.putInteger(idPgNm, 1);
+        executeAction(idplacedLayerReplaceContents, desc, DialogModes.NO);
+
+        var layer = app.activeDocument.activeLayer;
+        var currentBounds = layer.bounds;
+        var currentWidth = currentBounds[2] - currentBounds[0];
+        var currentHeight = currentBounds[3] - currentBounds[1];
+
+        var widthPercent = ({orig_width} / currentWidth) * 100;
+        var heightPercent = ({orig_height} / currentHeight) * 100;
+
+        layer.resize(widthPercent, heightPercent, AnchorPosition.MIDDLECENTER);
+        """
+        self.app.DoJavaScript(js_code)
+
+    def save_png(self, doc, output_path):
+        save_options = self._client.Dispatch("Photoshop.PNGSaveOptions")
+        doc.SaveAs(os.path.abspath(output_path), save_options, True)
+
+    def close(self, doc):
+        doc.Close(2)  # psDoNotSaveChanges
+
+
+class FakePhotoshop(PhotoshopDriver):
+    """
+    In-memory Photoshop for exercising SessionManager without Windows.
+
+    Documents are lists of history entries; every call is appended to
+    ``calls``. ``script`` is a list of (method name, action) consumed in order
+    the next time that method runs: an exception instance is raised, "crash"
+    kills the application (every later call fails until ``connect``), and
+    "close" closes the document the call was made on, as a user would,
+    so the call fails.
+    ``saved`` maps output paths to the history the document had when saved.
+    """
+
+    def __init__(self, layers=("front_surface",), script=None):
+        self.layers = set(layers)
+        self.script = list(script or [])
+        self.calls = []
+        self.saved = {}
+        self.alive = False
+        self.documents = []
+
+    def _enter(self, name, *args, doc=None):
+        self.calls.append((name,) + args)
+        if name != "connect" and not self.alive:
+            raise SessionLostError("Photoshop is not running")
+        for i, (method, action) in enumerate(self.script):
+            if method == name:
+                del self.script[i]
+                if action == "crash":
+                    self.alive = False
+                    self.documents = []
+                    raise SessionLostError("Photoshop crashed")
+                if action == "close" and doc is not None:
+                    doc["open"] = False
+                    break
+                raise action
+        if doc is not None and not doc["open"]:
+            raise RuntimeError("Document is closed")
+
+    def connect(self):
+        self._enter("connect")
+        # A (re)launched Photoshop starts with no documents open.
+        self.alive = True
+        self.documents = []
+
+    def is_alive(self):
+        return self.alive
+
+    def open(self, psd_path):
+        self._enter("open", psd_path)
+        doc = {"path": psd_path, "history": ["Open"], "open": True}
+        self.documents.append(doc)
+        return doc
+
+    def is_open(self, doc):
+        return self.alive and doc["open"] and doc in self.documents
+
+    def snapshot(self, doc):
+        self._enter("snapshot", doc["path"], doc=doc)
+        return len(doc["history"])
+
+    def rollback(self, doc, state):
+        self._enter("rollback", doc["path"], doc=doc)
+        del doc["history"][state:]
+
+    def find_layer(self, doc, layer_name):
+        self._enter("find_layer", doc["path"], layer_name, doc=doc)
+        if layer_name not in self.layers:
+            raise LayerNotFoundError(f"Layer '{layer_name}' not found in PSD.")
+        return layer_name
+
+    def replace_contents(self, doc, layer, image_path):
+        self._enter("replace_contents", doc["path"], image_path, doc=doc)
+        doc["history"] += [f"Replace Contents {layer} {image_path}", "Free Transform"]
+
+    def save_png(self, doc, output_path):
+        self._enter("save_png", doc["path"], output_path, doc=doc)
+        self.saved[output_path] = list(doc["history"])
+
+    def close(self, doc):
+        self._enter("close", doc["path"])
+        doc["open"] = False
+
+
+class SessionManager:
+    """
+    One Photoshop connection plus the template documents it keeps open.
+
+    ``driver_factory`` returns a PhotoshopDriver; it is called again to
+    reconnect after the session dies. At most ``max_documents`` templates stay
+    open (least recently used ones are closed). Photoshop works on one document
+    at a time, so renders are serialised.
+    """
+
+    def __init__(self, driver_factory, max_documents=8, retries=1):
+        self.driver_factory = driver_factory
+        self.max_documents = max_documents
+        self.retries = retries
+        self._driver = None
+        # psd path -> (psd mtime, doc, clean history state, {layer name: layer handle})
+        self._documents = OrderedDict()
+        self._lock = threading.Lock()
+        self.counters = {"connects": 0, "opens": 0, "reuses": 0, "rollbacks": 0, "reconnects": 0}
+
+    def render(self, psd_path, image_path, output_path, layer_name, timer=None):
+        """
+        Place ``image_path`` into ``psd_path``'s smart object and save a PNG.
+        ``image_path`` may be a dict of layer name -> image path to replace several
+        smart objects before the one save (``layer_name`` is then unused).
+        ``timer`` (a metrics.StageTimer) gets the connect/open/replace/save/rollback stages.
+        """
+        with self._lock:
+            attempt = 0
+            while True:
+                try:
+                    return self._render_once(psd_path, image_path, output_path, layer_name, timer)
+                except LayerNotFoundError:
+                    raise
+                except Exception:
+                    if self._driver is not None and self._driver.is_alive():
+                        raise
+                    # Photoshop went away mid-render: start a fresh session.
+                    self._reset()
+                    if attempt >= self.retries:
+                        raise
+                    attempt += 1
+                    self.counters["reconnects"] += 1
+                    print(f"Photoshop session lost, reconnecting (attempt {attempt})")
+
+    def close(self):
+        """Close every kept document (without saving) and drop the connection."""
+        with self._lock:
+            if self._driver is not None and self._driver.is_alive():
+                for _, doc, _, _ in self._documents.values():
+                    try:
+                        self._driver.close(doc)
+                    except Exception as e:
+                        print(f"Failed to close template document: {e}")
+            self._reset()
+
+    def stats(self):
+        return {**self.counters, "open_documents": len(self._documents)}
+
+    def _render_once(self, psd_path, image_path, output_path, layer_name, timer=None):
+        driver = self._connected_driver(timer)
+        doc, clean_state = self._document(psd_path, timer)
+        images = image_path if isinstance(image_path, dict) else {layer_name: image_path}
+        try:
+            with maybe_stage(timer, "replace"):
+                for name, path in images.items():
+                    driver.replace_contents(doc, self._layer(psd_path, doc, name), path)
+            with maybe_stage(timer, "save"):
+                driver.save_png(doc, output_path)
+        finally:
+            with maybe_stage(timer, "rollback"):
+                self._rollback(psd_path, doc, clean_state)
+        return output_path
+
+    def _connected_driver(self, timer=None):
+        if self._driver is None or not self._driver.is_alive():
+            self._reset()
+            with maybe_stage(timer, "connect"):
+                driver = self.driver_factory()
+                driver.connect()
+            self._driver = driver
+            self.counters["connects"] += 1
+        return self._driver
+
+    def _document(self, psd_path, timer=None):
+        """The open document for ``psd_path`` and its clean history state, opening it if needed."""
+        mtime = os.path.getmtime(psd_path) if os.path.exists(psd_path) else None
+        cached = self._documents.get(psd_path)
+        if cached is not None:
+            cached_mtime, doc, state, _ = cached
+            if cached_mtime == mtime and self._driver.is_open(doc):
+                self._documents.move_to_end(psd_path)
+                self.counters["reuses"] += 1
+                return doc, state
+            self._forget(psd_path)
+
+        while len(self._documents) >= self.max_documents:
+            self._forget(next(iter(self._documents)))
+
+        with maybe_stage(timer, "open"):
+            doc = self._driver.open(psd_path)
+            state = self._driver.snapshot(doc)
+        self._documents[psd_path] = (mtime, doc, state, {})
+        self.counters["opens"] += 1
+        return doc, state
+
+    def _layer(self, psd_path, doc, layer_name):
+        """The handle of a layer of an open document, looked up once per document."""
+        layers = self._documents[psd_path][3]
+        if layer_name not in layers:
+            layers[layer_name] = self._driver.find_layer(doc, layer_name)
+        return layers[layer_name]
+
+    def _rollback(self, psd_path, doc, state):
+        try:
+            self._driver.rollback(doc, state)
+            self.counters["rollbacks"] += 1
+        except Exception as e:
+            # The document's state is unknown now; reopen it next time.
+            print(f"History rollback failed for {os.path.basename(psd_path)}: {e}")
+            self._forget(psd_path)
+
+    def _forget(self, psd_path):
+        """Stop tracking a document, closing it if Photoshop still has it open."""
+        _, doc, _, _ = self._documents.pop(psd_path)
+        try:
+            if self._driver.is_open(doc):
+                self._driver.close(doc)
+        except Exception:
+            pass
+
+    def _reset(self):
+        self._driver = None
+        self._documents.clear()
@@ -0,0 +1,119 @@
+"""
+Live preview sessions: re-render a kept upload as the user moves it around.
+
+While a customer drags, scales and rotates their artwork in the editor, the
+client sends a stream of small placement updates over a WebSocket (see the
+/preview endpoint in app.py) instead of uploading the image again for every
+change. A session keeps the decoded upload, resized once per view, and renders
+low-resolution frames from it with psd_renderer.render_image, which only
+re-warps the smart object's box.
+
+Updates arrive far faster than frames can be rendered, so a session:
+
+    coalesces  a burst of updates into one frame: rendering starts once no
+               update came for ``debounce`` seconds, or ``max_frame_age``
+               seconds after the first one at the latest
+    drops      a view's frame (and the rest of a multi-view frame) that an
+               update made stale while it was rendering, unless that view got
+               no frame for ``max_frame_age`` seconds, so every view still
+               shows progress during a long drag
+
+Rendering runs on a worker thread, one frame at a time per session.
+"""
+import asyncio
+import time
+
+import metrics
+from psd_renderer import Placement
+
+DEBOUNCE = 0.03       # seconds without updates before a frame is rendered
+MAX_FRAME_AGE = 0.25  # seconds a moving session can go without a frame
+
+frames_total = metrics.register(metrics.Counter(
+    "mockup_preview_frames_total", "Live preview frames: sent, dropped as stale or failed.", ("outcome",)))
+
+
+def placement_from(message):
+    """A Placement from a client's {"offset": [x, y], "scale": s, "rotation": degrees}. Raises ValueError."""
+    try:
+        offset = message.get("offset", (0.0, 0.0))
+        if len(offset) != 2:
+            raise ValueError("offset must be [x, y]")
+        return Placement(offset, message.get("scale", 1.0), message.get("rotation", 0.0))
+    except (TypeError, AttributeError) as e:
+        raise ValueError(str(e))
+
+
+class PreviewSession:
+    """
+    One user's live preview.
+
+    ``render_frame(view, artwork, placement)`` renders and encodes one view on
+    a worker thread and returns (data, stats); ``send(event, data=None)`` is a
+    coroutine delivering a "frame" event with the encoded image, or an "error" event.
+    """
+
+    def __init__(self, views, render_frame, send, debounce=DEBOUNCE, max_frame_age=MAX_FRAME_AGE):
+        self.views = views
+        self.render_frame = render_frame
+        self.send = send
+        self.debounce = debounce
+        self.max_frame_age = max_frame_age
+        self.artwork = None       # per view, set by set_artwork()
+        self.placement = Placement()
+        self.client_seq = None    # the client's id for the latest update, echoed in its frames
+        self.version = 0          # bumped by every update
+        self.frames = 0
+        self.dropped = 0
+        self._last_sent = {}      # view -> time.monotonic() of its last frame
+        self._changed = asyncio.Event()
+
+    def set_artwork(self, artwork):
+        """A new upload, already resized for each view."""
+        self.artwork = artwork
+        self._update()
+
+    def move(self, placement, client_seq=None):
+        self.placement = placement
+        self.client_seq = client_seq
+        self._update()
+
+    def _update(self):
+        self.version += 1
+        self._changed.set()
+
+    async def _settle(self):
+        """Wait out a burst of updates."""
+        first = time.monotonic()
+        while time.monotonic() - first < self.max_frame_age:
+            self._changed.clear()
+            try:
+                await asyncio.wait_for(self._changed.wait(), self.debounce)
+            except asyncio.TimeoutError:
+                return
+        self._changed.clear()
+
+    async def run(self):
+        """Render frames as updates come in, until cancelled."""
+        loop = asyncio.get_running_loop()
+        while True:
+            await self._changed.wait()
+            await self._settle()
+            if self.artwork is None:
+                continue
+            version, artwork, placement, client_seq = self.version, self.artwork, self.placement, self.client_seq
+            for view in self.views:
+                try:
+                    data, stats = await loop.run_in_executor(None, self.render_frame, view, artwork[view], placement)
+                except Exception as e:
+                    frames_total.inc(outcome="failed")
+                    await self.send({"event": "error", "seq": version, "detail": f"Render error: {e}"})
+                    break
+                if self.version != version and time.monotonic() - self._last_sent.get(view, 0.0) < self.max_frame_age:
+                    self.dropped += 1
+                    frames_total.inc(outcome="dropped")
+                    break  # the next frame is already due
+                await self.send({"event": "frame", "seq": version, "client_seq": client_seq, "dropped": self.dropped, **stats}, data)
+                self._last_sent[view] = time.monotonic()
+                self.frames += 1
+                frames_total.inc(outcome="sent")
@@ -0,0 +1,121 @@
+"""
+Opt-in profiling of a single render.
+
+Aggregate metrics (metrics.py) say which stage is slow, not why. A request
+sent with an admin's ``X-Profile`` header (or a batch run with ``--profile``)
+is profiled from decoding the upload through the render to the encode, in one
+of two formats:
+
+    prof       cProfile statistics, for pstats / snakeviz:
+                   python -m pstats <file>.prof
+    collapsed  stacks sampled every millisecond, one "frame;frame;... count"
+               line per stack, for flamegraph.pl or speedscope
+
+Profiling is a context manager around the work; with ``kind`` None it is a
+no-op, so nothing is hooked or sampled unless a profile was asked for. Both
+profilers only see the thread that entered the context, so a profiled job
+renders and encodes its views on its own thread.
+"""
+import cProfile
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+PROFILE_FORMATS = {"prof": ".prof", "collapsed": ".collapsed.txt"}
+SAMPLE_INTERVAL = 0.001  # seconds between stack samples
+
+
+class StackSampler:
+    """Samples one thread's Python stack on a background thread and counts identical stacks."""
+
+    def __init__(self, thread_id, interval=SAMPLE_INTERVAL):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.counts = {}
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="stack-sampler", daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                continue
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                frame = frame.f_back
+            key = ";".join(reversed(stack))
+            self.counts[key] = self.counts.get(key, 0) + 1
+
+    def write(self, path):
+        with open(path, "w") as f:
+            for stack, count in sorted(self.counts.items(), key=lambda item: -item[1]):
+                f.write(f"{stack} {count}\n")
+
+
+def profile_path(directory, name, kind):
+    """Where a ``kind`` profile called ``name`` is stored."""
+    return os.path.join(directory, f"{name}{PROFILE_FORMATS[kind]}")
+
+
+@contextmanager
+def profile(kind, path):
+    """
+    Profile the calling thread for the duration of the block and write the
+    result to ``path``. ``kind`` is "prof", "collapsed" or None (no profiling).
+    """
+    if kind is None:
+        yield
+        return
+    if kind not in PROFILE_FORMATS:
+        raise ValueError(f"Unknown profile format '{kind}'. Choose one of: {list(PROFILE_FORMATS)}")
+
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    if kind == "prof":
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            yield
+        finally:
+            profiler.disable()
+            profiler.dump_stats(path)
+    else:
+        sampler = StackSampler(threading.get_ident())
+        sampler.start()
+        try:
+            yield
+        finally:
+            sampler.stop()
+            sampler.write(path)
+
+
+def prune(directory, keep):
+    """Delete all but the ``keep`` newest profiles in ``directory``."""
+    try:
+        entries = [entry for entry in os.scandir(directory) if entry.is_file()]
+    except FileNotFoundError:
+        return 0
+    entries.sort(key=lambda entry: entry.stat().st_mtime, reverse=True)
+    removed = 0
+    for entry in entries[keep:]:
+        try:
+            os.unlink(entry.path)
+            removed += 1
+        except OSError:
+            pass
+    return removed
+
+
+def profile_name(label):
+    """A unique, sortable file name stem for a profile of ``label``."""
+    return f"{time.strftime('%Y%m%d-%H%M%S')}_{label}"
@@ -0,0 +1,313 @@
+"""
+Header-only PSD layer index.
+
+Listing a template's layers or finding its ``front_surface`` smart object
+used to mean PSDImage.open(), which reads every layer's channel data. This
+module memory-maps the file and reads only what describes the layers: the
+file header and the layer records of the layer-and-mask section. Image
+resources and all pixel data are skipped over by their length fields, so
+indexing a template takes about a millisecond however large it is.
+
+The index is a JSON-friendly dict:
+
+    {"width", "height", "channels", "depth", "color_mode", "version",
+     "layers": [{"name", "kind", "id", "bbox", "visible", "opacity",
+                 "blend_mode", "clipping", "smart_object", "layers"}, ...]}
+
+``layers`` is the tree top-down (Photoshop's panel order); groups carry their
+children in ``layers``. ``kind`` uses psd-tools' names for group, pixel,
+smartobject, type and shape layers, plus "fill" and "adjustment".
+``smart_object`` is {"id", "transform"} for smart objects, the transform
+being the 8 canvas coordinates of the TL, TR, BR, BL corners.
+
+get_index() keeps indexes in memory by path and, given a directory, as
+``<sha256 of the PSD>.json`` files so they survive restarts. Run directly to
+print a PSD's layer tree:
+
+    python psd_index.py ../psdFiles/mug.psd
+"""
+import json
+import mmap
+import os
+import struct
+import sys
+
+from render_cache import file_digest
+
+INDEX_VERSION = 1
+
+COLOR_MODES = {0: "bitmap", 1: "grayscale", 2: "indexed", 3: "rgb", 4: "cmyk", 7: "multichannel", 8: "duotone", 9: "lab"}
+
+BLEND_MODES = {
+    b"pass": "pass_through", b"norm": "normal", b"diss": "dissolve", b"dark": "darken", b"mul ": "multiply",
+    b"idiv": "color_burn", b"lbrn": "linear_burn", b"dkCl": "darker_color", b"lite": "lighten",
+    b"scrn": "screen", b"div ": "color_dodge", b"lddg": "linear_dodge", b"lgCl": "lighter_color",
+    b"over": "overlay", b"sLit": "soft_light", b"hLit": "hard_light", b"vLit": "vivid_light",
+    b"lLit": "linear_light", b"pLit": "pin_light", b"hMix": "hard_mix", b"diff": "difference",
+    b"smud": "exclusion", b"fsub": "subtract", b"fdiv": "divide", b"hue ": "hue", b"sat ": "saturation",
+    b"colr": "color", b"lum ": "luminosity",
+}
+
+# Additional layer info blocks whose length field is 8 bytes in PSB files
+_BIG_KEYS = {
+    b"LMsk", b"Lr16", b"Lr32", b"Layr", b"Mt16", b"Mt32", b"Mtrn", b"Alph", b"FMsk",
+    b"lnk2", b"lnk3", b"lnkE", b"FEid", b"FXid", b"PxSD", b"pths",
+}
+_SMART_OBJECT_KEYS = (b"SoLd", b"SoLE", b"PlLd")
+_FILL_KEYS = {b"SoCo", b"GdFl", b"PtFl"}
+_VECTOR_KEYS = {b"vmsk", b"vsms", b"vogk"}
+_ADJUSTMENT_KEYS = {
+    b"brit", b"levl", b"curv", b"expA", b"vibA", b"hue ", b"hue2", b"blnc", b"blwh", b"phfl",
+    b"mixr", b"clrL", b"nvrt", b"post", b"thrs", b"grdm", b"selc",
+}
+_KEPT_KEYS = {b"luni", b"lsct", b"lsdk", b"lyid", b"TySh", *_SMART_OBJECT_KEYS, *_FILL_KEYS, *_VECTOR_KEYS, *_ADJUSTMENT_KEYS}
+
+# Section divider types (lsct)
+_GROUP_OPEN, _GROUP_CLOSED, _GROUP_END = 1, 2, 3
+
+
+class PSDFormatError(ValueError):
+    """The file isn't a PSD/PSB, or its layer section can't be read."""
+
+
+def _length(buf, pos, version, big=True):
+    """Read a section length: 4 bytes, or 8 in PSB files when ``big``."""
+    if version == 2 and big:
+        return struct.unpack_from(">Q", buf, pos)[0], pos + 8
+    return struct.unpack_from(">I", buf, pos)[0], pos + 4
+
+
+def _tagged_blocks(buf, pos, end, version, padding=1):
+    """{key: (offset, length)} of the additional layer info blocks between pos and end."""
+    blocks = {}
+    while pos + 12 <= end:
+        signature, key = struct.unpack_from(">4s4s", buf, pos)
+        if signature not in (b"8BIM", b"8B64"):
+            break
+        length, pos = _length(buf, pos + 8, version, key in _BIG_KEYS)
+        if key in _KEPT_KEYS:
+            blocks[key] = (pos, length)
+        pos += length + (-length % padding)
+    return blocks
+
+
+def _read_records(buf, pos, version):
+    """Parse the layer count and layer records starting at ``pos``, bottom layer first."""
+    count = abs(struct.unpack_from(">h", buf, pos)[0])  # negative: first alpha is merged transparency
+    pos += 2
+    channel_size = 6 if version == 1 else 10
+    records = []
+    for _ in range(count):
+        top, left, bottom, right, channels = struct.unpack_from(">4iH", buf, pos)
+        pos += 18 + channels * channel_size
+        signature, blend_mode, opacity, clipping, flags, extra_length = struct.unpack_from(">4s4sBBBxI", buf, pos)
+        if signature != b"8BIM":
+            raise PSDFormatError(f"Bad layer record signature {signature!r}")
+        pos += 16
+        end = pos + extra_length
+
+        mask_length = struct.unpack_from(">I", buf, pos)[0]
+        pos += 4 + mask_length
+        ranges_length = struct.unpack_from(">I", buf, pos)[0]
+        pos += 4 + ranges_length
+        name_length = buf[pos]
+        name = bytes(buf[pos + 1:pos + 1 + name_length]).decode("macroman")
+        pos += (1 + name_length + 3) // 4 * 4
+
+        records.append({
+            "bbox": [left, top, right, bottom],
+            "blend_mode": BLEND_MODES.get(blend_mode, blend_mode.decode("latin-1")),
+            "opacity": opacity,
+            "clipping": clipping == 1,
+            "visible": not flags & 0x02,
+            "name": name,
+            "blocks": _tagged_blocks(buf, pos, end, version),
+        })
+        pos = end
+    return records
+
+
+def _unicode_name(buf, offset):
+    count = struct.unpack_from(">I", buf, offset)[0]
+    return bytes(buf[offset + 4:offset + 4 + count * 2]).decode("utf-16-be").rstrip("\x00")
+
+
+def _smart_object(buf, blocks):
+    """{"id", "transform"} from the placed layer blocks, without decoding whole descriptors."""
+    if b"PlLd" in blocks:
+        offset, _ = blocks[b"PlLd"]
+        id_length = buf[offset + 8]
+        unique_id = bytes(buf[offset + 9:offset + 9 + id_length]).decode("ascii")
+        transform = struct.unpack_from(">8d", buf, offset + 9 + id_length + 16)
+        return {"id": unique_id, "transform": list(transform)}
+
+    # SoLd/SoLE only: pick the two fields out of the descriptor by their keys
+    offset, length = blocks.get(b"SoLd") or blocks[b"SoLE"]
+    end = offset + length
+    smart_object = {"id": None, "transform": None}
+    at = buf.find(b"\x00\x00\x00\x00IdntTEXT", offset, end)
+    if at >= 0:
+        smart_object["id"] = _unicode_name(buf, at + 12)
+    at = buf.find(b"\x00\x00\x00\x00TrnfVlLs", offset, end)
+    if at >= 0 and struct.unpack_from(">I", buf, at + 12)[0] == 8:
+        smart_object["transform"] = [struct.unpack_from(">d", buf, at + 16 + i * 12 + 4)[0] for i in range(8)]
+    return smart_object
+
+
+def _kind(blocks):
+    if b"lsct" in blocks or b"lsdk" in blocks:
+        return "group"
+    if any(key in blocks for key in _SMART_OBJECT_KEYS):
+        return "smartobject"
+    if b"TySh" in blocks:
+        return "type"
+    if any(key in blocks for key in _FILL_KEYS):
+        return "shape" if any(key in blocks for key in _VECTOR_KEYS) else "fill"
+    if any(key in blocks for key in _ADJUSTMENT_KEYS):
+        return "adjustment"
+    return "pixel"
+
+
+def _layer(buf, record):
+    blocks = record.pop("blocks")
+    layer = {"name": record["name"], "kind": _kind(blocks), "id": None, **record}
+    if b"luni" in blocks:
+        layer["name"] = _unicode_name(buf, blocks[b"luni"][0])
+    if b"lyid" in blocks:
+        layer["id"] = struct.unpack_from(">I", buf, blocks[b"lyid"][0])[0]
+    divider = blocks.get(b"lsct") or blocks.get(b"lsdk")
+    layer["divider"] = struct.unpack_from(">I", buf, divider[0])[0] if divider else 0
+    layer["smart_object"] = _smart_object(buf, blocks) if layer["kind"] == "smartobject" else None
+    return layer
+
+
+def _build_tree(layers):
+    """Nest the flat bottom-up record list into groups, top-down."""
+    root = []
+    stack = [root]
+    for layer in reversed(layers):
+        divider = layer.pop("divider")
+        if divider == _GROUP_END:  # the hidden "</Layer group>" record closes the innermost group
+            if len(stack) > 1:
+                stack.pop()
+            continue
+        if divider in (_GROUP_OPEN, _GROUP_CLOSED):
+            layer["layers"] = []
+            stack[-1].append(layer)
+            stack.append(layer["layers"])
+        else:
+            layer["kind"] = "pixel" if layer["kind"] == "group" else layer["kind"]
+            stack[-1].append(layer)
+    return root
+
+
+def parse(buf):
+    """Index a PSD/PSB held in ``buf`` (bytes or an mmap)."""
+    signature, version, channels, height, width, depth, color_mode = struct.unpack_from(">4sH6xHIIHH", buf, 0)
+    if signature != b"8BPS" or version not in (1, 2):
+        raise PSDFormatError("Not a PSD or PSB file")
+    pos = 26
+    color_data_length = struct.unpack_from(">I", buf, pos)[0]
+    pos += 4 + color_data_length
+    resources_length = struct.unpack_from(">I", buf, pos)[0]
+    pos += 4 + resources_length
+
+    section_length, pos = _length(buf, pos, version)
+    section_end = pos + section_length
+    records = []
+    if section_length:
+        info_length, info_pos = _length(buf, pos, version)
+        if info_length:
+            records = _read_records(buf, info_pos, version)
+        else:
+            # 16 and 32 bit documents keep their layers in an Lr16/Lr32 block after the global mask
+            pos = info_pos
+            mask_length = struct.unpack_from(">I", buf, pos)[0]
+            blocks = _tagged_blocks(buf, pos + 4 + mask_length, section_end, version, padding=4)
+            for key in (b"Lr16", b"Lr32", b"Layr"):
+                if key in blocks:
+                    records = _read_records(buf, blocks[key][0], version)
+                    break
+
+    return {
+        "index_version": INDEX_VERSION,
+        "version": version,
+        "width": width,
+        "height": height,
+        "channels": channels,
+        "depth": depth,
+        "color_mode": COLOR_MODES.get(color_mode, color_mode),
+        "layers": _build_tree([_layer(buf, record) for record in records]),
+    }
+
+
+def read_index(psd_path):
+    """Index a PSD file by memory-mapping it; only the pages holding layer records are read."""
+    with open(psd_path, "rb") as f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+            try:
+                return parse(buf)
+            except (struct.error, IndexError, UnicodeDecodeError) as e:
+                raise PSDFormatError(f"Can't read layers of {os.path.basename(psd_path)}: {e}")
+
+
+_indexes = {}
+
+
+def get_index(psd_path, cache_dir=None):
+    """
+    Layer index of ``psd_path``, cached in memory per (size, mtime) and, if
+    ``cache_dir`` is given, on disk per PSD SHA-256.
+    """
+    path = os.path.abspath(psd_path)
+    stat = os.stat(path)
+    signature = (stat.st_size, stat.st_mtime_ns)
+    cached = _indexes.get(path)
+    if cached is not None and cached[0] == signature:
+        return cached[1]
+
+    index = None
+    if cache_dir is not None:
+        cache_path = os.path.join(cache_dir, f"{file_digest(path)}.json")
+        try:
+            with open(cache_path, "r") as f:
+                index = json.load(f)
+            if index.get("index_version") != INDEX_VERSION:
+                index = None
+        except (OSError, ValueError):
+            index = None
+    if index is None:
+        index = read_index(path)
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+            staging = f"{cache_path}.{os.getpid()}.tmp"
+            with open(staging, "w") as f:
+                json.dump(index, f)
+            os.replace(staging, cache_path)
+
+    _indexes[path] = (signature, index)
+    return index
+
+
+def walk(layers, depth=0):
+    """Yield (depth, layer) for every layer in the tree, top-down."""
+    for layer in layers:
+        yield depth, layer
+        yield from walk(layer.get("layers", ()), depth + 1)
+
+
+def find_layer(index, name, kind=None):
+    """The first layer called ``name`` (of ``kind``, if given) anywhere in the tree, or None."""
+    for _, layer in walk(index["layers"]):
+        if layer["name"] == name and (kind is None or layer["kind"] == kind):
+            return layer
+    return None
+
+
+if __name__ == "__main__":
+    for psd_path in sys.argv[1:]:
+        index = read_index(psd_path)
+        print(f"{psd_path}: {index['width']}x{index['height']} {index['color_mode']} {index['depth']}-bit")
+        for depth, layer in walk(index["layers"]):
+            smart_object = f" | smart object {layer['smart_object']['id']}" if layer["smart_object"] else ""
+            print(f"{'  ' * (depth + 1)}- '{layer['name']}' | {layer['kind']} | {layer['bbox']}{smart_object}")
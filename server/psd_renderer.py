@@ -0,0 +1,1009 @@
+"""
+Headless mockup renderer built on psd-tools and NumPy.
+
+Instead of driving Photoshop over COM, the template PSD is split around its
+smart object layer: the layers below it are flattened into a background, the
+layers above it (shading, highlights, cut-outs) into an overlay, and the
+uploaded image is warped onto the smart object's transform box and blended in
+between. Runs anywhere numpy, Pillow and psd-tools install, no Photoshop needed.
+
+Layers above the smart object that don't blend normally (multiply shading,
+screen highlights, layers clipped to the smart object) can't be flattened on
+their own; they are kept as separate Overlays and applied one by one with
+blend_modes.py.
+
+A template can also fill several smart objects at once (a front and a back
+print area): everything above the lowest of them is kept as Overlays, with an
+ArtworkSlot at each smart object's place in the stack, and every input is
+blended in at its slot in the same composite.
+"""
+import os
+import threading
+
+import numpy as np
+from PIL import Image
+from psd_tools import PSDImage
+from psd_tools.constants import BlendMode, Tag
+
+import blend_modes
+import psd_index
+from metrics import maybe_stage
+
+LAYER_NAME = "front_surface"
+
+
+class MockupTemplate:
+    """A PSD template split around its smart object, ready to composite."""
+
+    def __init__(self, canvas_size, below, above, quad, mask, content_size, warp=None, overlays=None,
+                 layer_names=None, background=None):
+        self.canvas_size = canvas_size    # (width, height) of the PSD canvas
+        self.below = below                # HxWx4 float32, premultiplied RGBA
+        self.above = above                # HxWx4 float32, premultiplied RGBA (None with overlays)
+        self.quad = quad                  # 4x2 float64: TL, TR, BR, BL in canvas px
+        self.mask = mask                  # HxW float32 coverage of the smart object
+        self.content_size = content_size  # (width, height) of the embedded content
+        self.warp = warp                  # WarpGrid of the smart object's mesh warp, if any
+        self.overlays = overlays          # Overlays, bottom to top, instead of ``above``
+        # Smart objects filled, in the order inputs map to them; quad, mask and warp are the first one's
+        self.layer_names = layer_names or [LAYER_NAME]
+        # HxWx4 uint8 canvas without artwork (see flatten_background()), stored with compiled bundles
+        self.background = background
+
+    @property
+    def region(self):
+        """Canvas box (left, top, right, bottom) the smart object can touch."""
+        return _quad_box(self.quad, self.canvas_size)
+
+    @property
+    def slots(self):
+        """The ArtworkSlots of a template filling several smart objects (empty otherwise)."""
+        return [overlay for overlay in self.overlays or () if isinstance(overlay, ArtworkSlot)]
+
+    def above_coverage(self):
+        """HxW float32 alpha of everything above the smart object."""
+        if self.overlays is None:
+            return np.asarray(self.above[..., 3])
+        coverage = np.zeros(self.mask.shape, dtype=np.float32)
+        for overlay in self.overlays:
+            if overlay.clip is None:
+                left, top, right, bottom = overlay.box
+                alpha = overlay.pixels[..., 3] * overlay.opacity
+                region = coverage[top:bottom, left:right]
+                region += alpha * (1.0 - region)
+        return coverage
+
+
+class Overlay:
+    """A layer (or isolated group) above the smart object, kept apart to blend it with its own mode."""
+
+    def __init__(self, box, pixels, blend_mode, opacity=1.0, clip=None):
+        self.box = box                # (left, top, right, bottom) on the canvas
+        self.pixels = pixels          # HxWx4 float32, premultiplied RGBA covering ``box``
+        self.blend_mode = blend_mode  # a blend_modes.BLEND_FUNCS name
+        self.opacity = opacity        # 0-1, on top of the opacity already in ``pixels``
+        self.clip = clip              # "artwork" if clipped to the smart object, else None
+
+
+class ArtworkSlot:
+    """
+    One of several smart objects a template fills, kept among its Overlays at
+    its place in the layer stack. Compositing blends in the input placed for
+    ``layer_name``, or the smart object's own ``content`` when there is none.
+    """
+
+    blend_mode = "normal"
+    opacity = 1.0
+    clip = None
+
+    def __init__(self, layer_name, quad, mask, content_size, warp, content):
+        self.layer_name = layer_name
+        self.box = warp.box               # (left, top, right, bottom) on the canvas
+        self.quad = quad                  # 4x2 float64 transform box
+        self.mask = mask                  # HxW float32 coverage of the smart object over ``box``
+        self.content_size = content_size  # (width, height) of the embedded content
+        self.warp = warp                  # WarpGrid placing an input over ``box``
+        self.content = content            # HxWx4 premultiplied RGBA of the layer as saved, over ``box``
+
+    @property
+    def pixels(self):
+        return self.content
+
+
+class WarpGrid:
+    """
+    Where each canvas pixel in ``box`` samples the artwork from.
+
+    ``map_x``/``map_y`` are float32 source pixel coordinates in an artwork that
+    has been resized to ``source_size``; one ``remap`` call places it.
+    """
+
+    def __init__(self, box, map_x, map_y, source_size):
+        self.box = box                  # (left, top, right, bottom) on the canvas
+        self.map_x = map_x              # HxW float32
+        self.map_y = map_y              # HxW float32
+        self.source_size = source_size  # (width, height) to resize the artwork to
+
+
+class Placement:
+    """
+    Where the user put the artwork inside the smart object, as in an editor.
+
+    ``offset`` moves it by fractions of the smart object's width and height,
+    ``scale`` resizes and ``rotation`` turns it (degrees, clockwise) about the
+    centre. The default placement fills the smart object like a plain render.
+    """
+
+    def __init__(self, offset=(0.0, 0.0), scale=1.0, rotation=0.0):
+        self.offset = (float(offset[0]), float(offset[1]))
+        self.scale = float(scale)
+        self.rotation = float(rotation)
+        if not self.scale > 0:
+            raise ValueError("scale must be greater than 0")
+
+    @property
+    def is_default(self):
+        return self.offset == (0.0, 0.0) and self.scale == 1.0 and self.rotation % 360 == 0
+
+    def to_dict(self):
+        return {"offset": list(self.offset), "scale": self.scale, "rotation": self.rotation}
+
+
+def find_smart_object(psd, layer_name):
+    """Return the smart object layer called ``layer_name``, searching all groups."""
+    for layer in psd.descendants():
+        if layer.name == layer_name and layer.kind == "smartobject":
+            return layer
+    return None
+
+
+def placed_layer_descriptor(layer):
+    """Return the smart object's placement descriptor ('SoLd') as a dict."""
+    for key in (Tag.SMART_OBJECT_LAYER_DATA1, Tag.SMART_OBJECT_LAYER_DATA2):
+        data = layer.tagged_blocks.get_data(key)
+        if data is not None:
+            return data.data
+    return {}
+
+
+def to_premultiplied(image):
+    """Convert a PIL image to an HxWx4 float32 premultiplied RGBA array."""
+    rgba = np.asarray(image.convert("RGBA"), dtype=np.float32) / 255.0
+    rgba[..., :3] *= rgba[..., 3:4]
+    return rgba
+
+
+def unpremultiply_to_uint8(rgba):
+    """Convert a premultiplied float32 RGBA array to straight HxWx4 uint8."""
+    alpha = rgba[..., 3:4]
+    rgb = np.divide(rgba[..., :3], alpha, out=np.zeros_like(rgba[..., :3]), where=alpha > 0)
+    out = np.concatenate([rgb, alpha], axis=-1)
+    return np.clip(out * 255.0 + 0.5, 0, 255).astype(np.uint8)
+
+
+def from_premultiplied(rgba):
+    """Convert a premultiplied float32 RGBA array back to a PIL RGBA image."""
+    return Image.fromarray(unpremultiply_to_uint8(rgba), "RGBA")
+
+
+def _layer_coverage(layer, canvas_size):
+    """Rasterise a layer's shape (and layer mask) into a full-canvas HxW array."""
+    width, height = canvas_size
+    coverage = np.zeros((height, width), dtype=np.float32)
+    pixels = layer.topil()
+    if pixels is None:
+        return coverage
+
+    left, top, right, bottom = layer.bbox
+    alpha = np.asarray(pixels.getchannel("A"), dtype=np.float32) / 255.0
+    x0, y0 = max(left, 0), max(top, 0)
+    x1, y1 = min(right, width), min(bottom, height)
+    coverage[y0:y1, x0:x1] = alpha[y0 - top:y1 - top, x0 - left:x1 - left]
+    # Placeholder art is often semi-transparent; only its shape matters here.
+    covered = coverage[coverage > 0]
+    if covered.size:
+        coverage = np.minimum(coverage / np.median(covered), 1.0)
+
+    if layer.has_mask() and not layer.mask.disabled:
+        mask = np.full((height, width), layer.mask.background_color / 255.0, dtype=np.float32)
+        mask_image = layer.mask.topil()
+        if mask_image is not None:
+            m_left, m_top, m_right, m_bottom = layer.mask.bbox
+            mx0, my0 = max(m_left, 0), max(m_top, 0)
+            mx1, my1 = min(m_right, width), min(m_bottom, height)
+            values = np.asarray(mask_image, dtype=np.float32) / 255.0
+            mask[my0:my1, mx0:mx1] = values[my0 - m_top:my1 - m_top, mx0 - m_left:mx1 - m_left]
+        coverage *= mask
+    return coverage
+
+
+def _blend_units(psd, targets, layers):
+    """
+    What each of ``layers`` blends onto the canvas as: the layer itself, or its
+    outermost ancestor group with a blend mode other than pass-through. Layers
+    clipped to another layer come with their base and are skipped, and no group
+    holding one of the smart objects ``targets`` is taken as a whole.
+    """
+    units = []
+    for layer in layers:
+        if layer.clipping or not layer.is_visible():
+            continue
+        unit, parent = layer, layer.parent
+        while parent is not None and parent is not psd:
+            if parent.blend_mode != BlendMode.PASS_THROUGH:
+                unit = parent
+            parent = parent.parent
+        if unit is not layer and any(child is target for child in unit.descendants() for target in targets):
+            unit = layer
+        if not units or units[-1] is not unit:
+            units.append(unit)
+    return units
+
+
+def _overlay(unit, canvas_size, clip=None):
+    """An Overlay from a psd-tools layer or group: its mask, clipped layers and opacity applied."""
+    width, height = canvas_size
+    left, top, right, bottom = unit.bbox
+    box = (max(left, 0), max(top, 0), min(right, width), min(bottom, height))
+    if box[2] <= box[0] or box[3] <= box[1]:
+        return None
+    pixels = unit.composite(viewport=box)
+    if pixels is None:
+        return None
+    # Opacity of pass-through groups around the layer isn't part of its own composite
+    opacity, parent = 1.0, unit.parent
+    while parent is not None and getattr(parent, "parent", None) is not None:
+        opacity *= parent.opacity / 255.0
+        parent = parent.parent
+    return Overlay(box, to_premultiplied(pixels), blend_modes.layer_blend_mode(unit), opacity, clip)
+
+
+def _overlays_above(psd, target, layers):
+    """
+    The layers above the smart object as Overlays, or None when they all blend
+    normally and can be flattened into a single ``above`` layer.
+    """
+    artwork_clips = [layer for layer in target.clip_layers if layer.is_visible()]
+    units = _blend_units(psd, [target], layers)
+    modes = [blend_modes.layer_blend_mode(unit) for unit in units + artwork_clips]
+    if not artwork_clips and all(mode == "normal" for mode in modes):
+        return None
+    unsupported = sorted({mode for mode in modes if mode not in blend_modes.BLEND_FUNCS})
+    if unsupported:
+        print(f"Blend modes {unsupported} are not supported, flattening the layers above the smart object")
+        return None
+
+    overlays = [_overlay(layer, psd.size, clip="artwork") for layer in artwork_clips]
+    overlays += [_overlay(unit, psd.size) for unit in units]
+    return [overlay for overlay in overlays if overlay is not None]
+
+
+def layer_names(layer_name):
+    """``layer_name`` as a list: a single smart object's name, or the names of several."""
+    return [layer_name] if isinstance(layer_name, str) else list(layer_name)
+
+
+def layer_key(layer_name):
+    """A hashable, JSON-friendly key for ``layer_name``; a single name stays a plain string."""
+    names = layer_names(layer_name)
+    return names[0] if len(names) == 1 else tuple(names)
+
+
+def load_template(psd_path, layer_name=LAYER_NAME):
+    """
+    Parse a PSD and split it around the smart object called ``layer_name``, or
+    around every smart object in a list of names (see split_slots()).
+    """
+    psd = PSDImage.open(psd_path)
+    targets = []
+    for name in layer_names(layer_name):
+        target = find_smart_object(psd, name)
+        if target is None:
+            raise ValueError(f"Smart object layer '{name}' not found in {os.path.basename(psd_path)}")
+        targets.append(target)
+    if len(targets) == 1:
+        return split_template(psd, targets[0])
+    return split_slots(psd, targets)
+
+
+def _placement(target, canvas_size):
+    """A smart object's transform quad, content size, coverage and warp mesh (or None)."""
+    import warp_mesh  # imports this module
+
+    quad = np.array(target.smart_object.transform_box, dtype=np.float64).reshape(4, 2)
+    size = placed_layer_descriptor(target).get(b"Sz  ", {})
+    content_size = (int(size.get(b"Wdth", target.width)), int(size.get(b"Hght", target.height)))
+    mask = _layer_coverage(target, canvas_size)
+    return quad, content_size, mask, warp_mesh.mesh_grid(target, quad, canvas_size, content_size)
+
+
+def _slot(target, canvas_size):
+    quad, content_size, mask, warp = _placement(target, canvas_size)
+    warp = warp or _perspective_grid(quad, _quad_box(quad, canvas_size))
+    left, top, right, bottom = warp.box
+    content = target.composite(viewport=warp.box)
+    if content is None:
+        content = np.zeros((bottom - top, right - left, 4), dtype=np.float32)
+    else:
+        content = to_premultiplied(content)
+    return ArtworkSlot(
+        target.name, quad, np.ascontiguousarray(mask[top:bottom, left:right]), content_size, warp, content
+    )
+
+
+def split_slots(psd, targets):
+    """
+    Split an opened ``psd`` for filling all of the smart objects ``targets`` in
+    one pass: the layers under the lowest one are flattened, everything above
+    it becomes Overlays with an ArtworkSlot in place of each smart object.
+    """
+    pixel_layers = [layer for layer in psd.descendants() if not layer.is_group()]
+    position = min(pixel_layers.index(target) for target in targets)
+    below_ids = {id(layer) for layer in pixel_layers[:position]}
+    below = to_premultiplied(psd.composite(
+        layer_filter=lambda layer: layer.is_visible() and (layer.is_group() or id(layer) in below_ids), force=True
+    ))
+
+    slots = {id(target): _slot(target, psd.size) for target in targets}
+    overlays = []
+    for unit in _blend_units(psd, targets, pixel_layers[position:]):
+        if id(unit) in slots:
+            overlays += [_overlay(layer, psd.size, clip=unit.name) for layer in unit.clip_layers if layer.is_visible()]
+            overlays.append(slots[id(unit)])
+        else:
+            overlays.append(_overlay(unit, psd.size))
+    overlays = [overlay for overlay in overlays if overlay is not None]
+    unsupported = sorted({overlay.blend_mode for overlay in overlays} - set(blend_modes.BLEND_FUNCS))
+    if unsupported:
+        print(f"Blend modes {unsupported} are not supported, blending those layers normally")
+        for overlay in overlays:
+            if overlay.blend_mode not in blend_modes.BLEND_FUNCS:
+                overlay.blend_mode = "normal"
+
+    quad, content_size, mask, warp = _placement(targets[0], psd.size)
+    return MockupTemplate(
+        canvas_size=psd.size,
+        below=below,
+        above=None,
+        quad=quad,
+        mask=mask,
+        content_size=content_size,
+        warp=warp,
+        overlays=overlays,
+        layer_names=[target.name for target in targets],
+    )
+
+
+def split_template(psd, target):
+    """Split an opened ``psd`` around its smart object layer ``target``."""
+    pixel_layers = [layer for layer in psd.descendants() if not layer.is_group()]
+    position = pixel_layers.index(target)
+    below_ids = {id(layer) for layer in pixel_layers[:position]}
+    above_ids = {id(layer) for layer in pixel_layers[position + 1:]}
+
+    def only(ids):
+        return lambda layer: layer.is_visible() and (layer.is_group() or id(layer) in ids)
+
+    overlays = _overlays_above(psd, target, pixel_layers[position + 1:])
+    below = to_premultiplied(psd.composite(layer_filter=only(below_ids), force=True))
+    above = None
+    if overlays is None:
+        above = to_premultiplied(psd.composite(layer_filter=only(above_ids), force=True))
+
+    quad, content_size, mask, warp = _placement(target, psd.size)
+    return MockupTemplate(
+        canvas_size=psd.size,
+        below=below,
+        above=above,
+        quad=quad,
+        mask=mask,
+        content_size=content_size,
+        warp=warp,
+        overlays=overlays,
+        layer_names=[target.name],
+    )
+
+
+_template_cache = {}
+
+
+def get_template(psd_path, layer_name=LAYER_NAME):
+    """Load a template once per process, reloading it if the PSD changes on disk."""
+    key = (os.path.abspath(psd_path), layer_key(layer_name))
+    mtime = os.path.getmtime(psd_path)
+    cached = _template_cache.get(key)
+    if cached is None or cached[0] != mtime:
+        cached = (mtime, load_template(psd_path, layer_name))
+        _template_cache[key] = cached
+    return cached[1]
+
+
+def quad_homography(quad, width, height):
+    """
+    Return the 3x3 matrix mapping canvas coordinates inside ``quad`` back to
+    source coordinates in a ``width`` x ``height`` image (inverse mapping).
+    """
+    source = np.array([[0, 0], [width, 0], [width, height], [0, height]], dtype=np.float64)
+    rows, rhs = [], []
+    for (x, y), (u, v) in zip(quad, source):
+        rows.append([x, y, 1, 0, 0, 0, -u * x, -u * y])
+        rows.append([0, 0, 0, x, y, 1, -v * x, -v * y])
+        rhs.extend([u, v])
+    h = np.linalg.solve(np.array(rows), np.array(rhs))
+    return np.append(h, 1.0).reshape(3, 3)
+
+
+def homography_grid(matrix, box):
+    """Source sampling coordinates for every pixel centre in canvas ``box``."""
+    left, top, right, bottom = box
+    xs = np.arange(left, right, dtype=np.float64) + 0.5
+    ys = np.arange(top, bottom, dtype=np.float64) + 0.5
+    x, y = np.meshgrid(xs, ys)
+    w = matrix[2, 0] * x + matrix[2, 1] * y + matrix[2, 2]
+    u = (matrix[0, 0] * x + matrix[0, 1] * y + matrix[0, 2]) / w
+    v = (matrix[1, 0] * x + matrix[1, 1] * y + matrix[1, 2]) / w
+    return u.astype(np.float32), v.astype(np.float32)
+
+
+def remap(src, map_x, map_y):
+    """
+    Bilinear gather of ``src`` (HxWxC) at float pixel coordinates.
+
+    Samples outside the source come back fully transparent, so the edges of the
+    placed artwork are anti-aliased instead of smeared.
+    """
+    height, width = src.shape[:2]
+    padded = np.pad(src, ((1, 1), (1, 1), (0, 0)))
+    x = np.clip(map_x - 0.5, -1.0, width) + 1.0
+    y = np.clip(map_y - 0.5, -1.0, height) + 1.0
+    x0 = np.floor(x).astype(np.intp)
+    y0 = np.floor(y).astype(np.intp)
+    fx = (x - x0).astype(np.float32)[..., None]  # keep the blend in float32
+    fy = (y - y0).astype(np.float32)[..., None]
+    x1 = np.minimum(x0 + 1, width + 1)
+    y1 = np.minimum(y0 + 1, height + 1)
+    top = padded[y0, x0] * (1 - fx) + padded[y0, x1] * fx
+    bottom = padded[y1, x0] * (1 - fx) + padded[y1, x1] * fx
+    return top * (1 - fy) + bottom * fy
+
+
+def _intersect(box, other):
+    """Slices of ``box``-relative and ``other``-relative arrays covering both boxes, or None."""
+    left, top = max(box[0], other[0]), max(box[1], other[1])
+    right, bottom = min(box[2], other[2]), min(box[3], other[3])
+    if right <= left or bottom <= top:
+        return None
+    return (
+        (slice(top - box[1], bottom - box[1]), slice(left - box[0], right - box[0])),
+        (slice(top - other[1], bottom - other[1]), slice(left - other[0], right - other[0])),
+    )
+
+
+def apply_overlays(overlays, region, box, clip=None, scratch=None, artwork=None):
+    """
+    Blend the ``overlays`` with the given ``clip`` onto ``region`` (premultiplied, covering ``box``).
+    ArtworkSlots blend the placed input in ``artwork`` (layer name -> premultiplied array over the
+    slot's box) if there is one.
+    """
+    for overlay in overlays:
+        if overlay.clip != clip:
+            continue
+        slices = _intersect(box, overlay.box)
+        if slices is None:
+            continue
+        target, source = slices
+        pixels = overlay.pixels
+        if artwork is not None and isinstance(overlay, ArtworkSlot):
+            pixels = artwork.get(overlay.layer_name, pixels)
+        apply = blend_modes.blend_clipped if clip is not None else blend_modes.blend
+        apply(region[target], pixels[source], overlay.blend_mode, overlay.opacity, scratch=scratch)
+    return region
+
+
+def composite(template, placed, box):
+    """
+    Blend ``placed`` (premultiplied artwork covering ``box``) between the
+    template's background and overlay and return the full premultiplied canvas.
+    For a template with ArtworkSlots, ``placed`` is a dict from place_slots() and
+    ``box`` is unused.
+    """
+    if template.slots:
+        width, height = template.canvas_size
+        return apply_overlays(template.overlays, template.below.copy(), (0, 0, width, height), artwork=placed)
+    left, top, right, bottom = box
+    canvas = template.below.copy()
+    region = canvas[top:bottom, left:right]
+    placed = placed * template.mask[top:bottom, left:right, None]
+    if template.overlays is not None:
+        apply_overlays(template.overlays, placed, box, clip="artwork")
+    region *= 1.0 - placed[..., 3:4]
+    region += placed
+
+    if template.overlays is not None:
+        width, height = template.canvas_size
+        return apply_overlays(template.overlays, canvas, (0, 0, width, height))
+    above = template.above
+    canvas *= 1.0 - above[..., 3:4]
+    canvas += above
+    return canvas
+
+
+class RegionCompositor:
+    """
+    Composites a template by re-blending only the smart object's box.
+
+    Everything outside ``box`` is the same for every render of a template, so
+    the background and overlay are flattened once into an 8-bit canvas. A
+    render blends the placed artwork with the background and overlay slices of
+    the box, converts just that region to 8 bits and writes it into an output
+    canvas that each thread reuses between renders: per-render work and
+    allocations are proportional to the box, not the canvas.
+
+    Templates with Overlays blend them onto the box's slice one by one instead
+    of a single flattened overlay. Where the background is opaque across the
+    box, as in a photographed mockup, the overlays that aren't clipped to the
+    artwork are blended after the 8-bit conversion with blend_modes.blend_uint8(),
+    from 8-bit copies of their slices made here: fixed point and table lookups,
+    within a level or two of the float path per overlay, as Photoshop itself blends an
+    8-bit document. Otherwise they go through the float path.
+    """
+
+    def __init__(self, template, box):
+        self.template = template
+        self.box = box
+        left, top, right, bottom = box
+        # Views, not copies: a bundle's arrays are mapped once and shared by every process
+        self.below = template.below[top:bottom, left:right]
+        self.mask = template.mask[top:bottom, left:right, None]
+        self.overlays = template.overlays
+        if self.overlays is None:
+            self.above = template.above[top:bottom, left:right]
+            self.above_keep = 1.0 - self.above[..., 3:4]
+        self.background = _background(template)
+        self.overlays8 = None
+        if self.overlays is not None and np.all(self.below[..., 3] == 1.0):
+            self.overlays8 = _overlays_uint8(self.overlays, box)
+        self._local = threading.local()
+
+    def _buffers(self):
+        local = self._local
+        if getattr(local, "canvas", None) is None:
+            local.canvas = self.background.copy()
+            local.region = np.empty_like(self.below)
+            local.keep = np.empty_like(self.mask)
+            local.scratch = blend_modes.Scratch()
+        return local.canvas, local.region, local.keep
+
+    def render(self, placed):
+        """
+        Blend ``placed`` (premultiplied artwork covering the box, modified in place)
+        and return the flattened canvas as a PIL image.
+
+        The image shares memory with this thread's output canvas: encode or copy it
+        before the same thread renders this template again.
+        """
+        canvas, region, keep = self._buffers()
+        left, top, right, bottom = self.box
+        placed *= self.mask
+        if self.overlays is not None:
+            apply_overlays(self.overlays, placed, self.box, "artwork", self._local.scratch)
+        np.subtract(1.0, placed[..., 3:4], out=keep)
+        np.multiply(self.below, keep, out=region)
+        region += placed
+        if self.overlays is None:
+            region *= self.above_keep
+            region += self.above
+        elif self.overlays8 is None:
+            apply_overlays(self.overlays, region, self.box, scratch=self._local.scratch)
+        canvas[top:bottom, left:right] = unpremultiply_to_uint8(region)
+        if self.overlays8 is not None:
+            out = canvas[top:bottom, left:right]
+            for target, pixels, mode, opacity in self.overlays8:
+                blend_modes.blend_uint8(out[target], pixels, mode, opacity, scratch=self._local.scratch)
+        return Image.fromarray(canvas, "RGBA")
+
+
+def _overlays_uint8(overlays, box):
+    """(target slices, straight uint8 pixels, mode, 0-255 opacity) of the unclipped ``overlays`` over ``box``."""
+    prepared = []
+    for overlay in overlays:
+        if overlay.clip is not None:
+            continue
+        slices = _intersect(box, overlay.box)
+        if slices is None:
+            continue
+        target, source = slices
+        opacity = int(round(overlay.opacity * 255))
+        prepared.append((target, unpremultiply_to_uint8(overlay.pixels[source]), overlay.blend_mode, opacity))
+    return prepared
+
+
+class SlotCompositor(RegionCompositor):
+    """
+    RegionCompositor for a template with ArtworkSlots: each slot's box is
+    recomposited from the background up through every overlay and slot, and
+    the rest of the canvas is flattened once with the smart objects' own content.
+    Boxes that overlap are simply composited twice, to the same result.
+    """
+
+    def __init__(self, template, box=None):
+        self.template = template
+        self.overlays = template.overlays
+        self.boxes = list(dict.fromkeys(tuple(slot.box) for slot in template.slots))
+        self.below = template.below
+        self.background = _background(template)
+        self._local = threading.local()
+
+    def _buffers(self):
+        local = self._local
+        if getattr(local, "canvas", None) is None:
+            local.canvas = self.background.copy()
+            local.scratch = blend_modes.Scratch()
+        return local.canvas
+
+    def render(self, placed):
+        """Blend ``placed`` (place_slots()) and return the flattened canvas, as RegionCompositor.render."""
+        canvas = self._buffers()
+        for box in self.boxes:
+            left, top, right, bottom = box
+            region = np.array(self.below[top:bottom, left:right])
+            apply_overlays(self.overlays, region, box, scratch=self._local.scratch, artwork=placed)
+            canvas[top:bottom, left:right] = unpremultiply_to_uint8(region)
+        return Image.fromarray(canvas, "RGBA")
+
+
+def flatten_background(template):
+    """The canvas without artwork as 8-bit RGBA: what every render of ``template`` starts from."""
+    if template.overlays is None:
+        above = template.above
+        return unpremultiply_to_uint8(template.below * (1.0 - above[..., 3:4]) + above)
+    width, height = template.canvas_size
+    return unpremultiply_to_uint8(apply_overlays(template.overlays, np.array(template.below), (0, 0, width, height)))
+
+
+def _background(template):
+    return template.background if template.background is not None else flatten_background(template)
+
+
+_compositors = {}
+_compositors_lock = threading.Lock()
+
+
+def get_compositor(template, box):
+    """
+    The RegionCompositor of ``template`` for the smart object box ``box``, built once
+    (a SlotCompositor, whatever ``box``, for a template with ArtworkSlots).
+    """
+    slots = bool(template.slots)
+    key = (id(template), None if slots else tuple(box))
+    cached = _compositors.get(key)
+    if cached is None or cached.template is not template:
+        with _compositors_lock:
+            cached = _compositors.get(key)
+            if cached is None or cached.template is not template:
+                cached = SlotCompositor(template) if slots else RegionCompositor(template, tuple(box))
+                _compositors[key] = cached
+    return cached
+
+
+def drop_compositors(template):
+    """Forget ``template``'s compositors and their per-thread buffers, e.g. once it is unloaded."""
+    with _compositors_lock:
+        for key in [key for key, compositor in _compositors.items() if compositor.template is template]:
+            del _compositors[key]
+
+
+def _quad_box(quad, canvas_size):
+    """Canvas box (left, top, right, bottom) covering ``quad``."""
+    width, height = canvas_size
+    left, top = np.floor(quad.min(axis=0)).astype(int)
+    right, bottom = np.ceil(quad.max(axis=0)).astype(int)
+    return max(int(left), 0), max(int(top), 0), min(int(right), width), min(int(bottom), height)
+
+
+def _quad_extent(quad):
+    """Width and height of the quad's bounding box, in whole pixels."""
+    return max(int(np.ceil(np.ptp(quad[:, 0]))), 1), max(int(np.ceil(np.ptp(quad[:, 1]))), 1)
+
+
+def perspective_grid(template):
+    """WarpGrid that maps the artwork onto the template's transform quad."""
+    return _perspective_grid(template.quad, template.region)
+
+
+def _perspective_grid(quad, box):
+    # Resample to the quad's on-canvas size first so the gather never minifies.
+    width, height = _quad_extent(quad)
+    matrix = quad_homography(quad, width, height)
+    map_x, map_y = homography_grid(matrix, box)
+    return WarpGrid(box, map_x, map_y, (width, height))
+
+
+def load_warp_lut(lut_path):
+    """Load a calibrated remap LUT written by analyze_warp.py as a WarpGrid."""
+    with np.load(lut_path) as lut:
+        return WarpGrid(
+            box=tuple(int(v) for v in lut["box"]),
+            map_x=lut["map_x"],
+            map_y=lut["map_y"],
+            source_size=tuple(int(v) for v in lut["source_size"]),
+        )
+
+
+_lut_cache = {}
+
+
+def get_warp_lut(lut_path, scale=None):
+    """
+    Load a LUT once per process; returns None if no LUT exists for the template.
+    ``scale`` (x, y) gives the LUT for a downscaled preview level of the canvas.
+    """
+    if not os.path.exists(lut_path):
+        return None
+    key = (lut_path, scale)
+    mtime = os.path.getmtime(lut_path)
+    cached = _lut_cache.get(key)
+    if cached is None or cached[0] != mtime:
+        warp = load_warp_lut(lut_path) if scale is None else scale_warp(get_warp_lut(lut_path), scale)
+        cached = (mtime, warp)
+        _lut_cache[key] = cached
+    return cached[1]
+
+
+def _shrink(array, size):
+    """Area-average an HxW or HxWxC float32 array down to ``size`` (width, height)."""
+    if array.ndim == 3:
+        return np.stack([_shrink(array[..., c], size) for c in range(array.shape[2])], axis=-1)
+    plane = Image.fromarray(np.ascontiguousarray(array, dtype=np.float32), "F")
+    return np.asarray(plane.resize(size, Image.BOX), dtype=np.float32)
+
+
+def _sample(plane, xs, ys):
+    """Bilinear samples of an HxW array at the grid of pixel coordinates ``xs`` x ``ys``."""
+    height, width = plane.shape
+    xs = np.clip(xs, 0, width - 1)
+    ys = np.clip(ys, 0, height - 1)
+    x0 = np.minimum(np.floor(xs).astype(np.intp), width - 2) if width > 1 else np.zeros(len(xs), np.intp)
+    y0 = np.minimum(np.floor(ys).astype(np.intp), height - 2) if height > 1 else np.zeros(len(ys), np.intp)
+    x1 = np.minimum(x0 + 1, width - 1)
+    y1 = np.minimum(y0 + 1, height - 1)
+    fx = (xs - x0)[None, :]
+    fy = (ys - y0)[:, None]
+    top = plane[y0][:, x0] * (1 - fx) + plane[y0][:, x1] * fx
+    bottom = plane[y1][:, x0] * (1 - fx) + plane[y1][:, x1] * fx
+    return (top * (1 - fy) + bottom * fy).astype(np.float32)
+
+
+def scale_warp(warp, scale):
+    """
+    The WarpGrid for a canvas scaled by ``scale`` (x, y): the box shrinks with the
+    canvas, and the artwork is resampled to a proportionally smaller source size.
+    """
+    sx, sy = scale
+    left, top, right, bottom = warp.box
+    box_left, box_top = int(np.floor(left * sx)), int(np.floor(top * sy))
+    box = (box_left, box_top, max(int(np.ceil(right * sx)), box_left + 1), max(int(np.ceil(bottom * sy)), box_top + 1))
+    source_size = (max(int(round(warp.source_size[0] * sx)), 1), max(int(round(warp.source_size[1] * sy)), 1))
+
+    # Centres of the level's pixels, in the full-resolution grid's pixel coordinates
+    xs = (np.arange(box[0], box[2]) + 0.5) / sx - 0.5 - left
+    ys = (np.arange(box[1], box[3]) + 0.5) / sy - 0.5 - top
+    fx = source_size[0] / warp.source_size[0]
+    fy = source_size[1] / warp.source_size[1]
+    return WarpGrid(
+        box=box,
+        map_x=_sample(np.asarray(warp.map_x), xs, ys) * np.float32(fx),
+        map_y=_sample(np.asarray(warp.map_y), xs, ys) * np.float32(fy),
+        source_size=source_size,
+    )
+
+
+def scale_template(template, size):
+    """
+    A copy of ``template`` downscaled to a ``size`` (width, height) canvas, for previews.
+
+    The layers are area-averaged (they are premultiplied, so edges stay clean) and
+    the placement is always stored as a WarpGrid, so a preview render doesn't have
+    to evaluate the transform box's homography.
+    """
+    width, height = template.canvas_size
+    scale = (size[0] / width, size[1] / height)
+    warp = template.warp or perspective_grid(template)
+    overlays = None
+    if template.overlays is not None:
+        overlays = [
+            _scale_slot(overlay, template.canvas_size, size, scale) if isinstance(overlay, ArtworkSlot)
+            else _scale_overlay(overlay, template.canvas_size, size)
+            for overlay in template.overlays
+        ]
+        overlays = [overlay for overlay in overlays if overlay is not None]
+    return MockupTemplate(
+        canvas_size=tuple(size),
+        below=_shrink(template.below, size),
+        above=None if template.above is None else _shrink(template.above, size),
+        quad=template.quad * np.array(scale),
+        mask=_shrink(template.mask, size),
+        content_size=template.content_size,
+        warp=scale_warp(warp, scale),
+        overlays=overlays,
+        layer_names=template.layer_names,
+    )
+
+
+def _scale_overlay(overlay, canvas_size, size):
+    """``overlay`` on a canvas scaled from ``canvas_size`` to ``size``, or None if it vanishes."""
+    width, height = canvas_size
+    sx, sy = size[0] / width, size[1] / height
+    left, top, right, bottom = overlay.box
+    box = (int(np.floor(left * sx)), int(np.floor(top * sy)),
+           min(int(np.ceil(right * sx)), size[0]), min(int(np.ceil(bottom * sy)), size[1]))
+    if box[2] <= box[0] or box[3] <= box[1]:
+        return None
+    # Shrink on the full canvas so the overlay stays aligned with the other layers
+    canvas = np.zeros((height, width, 4), dtype=np.float32)
+    canvas[top:bottom, left:right] = overlay.pixels
+    pixels = _shrink(canvas, size)[box[1]:box[3], box[0]:box[2]]
+    return Overlay(box, np.ascontiguousarray(pixels), overlay.blend_mode, overlay.opacity, overlay.clip)
+
+
+def _on_canvas(pixels, box, canvas_size):
+    """``pixels`` covering ``box``, zero-padded to the whole canvas."""
+    width, height = canvas_size
+    canvas = np.zeros((height, width) + pixels.shape[2:], dtype=np.float32)
+    canvas[box[1]:box[3], box[0]:box[2]] = pixels
+    return canvas
+
+
+def _scale_slot(slot, canvas_size, size, scale):
+    """``slot`` on a canvas scaled from ``canvas_size`` to ``size``, or None if it vanishes."""
+    warp = scale_warp(slot.warp, scale)
+    left, top, right, bottom = warp.box
+    if right <= left or bottom <= top:
+        return None
+    mask = _shrink(_on_canvas(slot.mask, slot.box, canvas_size), size)[top:bottom, left:right]
+    content = _shrink(_on_canvas(slot.content, slot.box, canvas_size), size)[top:bottom, left:right]
+    return ArtworkSlot(
+        slot.layer_name, slot.quad * np.array(scale), np.ascontiguousarray(mask), slot.content_size, warp,
+        np.ascontiguousarray(content),
+    )
+
+
+def artwork_size(template, warp=None, layer_name=None):
+    """
+    Size render_image resamples the artwork to; larger uploads gain nothing.
+    ``layer_name`` picks one of a template's ArtworkSlots instead of its first smart object.
+    """
+    for slot in template.slots:
+        if slot.layer_name == layer_name and layer_name != template.layer_names[0]:
+            return tuple(slot.warp.source_size)
+    warp = warp or template.warp
+    if warp is not None:
+        return tuple(warp.source_size)
+    return _quad_extent(template.quad)
+
+
+def smart_object_size(psd_path, layer_name=LAYER_NAME, index_dir=None):
+    """
+    On-canvas size of the smart object's transform box, read from the layer
+    records only (see psd_index.py). Photoshop scales replaced content to about this size.
+    """
+    target = psd_index.find_layer(psd_index.get_index(psd_path, index_dir), layer_name, "smartobject")
+    if target is None or target["smart_object"]["transform"] is None:
+        raise ValueError(f"Smart object layer '{layer_name}' not found in {os.path.basename(psd_path)}")
+    return _quad_extent(np.array(target["smart_object"]["transform"], dtype=np.float64).reshape(4, 2))
+
+
+_perspective_grids = {}
+
+
+def _perspective_grid_for(template):
+    """perspective_grid(), evaluated once per template instead of on every render."""
+    cached = _perspective_grids.get(id(template))
+    if cached is None or cached[0] is not template:
+        cached = (template, perspective_grid(template))
+        _perspective_grids[id(template)] = cached
+    return cached[1]
+
+
+def place_warp(warp, placement):
+    """
+    ``warp`` with the artwork moved, scaled and rotated by ``placement``: the
+    sampling grid itself is transformed, so placing still takes one remap over
+    the smart object's box.
+    """
+    if placement is None or placement.is_default:
+        return warp
+    width, height = warp.source_size
+    cx, cy = width / 2.0, height / 2.0
+    angle = np.radians(placement.rotation)
+    cos, sin = np.cos(angle) / placement.scale, np.sin(angle) / placement.scale
+    # Inverse of: scale and rotate about the centre, then offset
+    x = warp.map_x - np.float32(cx + placement.offset[0] * width)
+    y = warp.map_y - np.float32(cy + placement.offset[1] * height)
+    map_x = x * np.float32(cos) + y * np.float32(sin) + np.float32(cx)
+    map_y = y * np.float32(cos) - x * np.float32(sin) + np.float32(cy)
+    return WarpGrid(warp.box, map_x, map_y, warp.source_size)
+
+
+def place_artwork(image, warp):
+    """Warp a PIL ``image`` through ``warp`` into premultiplied RGBA over ``warp.box``."""
+    artwork = to_premultiplied(image.resize(warp.source_size, Image.LANCZOS))
+    return remap(artwork, warp.map_x, warp.map_y)
+
+
+def place_slots(template, images, placement=None, scratch=None):
+    """
+    Place each input of ``images`` (layer name -> PIL image) into its ArtworkSlot: warped,
+    masked to the smart object and with the layers clipped to it applied. ``placement``
+    moves the first smart object's artwork. Returns layer name -> premultiplied array.
+    """
+    placed = {}
+    for slot in template.slots:
+        image = images.get(slot.layer_name)
+        if image is None:
+            continue
+        warp = slot.warp
+        if slot.layer_name == template.layer_names[0]:
+            warp = place_warp(warp, placement)
+        artwork = place_artwork(image, warp)
+        artwork *= slot.mask[..., None]
+        placed[slot.layer_name] = apply_overlays(template.overlays, artwork, slot.box, slot.layer_name, scratch)
+    return placed
+
+
+def render_image(template, image, warp=None, region_only=True, timer=None, placement=None):
+    """
+    Place a PIL ``image`` into ``template`` and return the flattened PIL image.
+
+    ``warp`` overrides the template's own placement (its mesh warp, or the
+    plain transform box), e.g. with a calibrated LUT. ``placement`` (a Placement)
+    moves the artwork within the smart object.
+
+    For a template filling several smart objects, ``image`` is a dict of layer
+    name -> PIL image (a single image goes into the first one); smart objects
+    without an input keep their own content, and ``warp`` is not used.
+
+    By default only the smart object's box is recomposited (see RegionCompositor)
+    and the result lives in a per-thread buffer reused by the next render of the
+    template; ``region_only=False`` composites the whole canvas into a new image.
+
+    ``timer`` (a metrics.StageTimer) gets the "place" and "composite" stages.
+    """
+    if template.slots:
+        images = image if isinstance(image, dict) else {template.layer_names[0]: image}
+        with maybe_stage(timer, "place"):
+            placed = place_slots(template, images, placement)
+        with maybe_stage(timer, "composite"):
+            if region_only:
+                return get_compositor(template, None).render(placed)
+            return from_premultiplied(composite(template, placed, None))
+    if isinstance(image, dict):
+        image = image[template.layer_names[0]]
+
+    warp = warp or template.warp or _perspective_grid_for(template)
+    left, top, right, bottom = warp.box
+    if right <= left or bottom <= top:
+        raise ValueError("Smart object lies outside the canvas")
+
+    with maybe_stage(timer, "place"):
+        placed = place_artwork(image, place_warp(warp, placement))
+    with maybe_stage(timer, "composite"):
+        if region_only:
+            return get_compositor(template, warp.box).render(placed)
+        return from_premultiplied(composite(template, placed, warp.box))
+
+
+def render_mockup(template, image, output_path, warp=None):
+    """Place a PIL ``image`` into ``template`` and save the flattened result."""
+    result = render_image(template, image, warp)
+    if output_path.lower().endswith((".jpg", ".jpeg")):
+        result = result.convert("RGB")
+    result.save(output_path)
+    return output_path
+
+
+def replace_smart_object_content(psd_path, image_path, output_path, layer_name=LAYER_NAME, warp=None):
+    """psd-tools counterpart of the COM ``replace_smart_object_content``."""
+    template = get_template(psd_path, layer_name)
+    with Image.open(image_path) as image:
+        return render_mockup(template, image, output_path, warp)
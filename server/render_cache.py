@@ -0,0 +1,196 @@
+"""
+Content-addressed cache of rendered mockups.
+
+The same artwork is often uploaded again to preview it on other products, so
+renders are keyed by what determines their pixels: the SHA-256 of the upload,
+the SHA-256 of the template PSD, the smart object layer and the output
+options. A render is stored as ``<key[:2]>/result_<key>.<ext>`` under the
+output directory, so a repeat request can hand back the existing /outputs URL
+without rendering, and the index can be rebuilt from the directory after a
+restart.
+
+The cache is bounded by the total size of its files: once it is over
+``max_bytes`` the least recently used renders are deleted, skipping any that
+``is_busy`` reports as in use. janitor.py expires renders unused for too long.
+"""
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+
+FILE_PREFIX = "result_"
+FILE_SUFFIXES = (".png", ".jpg", ".webp")
+
+
+class HashingWriter:
+    """File-like wrapper that hashes the bytes written through it, so an upload is hashed as it streams to disk."""
+
+    def __init__(self, f):
+        self._f = f
+        self._digest = hashlib.sha256()
+        self.size = 0
+
+    def write(self, data):
+        self._digest.update(data)
+        self.size += len(data)
+        return self._f.write(data)
+
+    def hexdigest(self):
+        return self._digest.hexdigest()
+
+
+_file_digests = {}
+
+
+def file_digest(path, chunk_size=1024 * 1024):
+    """SHA-256 of a file, re-hashed only when its size or mtime changes."""
+    stat = os.stat(path)
+    signature = (stat.st_size, stat.st_mtime)
+    cached = _file_digests.get(path)
+    if cached is None or cached[0] != signature:
+        digest = hashlib.sha256()
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(chunk_size), b""):
+                digest.update(chunk)
+        cached = (signature, digest.hexdigest())
+        _file_digests[path] = cached
+    return cached[1]
+
+
+def render_key(upload_sha256, psd_sha256, layer_name, options):
+    """Cache key for one render; ``options`` is a JSON-serialisable dict of output settings."""
+    material = json.dumps([upload_sha256, psd_sha256, layer_name, options], sort_keys=True)
+    return hashlib.sha256(material.encode("utf-8")).hexdigest()
+
+
+class RenderCache:
+    """LRU index of the cached renders in ``directory``, bounded by disk bytes."""
+
+    def __init__(self, directory, max_bytes, is_busy=None):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.is_busy = is_busy or (lambda path: False)
+        # key -> [filename relative to directory, size in bytes, last used], least recently used first
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def load(self):
+        """Index renders already in the directory, oldest access first."""
+        found = []
+        for shard in os.listdir(self.directory):
+            shard_dir = os.path.join(self.directory, shard)
+            if len(shard) != 2 or not os.path.isdir(shard_dir):
+                continue
+            for name in os.listdir(shard_dir):
+                stem, suffix = os.path.splitext(name)
+                key = stem[len(FILE_PREFIX):]
+                if name.startswith(FILE_PREFIX) and suffix in FILE_SUFFIXES and len(key) == 64:
+                    stat = os.stat(os.path.join(shard_dir, name))
+                    found.append((stat.st_mtime, key, f"{shard}/{name}", stat.st_size))
+        with self._lock:
+            for mtime, key, filename, size in sorted(found):
+                self._entries[key] = [filename, size, mtime]
+                self._bytes += size
+            self._evict()
+        return len(self._entries)
+
+    def get(self, key):
+        """Filename (relative to the directory) of the cached render for ``key``, or None. Counts a hit or miss."""
+        with self._lock:
+            filename = self._present(key)
+            if filename is not None:
+                self._entries.move_to_end(key)
+                self._entries[key][2] = time.time()
+                self.hits += 1
+            else:
+                self.misses += 1
+            return filename
+
+    def peek(self, key):
+        """Like get() but without touching the LRU order or the counters."""
+        with self._lock:
+            return self._present(key)
+
+    def put(self, key, rendered_path):
+        """Move a finished render into the cache and return its filename."""
+        filename = f"{key[:2]}/{FILE_PREFIX}{key}{os.path.splitext(rendered_path)[1]}"
+        target = self.path(filename)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        os.replace(rendered_path, target)
+        size = os.path.getsize(target)
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._bytes -= old[1]
+            self._entries[key] = [filename, size, time.time()]
+            self._bytes += size
+            self._evict()
+        return filename
+
+    def path(self, filename):
+        return os.path.join(self.directory, *filename.split("/"))
+
+    def paths(self):
+        """Files currently owned by the cache."""
+        with self._lock:
+            return [self.path(filename) for filename, _, _ in self._entries.values()]
+
+    def expire(self, max_age, now=None):
+        """Delete renders not used for ``max_age`` seconds. Returns how many went."""
+        cutoff = (time.time() if now is None else now) - max_age
+        with self._lock:
+            stale = [key for key, (_, _, used) in self._entries.items() if used < cutoff]
+            return sum(1 for key in stale if self._remove(key))
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 3) if lookups else None,
+                "evictions": self.evictions,
+            }
+
+    def _present(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if not os.path.exists(self.path(entry[0])):  # deleted behind our back
+            del self._entries[key]
+            self._bytes -= entry[1]
+            return None
+        return entry[0]
+
+    def _remove(self, key):
+        """Drop an entry and its file unless the file is in use. Caller holds the lock."""
+        filename, size, _ = self._entries[key]
+        path = self.path(filename)
+        if self.is_busy(path):
+            return False
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+        except OSError:  # still open on Windows
+            return False
+        del self._entries[key]
+        self._bytes -= size
+        self.evictions += 1
+        return True
+
+    def _evict(self):
+        # Oldest first; never the entry just added, even if it alone is over budget.
+        for key in list(self._entries)[:-1]:
+            if self._bytes <= self.max_bytes:
+                break
+            self._remove(key)
@@ -0,0 +1,179 @@
+"""
+Parallel rendering of a product's views (psd-tools backend).
+
+A multi-view product used to render its templates one after another on the
+job's thread. Here each view is handed to a process pool instead, so a request
+takes about as long as its slowest view rather than the sum of them. NumPy
+compositing holds the GIL for much of its time, hence processes, not threads.
+
+The upload is decoded once, in the job thread (see upload_normalizer.py), and
+copied into an RGBA buffer in shared memory. Workers attach to it by name and wrap it in a PIL image without
+copying, so no worker re-reads or re-decodes the file from server/uploads.
+Templates come from compiled bundles, which every worker memory-maps from
+the same files (see template_bundle.py): their pixels are in memory once
+however many workers there are, and each worker's TemplateStore unloads the
+templates it stopped using.
+"""
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from contextlib import ExitStack
+from multiprocessing import shared_memory
+
+from PIL import Image
+
+import output_encoder
+import psd_renderer
+import template_bundle
+from metrics import StageTimer
+
+
+class SharedImage:
+    """
+    A decoded RGBA image in a shared memory block, freed on exit.
+
+    ``spec`` is the small picklable handle workers pass to ``attach_image``.
+    """
+
+    def __init__(self, image):
+        rgba = image.convert("RGBA")
+        data = rgba.tobytes()
+        self._shm = shared_memory.SharedMemory(create=True, size=max(len(data), 1))
+        self._shm.buf[:len(data)] = data
+        self.spec = (self._shm.name, rgba.size)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self._shm.close()
+        self._shm.unlink()
+
+
+def attach_image(spec):
+    """Map a SharedImage in a worker. Returns (image, shm); close shm once done with image."""
+    name, size = spec
+    shm = shared_memory.SharedMemory(name=name)
+    image = Image.frombuffer("RGBA", size, shm.buf, "raw", "RGBA", 0, 1)
+    return image, shm
+
+
+def render_view(image_spec, psd_path, bundle_root, layers, lut_path, output_path, encoding):
+    """
+    Worker body: render one template from the shared upload and encode it.
+
+    ``layers`` names the template's smart object, or a list of all of them: the
+    bundle is always that one, whichever get an image. ``image_spec`` goes into
+    the first, or is a dict of smart object name -> spec to fill several in one
+    pass; the others keep their own content.
+
+    Returns output_encoder.encode()'s stats plus "render_ms" and "stages"
+    (StageTimer entries, for the job to merge). Raises ValueError if the
+    template has no such smart object layer.
+    """
+    timer = StageTimer(os.path.basename(psd_path))
+    started = time.perf_counter()
+    specs = image_spec if isinstance(image_spec, dict) else {psd_renderer.layer_names(layers)[0]: image_spec}
+    with timer.stage("template"):
+        warp = psd_renderer.get_warp_lut(lut_path)
+        template = template_bundle.get_bundle(psd_path, bundle_root, layers, hold=True)
+
+    with template_bundle.held(template):
+        attached = {layer: attach_image(spec) for layer, spec in specs.items()}
+        try:
+            images = {layer: image for layer, (image, _) in attached.items()}
+            result = psd_renderer.render_image(template, images, warp, timer=timer)
+        finally:
+            # The images are views of the shared blocks; drop them before unmapping.
+            images = None
+            for layer in list(attached):
+                image, shm = attached.pop(layer)
+                image.close()
+                del image
+                shm.close()
+    render_ms = round((time.perf_counter() - started) * 1000, 1)
+    timer.add("render", render_ms)
+    stats = output_encoder.encode(result, output_path, encoding)
+    timer.add("encode", stats["encode_ms"])
+    return {"render_ms": render_ms, "stages": timer.entries(), **stats}
+
+
+_pool = None
+
+
+def _init_worker(template_idle_seconds):
+    template_bundle.store.idle_seconds = template_idle_seconds
+    template_bundle.store.start_sweeping()
+
+
+def get_pool(workers):
+    """The process pool, created on first use and shared by every job."""
+    global _pool
+    if _pool is None:
+        # spawn, not fork: the server forks from a process full of threads.
+        _pool = ProcessPoolExecutor(
+            max_workers=workers,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=_init_worker,
+            initargs=(template_bundle.store.idle_seconds,),
+        )
+    return _pool
+
+
+def _ready():
+    return True
+
+
+def start_pool(workers):
+    """Spawn every worker up front so the first request doesn't pay for interpreter start-up."""
+    pool = get_pool(workers)
+    for future in [pool.submit(_ready) for _ in range(workers)]:
+        future.result()
+
+
+def shutdown_pool():
+    global _pool
+    if _pool is not None:
+        _pool.shutdown(wait=False, cancel_futures=True)
+        _pool = None
+
+
+def render_views(image, views, encoding, workers, bundle_root, layer_name=psd_renderer.LAYER_NAME, on_view=None):
+    """
+    Render a decoded PIL ``image`` into several templates at once, each
+    encoded with ``encoding`` (output_encoder.EncodeOptions).
+
+    ``views`` is a list of (psd_path, lut_path, output_path), each optionally
+    followed by a dict of smart object name -> key of ``image``, which is then
+    a dict of decoded images, to fill several smart objects in one pass, and by
+    the list of all the template's smart objects (default ``layer_name``).
+    Every image is shared once, however many views use it.
+
+    Returns a list of (render_view() stats, exception or None) in the same
+    order, once every view is done. ``on_view(index, stats, error)`` is called,
+    on this thread, as each view finishes.
+    """
+    images = image if isinstance(image, dict) else {None: image}
+    with ExitStack() as stack:
+        shared = {key: stack.enter_context(SharedImage(image)).spec for key, image in images.items()}
+        pool = get_pool(workers)
+        futures = {}
+        for index, (psd_path, lut_path, output_path, *extra) in enumerate(views):
+            if extra and extra[0]:
+                spec = {layer: shared[key] for layer, key in extra[0].items()}
+            else:
+                spec = shared[None]
+            layers = extra[1] if len(extra) > 1 else layer_name
+            future = pool.submit(render_view, spec, psd_path, bundle_root, layers, lut_path, output_path, encoding)
+            futures[future] = index
+        outcomes = [None] * len(views)
+        for future in as_completed(futures):
+            try:
+                outcome = (future.result(), None)
+            except Exception as e:
+                outcome = (None, e)
+            outcomes[futures[future]] = outcome
+            if on_view is not None:
+                on_view(futures[future], *outcome)
+        return outcomes
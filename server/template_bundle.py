@@ -0,0 +1,490 @@
+"""
+Compiled template bundles.
+
+Parsing and compositing a PSD with psd-tools takes far longer than the render
+itself, so each template is compiled once into a bundle directory:
+
+    <BUNDLE_DIR>/<psd name>__<layer name>[+<layer name>...]/
+        below.npy   premultiplied float32 RGBA of the layers under the smart object
+        above.npy   premultiplied float32 RGBA of the layers over it, or
+        overlay_<n>.npy
+                    each layer over it that needs its own blend mode; with
+                    several smart objects, each one's content, plus its
+                    overlay_<n>_mask.npy and overlay_<n>_warp_x/y.npy
+        mask.npy    float32 smart object coverage
+        background.npy
+                    uint8 RGBA canvas without artwork, each render's starting point
+        warp_x.npy  float32 sampling grid of the smart object's warp mesh
+        warp_y.npy  (only for warped smart objects, see warp_mesh.py)
+        meta.json   canvas size, transform quad, content size, PSD hash
+        levels/<width>x<height>/
+                    the same files for a downscaled copy, used by previews
+
+The arrays are plain .npy files so renders can memory-map them instead of
+decoding the PSD. A bundle is only rebuilt when the PSD's SHA-256 changes.
+
+Every process maps the same files read-only, so the render pool's workers
+share one copy of each template's pixels in the page cache instead of
+decoding their own. A process keeps its mapped templates in a TemplateStore,
+which counts who holds each one and unloads those unused for a while.
+
+Preview levels at 1/2 and 1/4 of the canvas are built with the bundle; other
+sizes (a product's editor size) are built from the mapped full-size bundle the
+first time get_level() asks for them, and kept until the bundle is rebuilt.
+
+Run directly to compile every template listed in products.json:
+
+    python template_bundle.py
+"""
+import hashlib
+import json
+import os
+import shutil
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+
+import numpy as np
+
+import psd_renderer
+from catalog import template_layers
+
+BUNDLE_VERSION = 4
+BUNDLE_ARRAYS = ("below", "above", "mask", "background")
+PREVIEW_SCALES = {"half": 0.5, "quarter": 0.25}
+
+
+def file_sha256(path, chunk_size=1024 * 1024):
+    """SHA-256 hex digest of a file, read in chunks."""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def bundle_dir_for(bundle_root, psd_path, layer_name=psd_renderer.LAYER_NAME):
+    """Directory holding the bundle of ``layer_name`` (or a list of smart object names) in ``psd_path``."""
+    return os.path.join(bundle_root, f"{Path(psd_path).stem}__{'+'.join(psd_renderer.layer_names(layer_name))}")
+
+
+def _layer_meta(layer_name):
+    """How a bundle's meta.json records its smart object name(s)."""
+    names = psd_renderer.layer_names(layer_name)
+    return names[0] if len(names) == 1 else names
+
+
+def read_meta(bundle_dir):
+    """Return a bundle's metadata, or None if it is missing or unreadable."""
+    try:
+        with open(os.path.join(bundle_dir, "meta.json"), "r") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def is_current(bundle_dir, psd_hash, layer_name):
+    """True if the bundle was compiled from this exact PSD content and layer."""
+    meta = read_meta(bundle_dir)
+    return (
+        meta is not None
+        and meta.get("version") == BUNDLE_VERSION
+        and meta.get("psd_sha256") == psd_hash
+        and meta.get("layer_name") == _layer_meta(layer_name)
+    )
+
+
+def compile_template(psd_path, bundle_root, layer_name=psd_renderer.LAYER_NAME, force=False):
+    """
+    Compile ``psd_path`` into a bundle under ``bundle_root``.
+
+    Returns (bundle_dir, compiled) where ``compiled`` is False if an up-to-date
+    bundle already existed.
+    """
+    bundle_dir = bundle_dir_for(bundle_root, psd_path, layer_name)
+    psd_hash = file_sha256(psd_path)
+    if not force and is_current(bundle_dir, psd_hash, layer_name):
+        _refresh_signature(bundle_dir, psd_path)
+        return bundle_dir, False
+
+    template = psd_renderer.load_template(psd_path, layer_name)
+
+    # Build next to the final location and swap it in, so a reader never maps a
+    # half-written bundle. _compile_lock is per process: render_pool workers may
+    # rebuild the same bundle at once, each in its own staging directory.
+    staging_dir = f"{bundle_dir}.{os.getpid()}.tmp"
+    shutil.rmtree(staging_dir, ignore_errors=True)
+    _save_template(staging_dir, template, {
+        "psd_file": os.path.basename(psd_path),
+        "psd_sha256": psd_hash,
+        "psd_size": os.path.getsize(psd_path),
+        "psd_mtime": os.path.getmtime(psd_path),
+        "layer_name": _layer_meta(layer_name),
+    })
+    for scale in PREVIEW_SCALES.values():
+        size = preview_size(template.canvas_size, scale)
+        _save_template(level_dir_for(staging_dir, size), psd_renderer.scale_template(template, size), {})
+
+    shutil.rmtree(bundle_dir, ignore_errors=True)
+    try:
+        os.replace(staging_dir, bundle_dir)
+    except OSError:
+        # Another process swapped its build in between the two calls
+        shutil.rmtree(staging_dir, ignore_errors=True)
+        if not is_current(bundle_dir, psd_hash, layer_name):
+            raise
+    return bundle_dir, True
+
+
+def _refresh_signature(bundle_dir, psd_path):
+    """
+    Record the PSD's current size and mtime in an up-to-date bundle (the file was
+    touched or copied again), so get_bundle() doesn't re-hash it on every load.
+    """
+    meta = read_meta(bundle_dir)
+    signature = _psd_signature(psd_path)
+    if (meta.get("psd_size"), meta.get("psd_mtime")) == signature:
+        return
+    meta["psd_size"], meta["psd_mtime"] = signature
+    staging_path = os.path.join(bundle_dir, f"meta.json.{os.getpid()}.tmp")
+    with open(staging_path, "w") as f:
+        json.dump(meta, f, indent=2)
+    os.replace(staging_path, os.path.join(bundle_dir, "meta.json"))
+
+
+def _save_template(directory, template, meta):
+    """Write a MockupTemplate's arrays and metadata (plus ``meta``) into ``directory``."""
+    os.makedirs(directory)
+    arrays = {name: getattr(template, name) for name in BUNDLE_ARRAYS}
+    if arrays["background"] is None:
+        arrays["background"] = psd_renderer.flatten_background(template)
+    for name, array in arrays.items():
+        if array is not None:
+            np.save(os.path.join(directory, f"{name}.npy"), np.ascontiguousarray(array))
+
+    overlays = None
+    if template.overlays is not None:
+        overlays = []
+        for number, overlay in enumerate(template.overlays):
+            np.save(os.path.join(directory, f"overlay_{number}.npy"), np.ascontiguousarray(overlay.pixels))
+            if isinstance(overlay, psd_renderer.ArtworkSlot):
+                np.save(os.path.join(directory, f"overlay_{number}_mask.npy"), np.ascontiguousarray(overlay.mask))
+                np.save(os.path.join(directory, f"overlay_{number}_warp_x.npy"), np.ascontiguousarray(overlay.warp.map_x))
+                np.save(os.path.join(directory, f"overlay_{number}_warp_y.npy"), np.ascontiguousarray(overlay.warp.map_y))
+                overlays.append({
+                    "slot": overlay.layer_name,
+                    "quad": overlay.quad.tolist(),
+                    "content_size": list(overlay.content_size),
+                    "warp": {"box": list(overlay.warp.box), "source_size": list(overlay.warp.source_size)},
+                })
+                continue
+            overlays.append({
+                "box": list(overlay.box),
+                "blend_mode": overlay.blend_mode,
+                "opacity": overlay.opacity,
+                "clip": overlay.clip,
+            })
+
+    warp = None
+    if template.warp is not None:
+        np.save(os.path.join(directory, "warp_x.npy"), np.ascontiguousarray(template.warp.map_x))
+        np.save(os.path.join(directory, "warp_y.npy"), np.ascontiguousarray(template.warp.map_y))
+        warp = {"box": list(template.warp.box), "source_size": list(template.warp.source_size)}
+
+    meta = {
+        "version": BUNDLE_VERSION,
+        **meta,
+        "canvas_size": list(template.canvas_size),
+        "quad": template.quad.tolist(),
+        "content_size": list(template.content_size),
+        "warp": warp,
+        "overlays": overlays,
+        "layer_names": template.layer_names,
+    }
+    with open(os.path.join(directory, "meta.json"), "w") as f:
+        json.dump(meta, f, indent=2)
+
+
+def load_bundle(bundle_dir):
+    """Memory-map a compiled bundle into a MockupTemplate (no PSD decoding)."""
+    meta = read_meta(bundle_dir)
+    if meta is None:
+        raise FileNotFoundError(f"No compiled bundle in {bundle_dir}")
+
+    arrays = {
+        name: np.load(os.path.join(bundle_dir, f"{name}.npy"), mmap_mode="r")
+        for name in BUNDLE_ARRAYS
+        if name != "above" or meta.get("overlays") is None
+    }
+    warp = None
+    if meta.get("warp"):
+        warp = psd_renderer.WarpGrid(
+            box=tuple(meta["warp"]["box"]),
+            map_x=np.load(os.path.join(bundle_dir, "warp_x.npy"), mmap_mode="r"),
+            map_y=np.load(os.path.join(bundle_dir, "warp_y.npy"), mmap_mode="r"),
+            source_size=tuple(meta["warp"]["source_size"]),
+        )
+    overlays = None
+    if meta.get("overlays") is not None:
+        overlays = [_load_overlay(bundle_dir, number, overlay) for number, overlay in enumerate(meta["overlays"])]
+        arrays["above"] = None
+
+    return psd_renderer.MockupTemplate(
+        canvas_size=tuple(meta["canvas_size"]),
+        quad=np.array(meta["quad"], dtype=np.float64),
+        content_size=tuple(meta["content_size"]),
+        warp=warp,
+        overlays=overlays,
+        layer_names=meta.get("layer_names"),
+        **arrays,
+    )
+
+
+def _load_overlay(bundle_dir, number, overlay):
+    def array(suffix=""):
+        return np.load(os.path.join(bundle_dir, f"overlay_{number}{suffix}.npy"), mmap_mode="r")
+
+    if "slot" in overlay:
+        return psd_renderer.ArtworkSlot(
+            layer_name=overlay["slot"],
+            quad=np.array(overlay["quad"], dtype=np.float64),
+            mask=array("_mask"),
+            content_size=tuple(overlay["content_size"]),
+            warp=psd_renderer.WarpGrid(
+                box=tuple(overlay["warp"]["box"]),
+                map_x=array("_warp_x"),
+                map_y=array("_warp_y"),
+                source_size=tuple(overlay["warp"]["source_size"]),
+            ),
+            content=array(),
+        )
+    return psd_renderer.Overlay(
+        box=tuple(overlay["box"]),
+        pixels=array(),
+        blend_mode=overlay["blend_mode"],
+        opacity=overlay["opacity"],
+        clip=overlay["clip"],
+    )
+
+
+class TemplateStore:
+    """
+    The templates a process has mapped, by key, each with a count of its holders.
+
+    A template nobody holds is unloaded once it has not been asked for in
+    ``idle_seconds``: the store and the compositors forget it, and its files
+    are unmapped when the last array view of them goes away. A replaced
+    template (its PSD changed) is unloaded straight away. start_sweeping()
+    checks for idle templates on a timer, so a process that stops rendering
+    still lets go of them.
+    """
+
+    def __init__(self, idle_seconds=600):
+        self.idle_seconds = idle_seconds
+        self._entries = {}  # key -> [signature, template, holders, last used]
+        self._lock = threading.Lock()
+        self._sweeper = None
+
+    def get(self, key, signature, hold=False):
+        """
+        The template stored under ``key`` if it was loaded for ``signature``, else None.
+        ``hold`` keeps it loaded until release(), however long it goes unused; the hold
+        is taken with the lookup, so the sweeper can't unload the template in between.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] != signature:
+                return None
+            entry[3] = time.monotonic()
+            if hold:
+                entry[2] += 1
+            return entry[1]
+
+    def put(self, key, signature, template, hold=False):
+        """Store ``template`` under ``key``, held once if ``hold`` (see get())."""
+        with self._lock:
+            replaced = self._entries.get(key)
+            self._entries[key] = [signature, template, 1 if hold else 0, time.monotonic()]
+        if replaced is not None:
+            psd_renderer.drop_compositors(replaced[1])
+        return template
+
+    def release(self, template):
+        with self._lock:
+            for entry in self._entries.values():
+                if entry[1] is template and entry[2] > 0:
+                    entry[2] -= 1
+                    entry[3] = time.monotonic()
+
+    def unload_idle(self, now=None):
+        """Unload the templates nobody holds that went unused for ``idle_seconds``. Returns their keys."""
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            idle = [
+                key for key, (_, _, holders, used) in self._entries.items()
+                if holders == 0 and now - used >= self.idle_seconds
+            ]
+            unloaded = [self._entries.pop(key)[1] for key in idle]
+        for template in unloaded:
+            psd_renderer.drop_compositors(template)
+        return idle
+
+    def start_sweeping(self):
+        """Run unload_idle() every ``idle_seconds / 4`` on a daemon thread, for the rest of the process."""
+        if self._sweeper is None:
+            self._sweeper = threading.Thread(target=self._sweep_forever, name="template-sweeper", daemon=True)
+            self._sweeper.start()
+
+    def _sweep_forever(self):
+        while True:
+            time.sleep(max(self.idle_seconds / 4, 1.0))
+            try:
+                self.unload_idle()
+            except Exception as e:
+                print(f"Template sweep failed: {e}")
+
+    def stats(self):
+        with self._lock:
+            return {
+                "loaded": len(self._entries),
+                "held": sum(1 for entry in self._entries.values() if entry[2] > 0),
+            }
+
+
+store = TemplateStore()
+_compile_lock = threading.Lock()  # render threads must not build the same bundle twice
+
+
+@contextmanager
+def held(*templates):
+    """Release templates got from get_bundle()/get_level() with ``hold=True`` when the block ends."""
+    try:
+        yield
+    finally:
+        for template in templates:
+            store.release(template)
+
+
+def _psd_signature(psd_path):
+    stat = os.stat(psd_path)
+    return (stat.st_size, stat.st_mtime)
+
+
+def get_bundle(psd_path, bundle_root, layer_name=psd_renderer.LAYER_NAME, hold=False):
+    """
+    Return the mapped template for ``psd_path``, compiling it first if needed.
+    ``hold`` keeps it loaded until store.release() (see held()), e.g. for a render.
+
+    Only a stat() of the PSD is done per call; the file is re-hashed when its
+    size or mtime differs from what the bundle was compiled from.
+    """
+    bundle_dir = bundle_dir_for(bundle_root, psd_path, layer_name)
+    signature = _psd_signature(psd_path)
+
+    template = store.get(bundle_dir, signature, hold)
+    if template is not None:
+        return template
+
+    with _compile_lock:
+        template = store.get(bundle_dir, signature, hold)
+        if template is not None:
+            return template
+        meta = read_meta(bundle_dir)
+        if (
+            meta is None
+            or meta.get("version") != BUNDLE_VERSION
+            or (meta.get("psd_size"), meta.get("psd_mtime")) != signature
+        ):
+            compile_template(psd_path, bundle_root, layer_name)
+
+        return store.put(bundle_dir, signature, load_bundle(bundle_dir), hold)
+
+
+def preview_size(canvas_size, scale):
+    """Canvas size of a preview level ``scale`` times the template's."""
+    width, height = canvas_size
+    return max(int(round(width * scale)), 1), max(int(round(height * scale)), 1)
+
+
+def editor_scale(canvas_size, editor_size):
+    """Scale that fits the canvas into the product's editor area, never above full size."""
+    width, height = canvas_size
+    return min(editor_size[0] / width, editor_size[1] / height, 1.0)
+
+
+def level_dir_for(bundle_dir, size):
+    return os.path.join(bundle_dir, "levels", f"{size[0]}x{size[1]}")
+
+
+def get_level(psd_path, bundle_root, layer_name, size, hold=False):
+    """
+    Return the template for ``psd_path`` downscaled to a ``size`` canvas, building
+    and storing that level from the full-size bundle if it doesn't exist yet.
+    ``hold`` is as for get_bundle().
+    """
+    template = get_bundle(psd_path, bundle_root, layer_name)
+    size = tuple(size)
+    if size == tuple(template.canvas_size):
+        return get_bundle(psd_path, bundle_root, layer_name, hold) if hold else template
+
+    bundle_dir = bundle_dir_for(bundle_root, psd_path, layer_name)
+    level_dir = level_dir_for(bundle_dir, size)
+    signature = _psd_signature(psd_path)
+    level = store.get(level_dir, signature, hold)
+    if level is not None:
+        return level
+
+    with _compile_lock:
+        level = store.get(level_dir, signature, hold)
+        if level is not None:
+            return level
+        if read_meta(level_dir) is None:
+            staging_dir = f"{level_dir}.{os.getpid()}.tmp"
+            shutil.rmtree(staging_dir, ignore_errors=True)
+            _save_template(staging_dir, psd_renderer.scale_template(template, size), {})
+            shutil.rmtree(level_dir, ignore_errors=True)
+            os.replace(staging_dir, level_dir)
+        return store.put(level_dir, signature, load_bundle(level_dir), hold)
+
+
+def compile_products(products_file, psd_dir, bundle_root, layer_name=psd_renderer.LAYER_NAME):
+    """
+    Compile every PSD referenced by products.json, skipping unchanged ones, for the
+    smart objects each product fills (its "smartObjects" lists, else ``layer_name``).
+
+    Returns a dict of psd filename -> "compiled" / "unchanged" / "missing" / error text,
+    with the layer names appended for a template filling several smart objects.
+    """
+    with open(products_file, "r") as f:
+        products = json.load(f)
+
+    os.makedirs(bundle_root, exist_ok=True)
+    report = {}
+    for product in products:
+        for psd_name in product.get("psdFiles", []):
+            layers = template_layers(product, psd_name, layer_name)
+            name = psd_name if len(layers) == 1 else f"{psd_name} ({'+'.join(layers)})"
+            if name in report:
+                continue
+            psd_path = os.path.join(psd_dir, psd_name)
+            if not os.path.exists(psd_path):
+                report[name] = "missing"
+                continue
+            try:
+                _, compiled = compile_template(psd_path, bundle_root, layers if len(layers) > 1 else layers[0])
+                report[name] = "compiled" if compiled else "unchanged"
+            except Exception as e:
+                report[name] = f"error: {e}"
+    return report
+
+
+if __name__ == "__main__":
+    base_dir = Path(__file__).resolve().parent.parent
+    results = compile_products(
+        str(base_dir / "server" / "products.json"),
+        str(base_dir / "psdFiles"),
+        str(base_dir / "server" / "template_bundles"),
+    )
+    for psd_name, status in results.items():
+        print(f"{psd_name}: {status}")
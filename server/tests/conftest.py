@@ -0,0 +1,5 @@
+import os
+import sys
+
+# The server's modules import each other by name, as when app.py is run from server/
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,135 @@
+import numpy as np
+import pytest
+from PIL import Image
+
+import blend_modes
+import psd_renderer
+from psd_index import BLEND_MODES
+
+SIZE = 64
+OPACITY = 179  # about 70%, as shading layers usually are
+
+# Largest difference from psd-tools' composite, in 8-bit levels
+FLOAT_MAX_ERROR = 1
+UINT8_MAX_ERROR = 2
+
+
+def _layers():
+    y, x = np.mgrid[0:SIZE, 0:SIZE].astype(np.float32) / (SIZE - 1)
+    backdrop = np.dstack([x, y, 1 - x * y, np.ones_like(x)])
+    source = np.dstack([y, 1 - x, (x + y) / 2, 0.25 + 0.75 * x])
+    return to_uint8(backdrop), to_uint8(source)
+
+
+def to_uint8(rgba):
+    return np.round(rgba * 255).astype(np.uint8)
+
+
+def premultiplied(rgba8):
+    out = rgba8.astype(np.float32) / 255
+    out[..., :3] *= out[..., 3:4]
+    return out
+
+
+def psd_tools_composite(backdrop, source, mode):
+    from psd_tools import PSDImage
+    from psd_tools.api.layers import PixelLayer
+    from psd_tools.constants import BlendMode
+
+    key = next(key for key, name in BLEND_MODES.items() if name == mode)
+    psd = PSDImage.new("RGBA", (SIZE, SIZE))
+    psd.append(PixelLayer.frompil(Image.fromarray(backdrop, "RGBA"), psd, "backdrop"))
+    layer = PixelLayer.frompil(Image.fromarray(source, "RGBA"), psd, mode)
+    layer.blend_mode = BlendMode(key)
+    layer.opacity = OPACITY
+    psd.append(layer)
+    return np.asarray(psd.composite().convert("RGBA"), dtype=np.float32)
+
+
+@pytest.mark.parametrize("mode", list(blend_modes.BLEND_FUNCS))
+def test_both_paths_match_psd_tools(mode):
+    pytest.importorskip("psd_tools")
+    backdrop, source = _layers()
+    reference = psd_tools_composite(backdrop, source, mode)
+
+    precise = premultiplied(backdrop)
+    blend_modes.blend(precise, premultiplied(source), mode, OPACITY / 255)
+    precise_error = np.abs(np.round(precise[..., :3] * 255) - reference[..., :3])
+    assert precise_error.max() <= FLOAT_MAX_ERROR
+
+    fast = backdrop.copy()
+    blend_modes.blend_uint8(fast, source, mode, OPACITY)
+    fast_error = np.abs(fast[..., :3].astype(np.float32) - reference[..., :3])
+    assert fast_error.max() <= UINT8_MAX_ERROR
+    assert (fast[..., 3] == 255).all()
+
+
+def test_unsupported_mode_raises():
+    backdrop, source = _layers()
+    with pytest.raises(ValueError, match="Unsupported blend mode"):
+        blend_modes.blend(premultiplied(backdrop), premultiplied(source), "hue")
+
+
+def test_mask_limits_the_layer():
+    backdrop, source = _layers()
+    mask = np.zeros((SIZE, SIZE), dtype=np.uint8)
+    mask[:, : SIZE // 2] = 255
+
+    precise = premultiplied(backdrop)
+    blend_modes.blend(precise, premultiplied(source), "multiply", 1.0, mask)
+    fast = backdrop.copy()
+    blend_modes.blend_uint8(fast, source, "multiply", 255, mask)
+
+    untouched = np.s_[:, SIZE // 2:]
+    assert np.array_equal(to_uint8(precise)[untouched], backdrop[untouched])
+    assert np.array_equal(fast[untouched], backdrop[untouched])
+    assert np.abs(to_uint8(precise).astype(int) - fast).max() <= UINT8_MAX_ERROR
+
+
+def test_clipped_layer_keeps_base_alpha():
+    backdrop, source = _layers()
+    base = premultiplied(backdrop)
+    base[..., :] *= np.linspace(0, 1, SIZE, dtype=np.float32)[:, None, None]
+    alpha = base[..., 3].copy()
+    blend_modes.blend_clipped(base, premultiplied(source), "screen", 0.7)
+    assert np.allclose(base[..., 3], alpha)
+
+
+def _template_with_overlays():
+    backdrop, source = _layers()
+    below = premultiplied(backdrop)
+    overlays = [
+        psd_renderer.Overlay((0, 0, SIZE, SIZE), premultiplied(source), "multiply", 0.7),
+        psd_renderer.Overlay((16, 8, 48, 40), premultiplied(source[8:40, 16:48]), "screen", 0.5),
+        psd_renderer.Overlay((0, 0, SIZE, SIZE), premultiplied(np.flipud(source)), "soft_light", 1.0, clip="artwork"),
+    ]
+    quad = np.array([[8, 8], [56, 8], [56, 56], [8, 56]], dtype=np.float64)
+    mask = np.zeros((SIZE, SIZE), dtype=np.float32)
+    mask[8:56, 8:56] = 1.0
+    return psd_renderer.MockupTemplate(
+        canvas_size=(SIZE, SIZE), below=below, above=None, quad=quad, mask=mask,
+        content_size=(48, 48), overlays=overlays,
+    )
+
+
+def test_compositor_blends_overlays_in_8_bits_on_an_opaque_background():
+    template = _template_with_overlays()
+    box = (8, 8, 56, 56)
+    rng = np.random.default_rng(0)
+    placed = premultiplied(rng.integers(0, 256, (48, 48, 4), dtype=np.uint8))
+
+    fast = psd_renderer.RegionCompositor(template, box)
+    assert fast.overlays8 is not None
+    precise = psd_renderer.RegionCompositor(template, box)
+    precise.overlays8 = None
+
+    fast_image = np.asarray(fast.render(placed.copy()), dtype=int)
+    precise_image = np.asarray(precise.render(placed.copy()), dtype=int)
+    assert np.abs(fast_image - precise_image).max() <= UINT8_MAX_ERROR
+    assert (fast_image[..., 3] == 255).all()
+
+
+def test_compositor_keeps_the_float_path_on_a_transparent_background():
+    template = _template_with_overlays()
+    template.below[0, 0] = 0.0
+    assert psd_renderer.RegionCompositor(template, (0, 0, SIZE, SIZE)).overlays8 is None
@@ -0,0 +1,145 @@
+import os
+
+import pytest
+
+from photoshop_session import FakePhotoshop, SessionLostError, SessionManager
+
+
+@pytest.fixture
+def psds(tmp_path):
+    """Three template paths on disk, so the session can stat their mtimes."""
+    paths = []
+    for name in ("mug.psd", "cap.psd", "shirt.psd"):
+        path = tmp_path / name
+        path.write_bytes(b"8BPS")
+        paths.append(str(path))
+    return paths
+
+
+def session_for(fake, **kwargs):
+    return SessionManager(lambda: fake, **kwargs)
+
+
+def rendered(image_path, layer="front_surface"):
+    """The history a document has when saved right after one clean render."""
+    return ["Open", f"Replace Contents {layer} {image_path}", "Free Transform"]
+
+
+def calls_named(fake, name):
+    return [call for call in fake.calls if call[0] == name]
+
+
+def test_crash_on_save_reconnects_and_retries_once(psds):
+    fake = FakePhotoshop(script=[("save_png", "crash")])
+    session = session_for(fake)
+
+    assert session.render(psds[0], "art.png", "out.png", "front_surface") == "out.png"
+
+    assert fake.saved["out.png"] == rendered("art.png")
+    assert len(calls_named(fake, "connect")) == 2
+    assert len(calls_named(fake, "open")) == 2  # the relaunched Photoshop has nothing open
+    assert session.stats()["reconnects"] == 1
+
+
+def test_crash_on_retry_gives_up(psds):
+    fake = FakePhotoshop(script=[("save_png", "crash"), ("save_png", "crash")])
+    session = session_for(fake)
+
+    with pytest.raises(SessionLostError):
+        session.render(psds[0], "art.png", "out.png", "front_surface")
+    assert len(calls_named(fake, "connect")) == 2
+    assert session.stats()["open_documents"] == 0
+
+    # The next render starts a fresh session
+    session.render(psds[0], "art.png", "out.png", "front_surface")
+    assert fake.saved["out.png"] == rendered("art.png")
+
+
+def test_document_closed_mid_render_fails_then_reopens(psds):
+    fake = FakePhotoshop()
+    session = session_for(fake)
+    session.render(psds[0], "a.png", "a_out.png", "front_surface")
+
+    fake.script.append(("replace_contents", "close"))
+    with pytest.raises(RuntimeError, match="closed"):
+        session.render(psds[0], "b.png", "b_out.png", "front_surface")
+    assert "b_out.png" not in fake.saved
+    assert len(calls_named(fake, "connect")) == 1  # Photoshop itself is fine, no reconnect
+
+    session.render(psds[0], "c.png", "c_out.png", "front_surface")
+    assert fake.saved["c_out.png"] == rendered("c.png")
+    assert len(calls_named(fake, "open")) == 2
+    assert session.stats()["reconnects"] == 0
+
+
+def test_document_closed_between_jobs_is_reopened(psds):
+    fake = FakePhotoshop()
+    session = session_for(fake)
+    session.render(psds[0], "a.png", "a_out.png", "front_surface")
+
+    fake.documents[0]["open"] = False
+    session.render(psds[0], "b.png", "b_out.png", "front_surface")
+
+    assert fake.saved["b_out.png"] == rendered("b.png")
+    assert len(calls_named(fake, "open")) == 2
+
+
+def test_least_recently_used_document_is_closed(psds):
+    mug, cap, shirt = psds
+    fake = FakePhotoshop()
+    session = session_for(fake, max_documents=2)
+
+    session.render(mug, "a.png", "1.png", "front_surface")
+    session.render(cap, "a.png", "2.png", "front_surface")
+    session.render(mug, "a.png", "3.png", "front_surface")  # cap is now the least recently used
+    session.render(shirt, "a.png", "4.png", "front_surface")
+
+    assert calls_named(fake, "close") == [("close", cap)]
+    assert sorted(doc["path"] for doc in fake.documents if doc["open"]) == sorted([mug, shirt])
+    assert session.stats()["open_documents"] == 2
+
+    session.render(cap, "a.png", "5.png", "front_surface")
+    assert calls_named(fake, "close") == [("close", cap), ("close", mug)]
+    assert [call[1] for call in calls_named(fake, "open")] == [mug, cap, shirt, cap]
+
+
+def test_history_is_rolled_back_between_jobs(psds):
+    fake = FakePhotoshop()
+    session = session_for(fake)
+
+    session.render(psds[0], "a.png", "a_out.png", "front_surface")
+    session.render(psds[0], "b.png", "b_out.png", "front_surface")
+
+    # The second save has only its own replacement, on the same document
+    assert fake.saved["b_out.png"] == rendered("b.png")
+    assert fake.documents[0]["history"] == ["Open"]
+    stats = session.stats()
+    assert (stats["opens"], stats["reuses"], stats["rollbacks"]) == (1, 1, 2)
+
+
+def test_failed_rollback_reopens_the_document(psds):
+    fake = FakePhotoshop(script=[("rollback", RuntimeError("history is gone"))])
+    session = session_for(fake)
+
+    session.render(psds[0], "a.png", "a_out.png", "front_surface")
+    session.render(psds[0], "b.png", "b_out.png", "front_surface")
+
+    assert fake.saved["b_out.png"] == rendered("b.png")
+    assert len(calls_named(fake, "open")) == 2
+
+
+def test_changed_psd_is_reopened(psds):
+    fake = FakePhotoshop()
+    session = session_for(fake)
+    session.render(psds[0], "a.png", "a_out.png", "front_surface")
+
+    mtime = os.path.getmtime(psds[0])
+    os.utime(psds[0], (mtime + 10, mtime + 10))
+    session.render(psds[0], "b.png", "b_out.png", "front_surface")
+
+    assert len(calls_named(fake, "open")) == 2
+    assert calls_named(fake, "close") == [("close", psds[0])]
+    assert fake.saved["b_out.png"] == rendered("b.png")
+
+    session.render(psds[0], "c.png", "c_out.png", "front_surface")
+    assert len(calls_named(fake, "open")) == 2
@@ -0,0 +1,74 @@
+import time
+
+import template_bundle
+from template_bundle import TemplateStore
+
+
+class Template:
+    """Stands in for a mapped MockupTemplate; the store only keeps it."""
+
+
+def test_idle_template_is_unloaded():
+    store = TemplateStore(idle_seconds=10)
+    store.put("mug", "sig", Template())
+    now = time.monotonic()
+
+    assert store.unload_idle(now + 5) == []
+    assert store.unload_idle(now + 11) == ["mug"]
+    assert store.get("mug", "sig") is None
+
+
+def test_held_template_stays_loaded():
+    store = TemplateStore(idle_seconds=10)
+    store.put("mug", "sig", Template())
+    template = store.get("mug", "sig", hold=True)
+
+    assert store.unload_idle(time.monotonic() + 60) == []
+    store.release(template)
+    assert store.unload_idle(time.monotonic() + 60) == ["mug"]
+
+
+def test_put_can_hold():
+    store = TemplateStore(idle_seconds=10)
+    template = store.put("mug", "sig", Template(), hold=True)
+
+    assert store.unload_idle(time.monotonic() + 60) == []
+    assert store.stats() == {"loaded": 1, "held": 1}
+    store.release(template)
+    assert store.stats() == {"loaded": 1, "held": 0}
+
+
+def test_miss_takes_no_hold():
+    store = TemplateStore(idle_seconds=10)
+    store.put("mug", "old", Template())
+    assert store.get("mug", "new", hold=True) is None
+    assert store.stats()["held"] == 0
+
+
+def test_changed_signature_is_a_miss():
+    store = TemplateStore()
+    store.put("mug", "old", Template())
+    assert store.get("mug", "new") is None
+
+
+def test_sweeper_unloads_without_further_requests():
+    store = TemplateStore(idle_seconds=0.4)
+    store.put("mug", "sig", Template())
+    store.start_sweeping()
+
+    deadline = time.monotonic() + 5
+    while store.stats()["loaded"] and time.monotonic() < deadline:
+        time.sleep(0.05)
+    assert store.stats()["loaded"] == 0
+
+
+def test_held_releases_after_the_block():
+    store = template_bundle.store
+    store.put("test-held", "sig", Template())
+    try:
+        template = store.get("test-held", "sig", hold=True)
+        with template_bundle.held(template):
+            assert "test-held" not in store.unload_idle(time.monotonic() + store.idle_seconds + 1)
+        assert "test-held" in store.unload_idle(time.monotonic() + store.idle_seconds + 1)
+    finally:
+        store._entries.pop("test-held", None)
@@ -0,0 +1,75 @@
+"""
+One-time preparation of an upload for every template it is rendered into.
+
+Uploads are often far larger than any smart object they end up in (phone
+photos, multi-thousand-pixel PNGs). Rather than every view decoding and
+resampling the original again, a job normalises it once: decode (JPEGs in
+libjpeg's reduced-size draft mode when they are much larger than needed),
+apply the EXIF orientation, convert to RGBA and downscale to the largest size
+any of the job's templates will use, then convert it from its embedded ICC
+profile to sRGB (see color_management.py). Every per-template render then
+starts from that one in-memory image.
+"""
+import math
+
+from PIL import Image, ImageOps
+
+import color_management
+
+EXIF_ORIENTATION = 0x0112
+ROTATED_ORIENTATIONS = {5, 6, 7, 8}  # stored sideways: width and height swap when applied
+
+
+def fit_scale(size, target_sizes):
+    """
+    Uniform scale that shrinks ``size`` as far as possible while still covering
+    every (width, height) in ``target_sizes``. Never above 1.0.
+    """
+    width, height = size
+    needed = max(max(target_w / width, target_h / height) for target_w, target_h in target_sizes)
+    return min(needed, 1.0)
+
+
+def _to_rgba(image):
+    if image.mode == "RGBA":
+        return image
+    if image.mode in ("I", "I;16", "I;16B", "I;16L", "F"):
+        # 16-bit / float greyscale: bring it into 8 bits before the colour conversion.
+        image = image.convert("I").point(lambda value: value * (1 / 256)).convert("L")
+    return image.convert("RGBA")
+
+
+def normalize_upload(image_path, target_sizes):
+    """
+    Decode ``image_path`` once, upright, as sRGB RGBA and no larger than the
+    biggest of ``target_sizes`` requires. Returns a loaded PIL image.
+    """
+    with Image.open(image_path) as image:
+        icc_profile = image.info.get("icc_profile")
+        stored_w, stored_h = image.size
+        if image.getexif().get(EXIF_ORIENTATION) in ROTATED_ORIENTATIONS:
+            upright = (stored_h, stored_w)
+        else:
+            upright = (stored_w, stored_h)
+        scale = fit_scale(upright, target_sizes) if target_sizes else 1.0
+
+        if scale < 1.0 and image.format == "JPEG":
+            # libjpeg decodes straight to 1/2, 1/4 or 1/8 size, never below the requested size.
+            image.draft(image.mode, (math.ceil(stored_w * scale), math.ceil(stored_h * scale)))
+
+        image = ImageOps.exif_transpose(image)
+        if image.mode in ("CMYK", "L"):
+            # Through the profile now rather than PIL's naive conversion to RGBA
+            image = color_management.to_srgb(image, icc_profile)
+            icc_profile = None
+        elif image.mode not in ("RGB", "RGBA", "P"):
+            icc_profile = None  # LA, 16-bit greyscale: LittleCMS can't take these modes
+        image = _to_rgba(image)
+        image.load()
+
+    scale = fit_scale(image.size, target_sizes) if target_sizes else 1.0
+    if scale < 1.0:
+        size = (max(math.ceil(image.width * scale), 1), max(math.ceil(image.height * scale), 1))
+        image = image.resize(size, Image.LANCZOS, reducing_gap=3.0)
+    # RGB profiles: on the downscaled pixels, in place
+    return color_management.to_srgb(image, icc_profile)
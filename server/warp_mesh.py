@@ -0,0 +1,202 @@
+"""
+Smart object warp meshes evaluated from PSD metadata.
+
+Photoshop stores a smart object's warp as a grid of Bezier control points in
+its placement descriptor ('SoLd'): either a single bicubic patch
+(``warp.customEnvelopeWarp``, 4x4 points) or a "quilt" of patches joined at
+``quiltSliceX``/``quiltSliceY`` (``quiltWarp``, (3n+1)x(3m+1) points). The
+mesh lives in its own coordinate space; its control-point bounding box is what
+the transform box (``Trnf``) places on the canvas.
+
+``mesh_grid`` turns that into a WarpGrid: for every canvas pixel, the point of
+the smart object content it shows. The mesh is sampled finely, projected onto
+the canvas and rasterised triangle by triangle, so foldovers and degenerate
+(collapsed) slices come out right without any iterative inversion.
+"""
+import numpy as np
+
+import psd_renderer
+
+# Coordinates for pixels the warped content doesn't reach; remap() reads them as transparent.
+OUTSIDE = -16.0
+
+
+def read_warp(layer):
+    """
+    Return the warp descriptor Photoshop renders with, or None for no warp.
+
+    A quilt (split) warp takes precedence over the plain envelope warp.
+    """
+    descriptor = psd_renderer.placed_layer_descriptor(layer)
+    for key in (b"quiltWarp", b"warp"):
+        warp = descriptor.get(key)
+        if warp is not None and getattr(warp.get(b"warpStyle"), "enum", None) == b"warpCustom":
+            return warp
+    return None
+
+
+def mesh_from_warp(warp):
+    """
+    Unpack a custom warp descriptor.
+
+    Returns (points, breaks_s, breaks_t): points is a rows x cols x 2 array of
+    control points, breaks_* are the normalised content positions (0..1) where
+    patches meet along each axis.
+    """
+    envelope = warp[b"customEnvelopeWarp"]
+    mesh = envelope[b"meshPoints"]
+    xs = np.array(list(mesh[b"Hrzn"]), dtype=np.float64)
+    ys = np.array(list(mesh[b"Vrtc"]), dtype=np.float64)
+    rows = int(warp.get(b"deformNumRows", warp.get(b"vOrder", 4)))
+    cols = int(warp.get(b"deformNumCols", warp.get(b"uOrder", 4)))
+    points = np.stack([xs, ys], axis=-1).reshape(rows, cols, 2)
+
+    bounds = warp[b"bounds"]
+    left, top = float(bounds[b"Left"]), float(bounds[b"Top "])
+    right, bottom = float(bounds[b"Rght"]), float(bounds[b"Btom"])
+
+    def breaks(key, start, end, count):
+        if key in envelope:
+            values = np.array(list(envelope[key][key]), dtype=np.float64)
+            values = (values - start) / (end - start)
+            values[0], values[-1] = 0.0, 1.0
+            return values
+        return np.linspace(0.0, 1.0, (count - 1) // 3 + 1)
+
+    return (
+        points,
+        breaks(b"quiltSliceX", left, right, cols),
+        breaks(b"quiltSliceY", top, bottom, rows),
+    )
+
+
+def _bernstein(t):
+    """Cubic Bernstein basis, shape t.shape + (4,)."""
+    u = 1.0 - t
+    return np.stack([u ** 3, 3 * u * u * t, 3 * u * t * t, t ** 3], axis=-1)
+
+
+def _patch_coords(values, breaks):
+    """Patch index and local parameter (0..1) for normalised positions."""
+    index = np.clip(np.searchsorted(breaks, values, side="right") - 1, 0, len(breaks) - 2)
+    span = breaks[index + 1] - breaks[index]
+    local = np.divide(values - breaks[index], span, out=np.zeros_like(values), where=span > 0)
+    return index, np.clip(local, 0.0, 1.0)
+
+
+def evaluate_mesh(points, breaks_s, breaks_t, s, t):
+    """
+    Evaluate the piecewise bicubic Bezier surface at content positions ``s``
+    (1D, across) and ``t`` (1D, down). Returns a len(t) x len(s) x 2 array.
+    """
+    col, local_s = _patch_coords(s, breaks_s)
+    row, local_t = _patch_coords(t, breaks_t)
+    basis_s = _bernstein(local_s)  # S x 4
+    basis_t = _bernstein(local_t)  # T x 4
+
+    cols = col[:, None] * 3 + np.arange(4)  # S x 4 control point columns
+    rows = row[:, None] * 3 + np.arange(4)  # T x 4 control point rows
+    # Blend along s for every control row, then along t.
+    across = np.einsum("sk,rskc->rsc", basis_s, points[:, cols])          # R x S x 2
+    return np.einsum("tk,tksc->tsc", basis_t, across[rows])                # T x S x 2
+
+
+def _rasterise(vertices, params, box):
+    """
+    Scan-convert the triangulated sample grid into per-pixel content positions.
+
+    ``vertices`` (canvas px) and ``params`` (s, t) are (N+1) x (M+1) x 2 grids.
+    """
+    left, top, right, bottom = box
+    height, width = bottom - top, right - left
+    out = np.full((height, width, 2), np.nan, dtype=np.float64)
+
+    v00, v01 = vertices[:-1, :-1].reshape(-1, 2), vertices[:-1, 1:].reshape(-1, 2)
+    v10, v11 = vertices[1:, :-1].reshape(-1, 2), vertices[1:, 1:].reshape(-1, 2)
+    p00, p01 = params[:-1, :-1].reshape(-1, 2), params[:-1, 1:].reshape(-1, 2)
+    p10, p11 = params[1:, :-1].reshape(-1, 2), params[1:, 1:].reshape(-1, 2)
+
+    for a, b, c, pa, pb, pc in ((v00, v01, v10, p00, p01, p10), (v11, v10, v01, p11, p10, p01)):
+        lo = np.floor(np.minimum(np.minimum(a, b), c) - 0.5).astype(np.int64) + 1
+        hi = np.floor(np.maximum(np.maximum(a, b), c) - 0.5).astype(np.int64)
+        span = int(max((hi - lo).max(initial=0) + 1, 1))
+        denom = (b[:, 1] - c[:, 1]) * (a[:, 0] - c[:, 0]) + (c[:, 0] - b[:, 0]) * (a[:, 1] - c[:, 1])
+        usable = np.abs(denom) > 1e-12
+
+        for dy in range(span):
+            for dx in range(span):
+                px = lo[:, 0] + dx
+                py = lo[:, 1] + dy
+                cx, cy = px + 0.5, py + 0.5
+                w_a = ((b[:, 1] - c[:, 1]) * (cx - c[:, 0]) + (c[:, 0] - b[:, 0]) * (cy - c[:, 1])) / np.where(usable, denom, 1)
+                w_b = ((c[:, 1] - a[:, 1]) * (cx - c[:, 0]) + (a[:, 0] - c[:, 0]) * (cy - c[:, 1])) / np.where(usable, denom, 1)
+                w_c = 1.0 - w_a - w_b
+                inside = (
+                    usable
+                    & (px <= hi[:, 0]) & (py <= hi[:, 1])
+                    & (w_a >= -1e-9) & (w_b >= -1e-9) & (w_c >= -1e-9)
+                    & (px >= left) & (px < right) & (py >= top) & (py < bottom)
+                )
+                if not inside.any():
+                    continue
+                value = (
+                    w_a[inside, None] * pa[inside]
+                    + w_b[inside, None] * pb[inside]
+                    + w_c[inside, None] * pc[inside]
+                )
+                out[py[inside] - top, px[inside] - left] = value
+    return out
+
+
+def mesh_grid(layer, quad, canvas_size, content_size, max_cell=0.75):
+    """
+    Build the WarpGrid for a warped smart object ``layer``, or None if the layer
+    has no custom warp. ``quad`` is its transform box (4x2, TL TR BR BL) and
+    ``content_size`` the size of the embedded content.
+    """
+    warp = read_warp(layer)
+    if warp is None:
+        return None
+    points, breaks_s, breaks_t = mesh_from_warp(warp)
+
+    # The mesh's control-point box is what the transform box places on the canvas.
+    low, high = points.reshape(-1, 2).min(axis=0), points.reshape(-1, 2).max(axis=0)
+    extent = high - low
+    if (extent <= 0).any():
+        return None
+    to_canvas = np.linalg.inv(psd_renderer.quad_homography(quad, 1.0, 1.0))
+
+    def project(mesh_xy):
+        unit = (mesh_xy - low) / extent
+        h = np.concatenate([unit, np.ones(unit.shape[:-1] + (1,))], axis=-1) @ to_canvas.T
+        return h[..., :2] / h[..., 2:3]
+
+    # Sample finely enough that no mesh cell spans more than ``max_cell`` pixels.
+    coarse = project(evaluate_mesh(points, breaks_s, breaks_t, np.linspace(0, 1, 65), np.linspace(0, 1, 65)))
+    step_s = np.linalg.norm(np.diff(coarse, axis=1), axis=-1).max()
+    step_t = np.linalg.norm(np.diff(coarse, axis=0), axis=-1).max()
+    count_s = int(np.ceil(64 * step_s / max_cell)) + 1
+    count_t = int(np.ceil(64 * step_t / max_cell)) + 1
+    # Include the patch seams exactly so collapsed slices keep their edges.
+    s = np.unique(np.concatenate([np.linspace(0, 1, count_s), breaks_s]))
+    t = np.unique(np.concatenate([np.linspace(0, 1, count_t), breaks_t]))
+    vertices = project(evaluate_mesh(points, breaks_s, breaks_t, s, t))
+    params = np.stack(np.meshgrid(s, t), axis=-1)
+
+    width, height = canvas_size
+    lo = np.floor(vertices.reshape(-1, 2).min(axis=0)).astype(int)
+    hi = np.ceil(vertices.reshape(-1, 2).max(axis=0)).astype(int)
+    box = (max(int(lo[0]), 0), max(int(lo[1]), 0), min(int(hi[0]), width), min(int(hi[1]), height))
+    if box[2] <= box[0] or box[3] <= box[1]:
+        return None
+
+    field = _rasterise(vertices, params, box)
+
+    # Resample the artwork at its on-canvas scale so the gather never minifies.
+    source_w = max(int(round(content_size[0] * np.ptp(quad[:, 0]) / extent[0])), 1)
+    source_h = max(int(round(content_size[1] * np.ptp(quad[:, 1]) / extent[1])), 1)
+
+    missing = np.isnan(field[..., 0])
+    map_x = np.where(missing, OUTSIDE, field[..., 0] * source_w).astype(np.float32)
+    map_y = np.where(missing, OUTSIDE, field[..., 1] * source_h).astype(np.float32)
+    return psd_renderer.WarpGrid(box, map_x, map_y, (source_w, source_h))